@@ -0,0 +1,69 @@
+# Measures how long logger calls take on the thread that logs, with records
+# formatted by LogzioHandler.emit and with defer_formatting, where the
+# sending thread formats them.
+#
+# Logs are only queued, the listener URL is never reached. Between logs the
+# thread sleeps for --interval-us, like a web worker waiting on I/O; with 0
+# it logs in a tight loop, competing with the sending thread for the GIL.
+#
+# Run from the repository root:
+#   python -m benchmarks.emit_latency [--records 20000] [--interval-us 100]
+import argparse
+import logging
+import time
+
+from logzio.handler import LogzioHandler
+
+
+def measure(defer_formatting, records, interval):
+    handler = LogzioHandler('token', url='http://127.0.0.1:9',
+                            backup_logs=False, linger_ms=3600000,
+                            bulk_size_in_bytes=1 << 40,
+                            defer_formatting=defer_formatting)
+    handler.setFormatter(logging.Formatter('%(message)s'))
+    logger = logging.getLogger('benchmark-{}'.format(defer_formatting))
+    logger.propagate = False
+    logger.addHandler(handler)
+    logger.setLevel(logging.INFO)
+
+    try:
+        raise ValueError('Payment declined')
+    except ValueError:
+        exc_info = True
+
+    latencies = []
+    for counter in range(records):
+        start = time.perf_counter()
+        if counter % 100 == 0:
+            logger.error('Order %s failed', counter, exc_info=exc_info,
+                         extra={'user_id': counter, 'cart': ['a', 'b']})
+        else:
+            logger.info('Order %s placed for %s', counter, 'moo',
+                        extra={'user_id': counter, 'cart': ['a', 'b']})
+        latencies.append(time.perf_counter() - start)
+        if interval:
+            time.sleep(interval)
+
+    handler.logzio_sender.shutdown(timeout=0)
+    latencies.sort()
+    return [latencies[int(len(latencies) * percentile)] * 1e6
+            for percentile in (0.5, 0.99, 0.999)]
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--records', type=int, default=20000)
+    parser.add_argument('--interval-us', type=int, default=100)
+    args = parser.parse_args()
+
+    print('{:<24} {:>10} {:>10} {:>10}'.format('mode', 'p50', 'p99',
+                                               'p99.9'))
+    for defer_formatting in (False, True):
+        print('{:<24} {:>8.2f}us {:>8.2f}us {:>8.2f}us'.format(
+            'deferred' if defer_formatting else 'in emit (before)',
+            *measure(defer_formatting, args.records,
+                     args.interval_us / 1e6)))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,60 @@
+# Measures the per-record cost of encoding a typical handler log, with
+# json.dumps(...).encode('utf-8') as LogzioSender.append used to, and with
+# each installed encoder.
+#
+# Run from the repository root:
+#   python -m benchmarks.encoding [--records 100000]
+import argparse
+import datetime
+import json
+import timeit
+
+from logzio.encoder import ENCODERS
+
+LOG = {
+    'logger': 'myapp.views',
+    'line_number': 42,
+    'path_name': '/srv/myapp/views.py',
+    'log_level': 'INFO',
+    'type': 'python',
+    'message': 'User 1234 logged in from 10.0.0.1 — כניסה מוצלחת',
+    '@timestamp': '2024-01-02T03:04:05.678Z',
+    'request_id': 'a1b2c3d4',
+    'duration_ms': 12.5,
+    'tags': ['auth', 'login'],
+}
+LOG_WITH_OBJECTS = dict(LOG, context={
+    'when': datetime.datetime(2024, 1, 2, 3, 4, 5), 'roles': {'admin'}})
+
+
+def measure(function, records):
+    # Best of 5 runs, in microseconds per record
+    best = min(timeit.repeat(function, number=records, repeat=5))
+    return best / records * 1e6
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--records', type=int, default=100000)
+    args = parser.parse_args()
+
+    print('{:<28} {:>12} {:>16}'.format(
+        'encoder', 'plain log', 'log with objects'))
+    print('{:<28} {:>10.2f}us {:>14}'.format(
+        'json.dumps (before)',
+        measure(lambda: json.dumps(LOG).encode('utf-8'), args.records),
+        'raises'))
+    for name, encoder_class in ENCODERS.items():
+        try:
+            encoder = encoder_class()
+        except ImportError:
+            print('{:<28} not installed'.format(name))
+            continue
+        print('{:<28} {:>10.2f}us {:>14.2f}us'.format(
+            name,
+            measure(lambda: encoder.dumps(LOG), args.records),
+            measure(lambda: encoder.dumps(LOG_WITH_OBJECTS), args.records)))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,238 @@
+# Runs the benchmarks that guard the hot paths of the handler, and writes
+# their results as JSON, so runs can be compared:
+#   emit.*         cost of a logger call for records of a few kinds, with
+#                  the log formatted, encoded and queued (never sent)
+#   producers.*    logs per second queued by that many threads at once
+#   bulk_build.*   cost of cutting a bulk off the queue and building its
+#                  request body, plain and gzipped
+#   end_to_end     logs per second from logger calls to the mock listener
+#
+# Run from the repository root:
+#   python -m benchmarks.suite [--output results.json] [--compare old.json]
+import argparse
+import json
+import logging
+import platform
+import subprocess
+import sys
+import threading
+import time
+import timeit
+from datetime import datetime, timezone
+from importlib.metadata import version
+
+from logzio.encoder import get_encoder
+from logzio.handler import LogzioHandler
+from logzio.logs_queue import LogsQueue
+from logzio.sender import GZIP, MAX_BULK_SIZE_IN_BYTES, prepare_bulk
+
+from .throughput import start_listener
+
+# Where logs are never sent, the sending thread only ships when asked to
+UNREACHABLE = dict(url='http://127.0.0.1:9', backup_logs=False,
+                   linger_ms=3600000, bulk_size_in_bytes=1 << 40)
+JSON_FORMAT = ('{"app": "shop", "level": "%(levelname)s", '
+               '"where": "%(module)s:%(lineno)d", "text": "%(message)s"}')
+EXTRA = {'field_{}'.format(index): 'value {}'.format(index)
+         for index in range(20)}
+EXTRA.update(user_id=1234, cart=['apple', 'pear'], price=12.5,
+             address={'city': 'Tel Aviv', 'zip': '6100000'})
+
+
+def _logger(name, formatter=None, **options):
+    handler = LogzioHandler('token', **dict(UNREACHABLE, **options))
+    if formatter is not None:
+        handler.setFormatter(formatter)
+    logger = logging.getLogger('benchmark.' + name)
+    logger.handlers = [handler]
+    logger.propagate = False
+    logger.setLevel(logging.INFO)
+    return logger, handler
+
+
+def _close(handler):
+    # Drops the queued logs, which have nowhere to go
+    sender = handler.logzio_sender
+    while sender.queue.get_bulk():
+        pass
+    sender.shutdown()
+
+
+def _best_per_call(function, calls, repeat=5):
+    # Best of repeat runs, in seconds per call
+    return min(timeit.repeat(function, number=calls, repeat=repeat)) / calls
+
+
+def bench_emit(records):
+    try:
+        raise ValueError('Payment declined')
+    except ValueError:
+        exc_info = sys.exc_info()
+
+    cases = {
+        'plain': (None, lambda logger: logger.info(
+            'Order %s placed', 1234)),
+        'json_formatter': (logging.Formatter(JSON_FORMAT), lambda logger:
+                           logger.info('Order %s placed', 1234)),
+        'extras': (None, lambda logger: logger.info(
+            'Order %s placed', 1234, extra=EXTRA)),
+        'exception': (None, lambda logger: logger.error(
+            'Order %s failed', 1234, exc_info=exc_info)),
+    }
+    results = {}
+    for name, (formatter, log) in cases.items():
+        logger, handler = _logger('emit.' + name, formatter)
+        seconds = _best_per_call(lambda: log(logger), records)
+        _close(handler)
+        results['emit.' + name] = _result(seconds * 1e6, 'us/record',
+                                          'lower')
+    return results
+
+
+def bench_producers(records, thread_counts):
+    results = {}
+    for thread_count in thread_counts:
+        logger, handler = _logger('producers.{}'.format(thread_count))
+        start = threading.Barrier(thread_count + 1)
+
+        def produce():
+            start.wait()
+            for counter in range(records):
+                logger.info('Order %s placed', counter,
+                            extra={'user_id': counter})
+
+        threads = [threading.Thread(target=produce)
+                   for _ in range(thread_count)]
+        for thread in threads:
+            thread.start()
+        start.wait()
+        started = time.perf_counter()
+        for thread in threads:
+            thread.join()
+        elapsed = time.perf_counter() - started
+        _close(handler)
+        results['producers.{}'.format(thread_count)] = _result(
+            thread_count * records / elapsed, 'records/s', 'higher')
+    return results
+
+
+def bench_bulk_build(bulks):
+    encoder = get_encoder()
+    log = encoder.dumps({
+        'logger': 'benchmark', 'log_level': 'INFO', 'type': 'python',
+        'message': 'Order 1234 placed', '@timestamp':
+        '2024-01-02T03:04:05.678Z', **EXTRA})
+    logs_per_bulk = MAX_BULK_SIZE_IN_BYTES // (len(log) + 1)
+    results = {}
+    for name, compression in (('plain', None), ('gzip', GZIP)):
+        queue = LogsQueue(bulk_size=MAX_BULK_SIZE_IN_BYTES)
+
+        def build():
+            for _ in range(logs_per_bulk):
+                queue.put(log)
+            started = time.perf_counter()
+            prepare_bulk(queue.get_bulk(), compression)
+            return time.perf_counter() - started
+
+        best = min(build() for _ in range(bulks))
+        results['bulk_build.' + name] = _result(best * 1e3, 'ms/bulk',
+                                                'lower')
+    return results
+
+
+def bench_end_to_end(records):
+    listener, url = start_listener(0)
+    logger, handler = _logger('end_to_end', url=url, linger_ms=100,
+                              bulk_size_in_bytes=MAX_BULK_SIZE_IN_BYTES)
+    started = time.perf_counter()
+    for counter in range(records):
+        logger.info('Order %s placed', counter, extra={'user_id': counter})
+    handler.flush()
+    elapsed = time.perf_counter() - started
+    handler.logzio_sender.shutdown()
+    listener.stop()
+    assert listener.get_number_of_logs() == records, \
+        'Not all logs reached the listener'
+    return {'end_to_end': _result(records / elapsed, 'records/s',
+                                  'higher')}
+
+
+def _result(value, unit, better):
+    return {'value': round(value, 3), 'unit': unit, 'better': better}
+
+
+def _environment():
+    try:
+        commit = subprocess.run(
+            ['git', 'rev-parse', '--short', 'HEAD'], capture_output=True,
+            text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        commit = None
+    return {
+        'date': datetime.now(timezone.utc).isoformat(timespec='seconds'),
+        'commit': commit,
+        'package_version': version('logzio-python-handler'),
+        'python': platform.python_version(),
+        'implementation': platform.python_implementation(),
+        'platform': platform.platform(),
+        'encoder': get_encoder().name,
+    }
+
+
+def run(scale=1.0):
+    def count(number):
+        return max(1, int(number * scale))
+
+    results = {}
+    results.update(bench_emit(count(20000)))
+    results.update(bench_producers(count(20000), (1, 4, 8)))
+    results.update(bench_bulk_build(count(5)))
+    results.update(bench_end_to_end(count(50000)))
+    return {'environment': _environment(), 'results': results}
+
+
+def compare(baseline, current):
+    # A table of each result next to the baseline's, with the ones that
+    # got worse marked
+    lines = ['{:<26} {:>14} {:>14} {:>9}'.format(
+        'benchmark', 'baseline', 'current', 'change')]
+    for name, result in current['results'].items():
+        before = baseline['results'].get(name)
+        if before is None or not before['value']:
+            lines.append('{:<26} {:>14} {:>14.3f}'.format(
+                name, '-', result['value']))
+            continue
+        change = (result['value'] - before['value']) / before['value']
+        worse = change < 0 if result['better'] == 'higher' else change > 0
+        lines.append('{:<26} {:>14.3f} {:>14.3f} {:>+8.1%}{}'.format(
+            name, before['value'], result['value'], change,
+            ' worse' if worse else ''))
+    return '\n'.join(lines)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--output', help='Write the results to this file, '
+                                         'standard output by default')
+    parser.add_argument('--compare', metavar='BASELINE',
+                        help='Results of an earlier run to compare with')
+    parser.add_argument('--scale', type=float, default=1.0,
+                        help='Multiplies the number of records, e.g. 0.1 '
+                             'for a quick run')
+    args = parser.parse_args()
+
+    results = run(args.scale)
+    text = json.dumps(results, indent=2)
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.write(text + '\n')
+    else:
+        print(text)
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)
+        print(compare(baseline, results), file=sys.stderr)
+
+
+if __name__ == '__main__':
+    main()
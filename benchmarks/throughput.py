@@ -0,0 +1,60 @@
+# Measures how many logs per second LogzioSender ships to the mock listener,
+# for a few max_in_flight values. The listener answers after a fixed
+# latency, standing in for the round trip to Logz.io.
+#
+# Run from the repository root:
+#   python -m benchmarks.throughput [--logs 20000] [--latency-ms 50]
+import argparse
+import time
+
+from logzio.sender import LogzioSender
+from tests.mockLogzioListener.listener import MockLogzioListener
+
+
+def start_listener(latency):
+    # Only counts the logs, so the listener isn't what's being measured
+    listener = MockLogzioListener(latency=latency, store_logs=False)
+    return listener, 'http://{}:{}'.format(listener.get_host(),
+                                           listener.get_port())
+
+
+def run(listener, url, logs, max_in_flight, bulk_size):
+    listener.clear_logs_buffer()
+    sender = LogzioSender(token='token', url=url, logs_drain_timeout=60,
+                          bulk_size_in_bytes=bulk_size,
+                          max_in_flight=max_in_flight)
+    for counter in range(logs):
+        sender.append({'message': 'Benchmark log number {}'.format(counter),
+                       'logger': 'benchmark', 'log_level': 'INFO'})
+
+    start_time = time.perf_counter()
+    sender.flush()
+    elapsed = time.perf_counter() - start_time
+    sender.shutdown()
+    assert listener.get_number_of_logs() == logs, \
+        'Not all logs reached the listener'
+    return elapsed
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--logs', type=int, default=20000)
+    parser.add_argument('--latency-ms', type=float, default=50)
+    parser.add_argument('--bulk-size', type=int, default=64 * 1024)
+    parser.add_argument('--max-in-flight', type=int, nargs='+',
+                        default=[1, 2, 4, 8])
+    args = parser.parse_args()
+
+    listener, url = start_listener(args.latency_ms / 1000.0)
+    print('{} logs, {} bytes bulks, {} ms listener latency'.format(
+        args.logs, args.bulk_size, args.latency_ms))
+    for max_in_flight in args.max_in_flight:
+        elapsed = run(listener, url, args.logs, max_in_flight,
+                      args.bulk_size)
+        print('max_in_flight={:<3} {:8.3f}s {:10.0f} logs/s'.format(
+            max_in_flight, elapsed, args.logs / elapsed))
+    listener.stop()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,42 @@
+# Measures the per-record cost of the @timestamp of a log, with
+# datetime.now() and strftime() as LogzioHandler.format_message used to,
+# and with TimestampFormatter in each precision.
+#
+# Run from the repository root:
+#   python -m benchmarks.timestamps [--records 100000]
+import argparse
+import datetime
+import time
+import timeit
+
+from logzio.timestamps import TIMESTAMP_PRECISIONS, TimestampFormatter
+
+
+def measure(function, records):
+    # Best of 5 runs, in microseconds per record
+    best = min(timeit.repeat(function, number=records, repeat=5))
+    return best / records * 1e6
+
+
+def strftime_now():
+    now = datetime.datetime.now(datetime.timezone.utc)
+    return now.strftime('%Y-%m-%dT%H:%M:%S') + \
+        '.%03d' % (now.microsecond / 1000) + 'Z'
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--records', type=int, default=100000)
+    args = parser.parse_args()
+
+    print('{:<28} {:>10.2f}us'.format(
+        'datetime.now (before)', measure(strftime_now, args.records)))
+    for precision in TIMESTAMP_PRECISIONS:
+        format_timestamp = TimestampFormatter(precision)
+        print('{:<28} {:>10.2f}us'.format(
+            precision,
+            measure(lambda: format_timestamp(time.time()), args.records)))
+
+
+if __name__ == '__main__':
+    main()
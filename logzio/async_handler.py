@@ -0,0 +1,112 @@
+import asyncio
+import logging
+from concurrent import futures
+
+from .async_sender import AsyncLogzioSender
+from .exceptions import LogzioException
+from .handler import LogzioHandler, add_trace_context
+from .sender import MAX_BULK_SIZE_IN_BYTES
+
+
+class AsyncLogzioHandler(LogzioHandler):
+    # Formats records like LogzioHandler, and ships them from a task on the
+    # running event loop with an AsyncLogzioSender
+
+    def __init__(self,
+                 token,
+                 logzio_type="python",
+                 logs_drain_timeout=3,
+                 url="https://listener.logz.io:8071",
+                 debug=False,
+                 backup_logs=True,
+                 network_timeout=10.0,
+                 retries_no=4,
+                 retry_timeout=2,
+                 add_context=False,
+                 max_queue_size=0,
+                 max_queue_bytes=0,
+                 overflow_policy='drop_newest',
+                 compression=None,
+                 compression_level=6,
+                 bulk_size_in_bytes=MAX_BULK_SIZE_IN_BYTES,
+                 linger_ms=None,
+                 shutdown_timeout=10.0,
+                 transport=None,
+                 json_encoder=None,
+                 allowed_extra_fields=None,
+                 denied_extra_fields=None,
+                 timestamp_precision='millis',
+                 sampling_rules=None,
+                 sampling_summary_interval=60,
+                 dedup_window=None,
+                 dedup_max_keys=1024):
+
+        if not token:
+            raise LogzioException('Logz.io Token must be provided')
+
+        self.logzio_type = logzio_type
+        self._init_record_pipeline(
+            allowed_extra_fields, denied_extra_fields, timestamp_precision,
+            sampling_rules, sampling_summary_interval, dedup_window,
+            dedup_max_keys)
+
+        if add_context:
+            add_trace_context()
+        self.logzio_sender = AsyncLogzioSender(
+            token=token,
+            url=url,
+            logs_drain_timeout=logs_drain_timeout,
+            debug=debug,
+            backup_logs=backup_logs,
+            network_timeout=network_timeout,
+            number_of_retries=retries_no,
+            retry_timeout=retry_timeout,
+            max_queue_size=max_queue_size,
+            max_queue_bytes=max_queue_bytes,
+            overflow_policy=overflow_policy,
+            compression=compression,
+            compression_level=compression_level,
+            bulk_size_in_bytes=bulk_size_in_bytes,
+            linger_ms=linger_ms,
+            shutdown_timeout=shutdown_timeout,
+            transport=transport,
+            json_encoder=json_encoder)
+        logging.Handler.__init__(self)
+
+    async def aflush(self):
+        self._ship_pending_summaries()
+        await self.logzio_sender.flush()
+
+    async def aclose(self):
+        self._ship_pending_summaries()
+        await self.logzio_sender.aclose()
+        logging.Handler.close(self)
+
+    # logging calls flush() and close() synchronously, e.g. from
+    # logging.shutdown()
+    def flush(self, timeout=None):
+        # Waits up to timeout seconds for the queue to be drained, and
+        # returns whether it was. From a running loop, which the flush
+        # needs, or without a timeout while the loop runs in another
+        # thread, the flush is only scheduled. With no loop running, it's
+        # run in this thread, for up to shutdown_timeout seconds without a
+        # timeout.
+        future = self.flush_async(timeout)
+        try:
+            asyncio.get_running_loop()
+        except RuntimeError:
+            if timeout is not None:
+                try:
+                    return future.result(timeout)
+                except futures.TimeoutError:
+                    return False
+        return future.done() and not future.cancelled() and future.result()
+
+    def flush_async(self, timeout=None):
+        self._ship_pending_summaries()
+        return self.logzio_sender.flush_async(timeout)
+
+    def close(self):
+        self._ship_pending_summaries()
+        self.logzio_sender.schedule_close()
+        logging.Handler.close(self)
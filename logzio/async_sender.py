@@ -0,0 +1,312 @@
+# This class is responsible for handling Logz.io's communication from a
+# task on the running asyncio event loop, instead of a thread of its own
+import asyncio
+import functools
+import threading
+from concurrent import futures
+
+import requests
+
+from .encoder import get_encoder
+from .exceptions import LogzioException
+from .logger import get_stdout_logger
+from .logs_queue import LogsQueue, BLOCK, DROP_NEWEST
+from .sender import (MAX_BULK_SIZE_IN_BYTES, GZIP, RETRY, backup_logs,
+                     check_response, prepare_bulk, _write_backup_file)
+
+
+class RequestsTransport:
+    # Posts with a blocking requests session, from the loop's default
+    # executor. Used when aiohttp is not installed.
+    def __init__(self):
+        self.requests_session = requests.Session()
+
+    async def post(self, url, headers, data, timeout):
+        loop = asyncio.get_running_loop()
+        response = await loop.run_in_executor(None, functools.partial(
+            self.requests_session.post, url, headers=headers, data=data,
+            timeout=timeout))
+        return response.status_code, response.text
+
+    async def close(self):
+        self.requests_session.close()
+
+
+class AiohttpTransport:
+    def __init__(self):
+        import aiohttp
+        self._aiohttp = aiohttp
+        self._session = None
+        self._loop = None
+
+    async def post(self, url, headers, data, timeout):
+        loop = asyncio.get_running_loop()
+        # A session can only be used from the loop it was created in
+        if self._session is None or self._loop is not loop:
+            self._session = self._aiohttp.ClientSession()
+            self._loop = loop
+        async with self._session.post(
+                url, headers=headers, data=data,
+                timeout=self._aiohttp.ClientTimeout(total=timeout)) as resp:
+            return resp.status, await resp.text()
+
+    async def close(self):
+        if self._session is not None:
+            await self._session.close()
+            self._session = None
+
+
+def default_transport():
+    try:
+        return AiohttpTransport()
+    except ImportError:
+        return RequestsTransport()
+
+
+def _concurrent_future(task):
+    # A concurrent.futures.Future following task, for other threads to wait
+    # for
+    future = futures.Future()
+
+    def copy_outcome(task):
+        if task.cancelled():
+            future.cancel()
+        elif task.exception() is not None:
+            future.set_exception(task.exception())
+        else:
+            future.set_result(task.result())
+
+    task.add_done_callback(copy_outcome)
+    return future
+
+
+class AsyncLogzioSender:
+    def __init__(self,
+                 token, url='https://listener.logz.io:8071',
+                 logs_drain_timeout=5,
+                 debug=False,
+                 backup_logs=True,
+                 network_timeout=10.0,
+                 number_of_retries=4,
+                 retry_timeout=2,
+                 max_queue_size=0,
+                 max_queue_bytes=0,
+                 overflow_policy=DROP_NEWEST,
+                 compression=None,
+                 compression_level=6,
+                 bulk_size_in_bytes=MAX_BULK_SIZE_IN_BYTES,
+                 linger_ms=None,
+                 shutdown_timeout=10.0,
+                 transport=None,
+                 json_encoder=None):
+        if overflow_policy == BLOCK:
+            raise LogzioException(
+                'The block overflow policy would block the event loop')
+        if compression not in (None, GZIP):
+            raise LogzioException(
+                'Unsupported compression {}, only {} is supported'.format(
+                    compression, GZIP))
+
+        self.token = token
+        self.url = '{}/?token={}'.format(url, token)
+        self.stdout_logger = get_stdout_logger(debug)
+        self.backup_logs = backup_logs
+        self.encoder = get_encoder(json_encoder)
+        self.network_timeout = network_timeout
+        self.number_of_retries = number_of_retries
+        self.retry_timeout = retry_timeout
+        self.compression = compression
+        self.compression_level = compression_level
+        self.bulk_size_in_bytes = bulk_size_in_bytes
+        self.linger = (logs_drain_timeout if linger_ms is None
+                       else linger_ms / 1000.0)
+        self.shutdown_timeout = shutdown_timeout
+        self.transport = transport or default_transport()
+        self.queue = LogsQueue(max_size=max_queue_size,
+                               max_bytes=max_queue_bytes,
+                               overflow_policy=overflow_policy,
+                               spill_function=_write_backup_file,
+                               bulk_size=bulk_size_in_bytes)
+
+        self._loop = None
+        self._loop_thread_id = None
+        self._drain_task = None
+        self._wakeup = None
+        self._flush_lock = None
+        self._closing = False
+
+    @property
+    def dropped_logs(self):
+        return self.queue.dropped
+
+    def append(self, logs_message):
+        # Can be called from any thread. The sending task is started on
+        # the loop running in the calling thread, if there is one.
+        was_empty = self.queue.empty()
+        if not self.queue.put(self.encoder.dumps(logs_message)):
+            return
+        if ((self._drain_task is None or self._drain_task.done()) and
+                not self._closing):
+            self._start()
+        if was_empty or self.queue.bulk_ready(self.linger):
+            self._wake()
+
+    def _start(self):
+        try:
+            loop = asyncio.get_running_loop()
+        except RuntimeError:
+            # No loop in this thread, logs wait until one starts the task
+            return
+        self._bind(loop)
+        self._drain_task = loop.create_task(self._drain_queue())
+
+    def _bind(self, loop):
+        if self._loop is not loop:
+            self._loop = loop
+            self._loop_thread_id = threading.get_ident()
+            self._wakeup = asyncio.Event()
+            self._flush_lock = asyncio.Lock()
+
+    def _wake(self):
+        if self._wakeup is None or self._loop.is_closed():
+            return
+        if threading.get_ident() == self._loop_thread_id:
+            self._wakeup.set()
+        else:
+            self._loop.call_soon_threadsafe(self._wakeup.set)
+
+    async def _drain_queue(self):
+        while not self._closing:
+            try:
+                await asyncio.wait_for(self._wakeup.wait(),
+                                       self.queue.time_to_bulk(self.linger))
+            except asyncio.TimeoutError:
+                pass
+            self._wakeup.clear()
+            try:
+                await self._flush_queue(drain_all=self._closing)
+            except Exception as e:
+                self.stdout_logger.debug(
+                    'Unexpected exception while draining queue to Logz.io, '
+                    'swallowing. Exception: %s', e)
+
+    async def flush(self):
+        self._bind(asyncio.get_running_loop())
+        await self._flush_queue()
+
+    async def _flush_within(self, timeout):
+        # Whether the flush ended within timeout seconds. It goes on past
+        # them, so the bulk being sent isn't cancelled.
+        try:
+            await asyncio.wait_for(asyncio.shield(self.flush()), timeout)
+        except asyncio.TimeoutError:
+            return False
+        return True
+
+    async def aclose(self):
+        # Sends everything queued, giving up after shutdown_timeout seconds
+        # (logs left are backed up to disk), and closes the transport
+        self._closing = True
+        self._wake()
+        try:
+            await asyncio.wait_for(self.flush(), self.shutdown_timeout)
+        except asyncio.TimeoutError:
+            self.stdout_logger.info(
+                'Could not drain the queue within %s seconds of shutdown',
+                self.shutdown_timeout)
+            if self.backup_logs:
+                while not self.queue.empty():
+                    backup_logs(self.queue.get_bulk(), self.stdout_logger)
+        if self._drain_task is not None:
+            self._drain_task.cancel()
+        await self.transport.close()
+
+    # For synchronous callers, which can't wait for the loop: the work is
+    # scheduled on it, or run to completion when no loop is running
+    def schedule_flush(self):
+        self._run_soon(self.flush)
+
+    def schedule_close(self):
+        self._run_soon(self.aclose)
+
+    def flush_async(self, timeout=None):
+        # Like LogzioSender.flush_async(), a concurrent.futures.Future whose
+        # result is whether the queue was drained within timeout seconds.
+        # With no loop running, the flush is run in this thread, so without
+        # a timeout it's given up after shutdown_timeout seconds.
+        if timeout is None and self._no_running_loop():
+            timeout = self.shutdown_timeout
+        return self._run_soon(functools.partial(self._flush_within, timeout))
+
+    def _no_running_loop(self):
+        try:
+            asyncio.get_running_loop()
+        except RuntimeError:
+            return self._loop is None or not self._loop.is_running()
+        return False
+
+    def _run_soon(self, coroutine_function):
+        # Returns a concurrent.futures.Future of the coroutine's result
+        try:
+            loop = asyncio.get_running_loop()
+        except RuntimeError:
+            loop = None
+
+        if loop is not None:
+            return _concurrent_future(loop.create_task(coroutine_function()))
+        if self._loop is not None and self._loop.is_running():
+            return asyncio.run_coroutine_threadsafe(coroutine_function(),
+                                                    self._loop)
+        future = futures.Future()
+        future.set_result(asyncio.run(coroutine_function()))
+        return future
+
+    async def _flush_queue(self, drain_all=True):
+        async with self._flush_lock:
+            while (not self.queue.empty() if drain_all
+                   else self.queue.bulk_ready(self.linger)):
+                logs_list = self.queue.get_bulk()
+                if not logs_list:
+                    break
+                self.stdout_logger.debug(
+                    'Starting to drain %s logs to Logz.io', len(logs_list))
+                try:
+                    await self._send_bulk(logs_list)
+                except asyncio.CancelledError:
+                    # Logs taken off the queue are not lost on cancellation
+                    if self.backup_logs:
+                        backup_logs(logs_list, self.stdout_logger)
+                    raise
+
+    async def _send_bulk(self, logs_list):
+        # Same bulk, response and backup semantics as LogzioSender. Retries
+        # sleep on the loop, which keeps serving other tasks meanwhile.
+        should_backup_to_disk = True
+        headers, data, _ = prepare_bulk(
+            logs_list, self.compression, self.compression_level)
+
+        for current_try in range(self.number_of_retries):
+            try:
+                status_code, text = await self.transport.post(
+                    self.url, headers, data, self.network_timeout)
+                result = check_response(
+                    status_code, text, len(logs_list), current_try,
+                    self.number_of_retries, self.stdout_logger)
+            except Exception as e:
+                self.stdout_logger.warning(
+                    'Got exception while sending logs to Logz.io, '
+                    'Try (%s/%s). Message: %s',
+                    current_try + 1, self.number_of_retries, e)
+                result = RETRY
+
+            if result != RETRY:
+                should_backup_to_disk = False
+                break
+            await asyncio.sleep(self.retry_timeout)
+
+        if should_backup_to_disk and self.backup_logs:
+            self.stdout_logger.error(
+                'Could not send logs to Logz.io after %s tries, '
+                'backing up to local file system', self.number_of_retries)
+            await asyncio.get_running_loop().run_in_executor(
+                None, backup_logs, logs_list, self.stdout_logger)
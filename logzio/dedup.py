@@ -0,0 +1,169 @@
+# Collapses bursts of the same record into one summary record
+import os
+import threading
+import weakref
+from collections import OrderedDict
+from time import monotonic
+
+from .formatting import snapshot_record
+
+# Deduplicators in use, reset in forked children
+_live_deduplicators = weakref.WeakSet()
+
+
+def _reset_deduplicators_after_fork():
+    for deduplicator in list(_live_deduplicators):
+        deduplicator._reset_after_fork()
+
+
+if hasattr(os, 'register_at_fork'):
+    os.register_at_fork(after_in_child=_reset_deduplicators_after_fork)
+
+
+def fingerprint(record):
+    # Records are the same when they are logged by the same call, with the
+    # same template, and for an exception of the same type raised at the
+    # same place
+    exception_type = exception_location = None
+    if record.exc_info and record.exc_info[0] is not None:
+        exception_type = record.exc_info[0]
+        traceback = record.exc_info[2]
+        while traceback is not None and traceback.tb_next is not None:
+            traceback = traceback.tb_next
+        if traceback is not None:
+            exception_location = (traceback.tb_frame.f_code.co_filename,
+                                  traceback.tb_lineno)
+    return (record.name, record.levelno, record.msg, record.pathname,
+            record.lineno, exception_type, exception_location)
+
+
+class _Window:
+    __slots__ = ('expires', 'repeats', 'first_created', 'last_record',
+                 'args_samples')
+
+    def __init__(self, expires):
+        self.expires = expires
+        self.repeats = 0
+        self.first_created = None
+        self.last_record = None
+        self.args_samples = []
+
+
+# The first record of a fingerprint is let through, and the ones repeating
+# it in the next window seconds are held back. Once the window is over,
+# summary_function gets a copy of the last repeat, with repeat_count, the
+# records held back, and repeated_args, the repr() of up to
+# max_args_samples distinct args, along with the times the first and last
+# repeats were created.
+#
+# At most max_keys fingerprints are tracked, the oldest window is closed
+# early to make room for a new one.
+class RecordDeduplicator:
+
+    def __init__(self, summary_function, window=1.0, max_keys=1024,
+                 max_args_samples=5):
+        self.summary_function = summary_function
+        self.window = window
+        self.max_keys = max_keys
+        self.max_args_samples = max_args_samples
+        # Windows by fingerprint, in the order they started and so expire
+        self._windows = OrderedDict()
+        self._lock = threading.Lock()
+        # Closes windows with repeats while no records come in
+        self._timer = None
+        _live_deduplicators.add(self)
+
+    def _reset_after_fork(self):
+        # Runs in a forked child. The repeats counted so far are summarized
+        # by the parent, the timer's thread is gone, and the lock may have
+        # been held by one of the parent's threads.
+        self._windows = OrderedDict()
+        self._lock = threading.Lock()
+        self._timer = None
+
+    def admit(self, record):
+        try:
+            key = fingerprint(record)
+            hash(key)
+        except TypeError:
+            # A msg that isn't hashable
+            return True
+
+        summaries = []
+        with self._lock:
+            now = monotonic()
+            self._expire(now, summaries)
+            window = self._windows.get(key)
+            if window is None:
+                if len(self._windows) >= self.max_keys:
+                    self._close(self._windows.popitem(last=False)[1],
+                                summaries)
+                self._windows[key] = _Window(now + self.window)
+                admitted = True
+            else:
+                self._add_repeat(window, record)
+                if self._timer is None:
+                    self._start_timer(window.expires - now)
+                admitted = False
+        self._ship(summaries)
+        return admitted
+
+    def _add_repeat(self, window, record):
+        if not window.repeats:
+            window.first_created = record.created
+        window.repeats += 1
+        window.last_record = record
+        if len(window.args_samples) < self.max_args_samples and record.args:
+            args = repr(record.args)
+            if args not in window.args_samples:
+                window.args_samples.append(args)
+
+    def _expire(self, now, summaries):
+        while self._windows:
+            window = next(iter(self._windows.values()))
+            if window.expires > now:
+                break
+            self._windows.popitem(last=False)
+            self._close(window, summaries)
+
+    def _close(self, window, summaries):
+        if not window.repeats:
+            return
+        summary = snapshot_record(window.last_record)
+        summary.repeat_count = window.repeats
+        summary.repeated_args = window.args_samples
+        summaries.append((summary, window.first_created,
+                          window.last_record.created))
+
+    def _start_timer(self, delay):
+        self._timer = threading.Timer(max(0, delay), self._on_timer)
+        self._timer.daemon = True
+        self._timer.start()
+
+    def _on_timer(self):
+        summaries = []
+        with self._lock:
+            self._timer = None
+            now = monotonic()
+            self._expire(now, summaries)
+            pending = [window for window in self._windows.values()
+                       if window.repeats]
+            if pending:
+                self._start_timer(pending[0].expires - now)
+        self._ship(summaries)
+
+    def close_all(self):
+        # Ships the summaries of every window, over or not, e.g. on flush
+        summaries = []
+        with self._lock:
+            while self._windows:
+                self._close(self._windows.popitem(last=False)[1], summaries)
+            if self._timer is not None:
+                self._timer.cancel()
+                self._timer = None
+        self._ship(summaries)
+
+    def _ship(self, summaries):
+        # Outside the lock, summary_function may take the handler's lock
+        for summary, first_created, last_created in summaries:
+            self.summary_function(summary, first_created, last_created)
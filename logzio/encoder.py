@@ -0,0 +1,155 @@
+# Encodes logs to UTF-8 JSON, with orjson or ujson when they are installed
+import dataclasses
+import datetime
+import decimal
+import enum
+import json
+import uuid
+from pathlib import PurePath
+
+from .exceptions import LogzioException
+
+
+def _encode_bytes(value):
+    return value.decode('utf-8', 'replace')
+
+
+def _encode_dataclass(value):
+    return dataclasses.asdict(value)
+
+
+# How values JSON doesn't support are encoded, by type. Subclasses use the
+# converter of their closest registered base class, and values of any other
+# type are encoded with repr().
+DEFAULT_CONVERTERS = {
+    datetime.datetime: datetime.datetime.isoformat,
+    datetime.date: datetime.date.isoformat,
+    datetime.time: datetime.time.isoformat,
+    datetime.timedelta: datetime.timedelta.total_seconds,
+    decimal.Decimal: str,
+    uuid.UUID: str,
+    enum.Enum: lambda value: value.value,
+    PurePath: str,
+    bytes: _encode_bytes,
+    bytearray: _encode_bytes,
+    set: list,
+    frozenset: list,
+    tuple: list,
+    BaseException: repr,
+}
+
+
+class TypeDispatcher:
+    # The `default` hook of the encoders. The converter found for a type is
+    # cached, so the type's MRO is only looked up the first time.
+
+    def __init__(self, converters=None):
+        self._converters = dict(DEFAULT_CONVERTERS)
+        self._converters.update(converters or {})
+        self._cache = {}
+
+    def register(self, value_type, converter):
+        self._converters[value_type] = converter
+        self._cache.clear()
+
+    def __call__(self, value):
+        value_type = type(value)
+        try:
+            converter = self._cache[value_type]
+        except KeyError:
+            converter = self._cache[value_type] = self._resolve(value_type)
+        if converter is repr and dataclasses.is_dataclass(value):
+            converter = _encode_dataclass
+        return converter(value)
+
+    def _resolve(self, value_type):
+        for base in value_type.__mro__:
+            converter = self._converters.get(base)
+            if converter is not None:
+                return converter
+        return repr
+
+
+class StdlibEncoder:
+    name = 'json'
+
+    def __init__(self, default=None):
+        self.default = default or TypeDispatcher()
+        self._encoder = json.JSONEncoder(
+            ensure_ascii=False, separators=(',', ':'), default=self.default)
+        # Escapes lone surrogates, which can't be encoded to UTF-8
+        self._ascii_encoder = json.JSONEncoder(
+            separators=(',', ':'), default=self.default)
+
+    def dumps(self, value):
+        try:
+            return self._encoder.encode(value).encode('utf-8')
+        except UnicodeEncodeError:
+            return self._ascii_encoder.encode(value).encode('utf-8')
+
+    def loads(self, data):
+        return json.loads(data)
+
+
+class OrjsonEncoder(StdlibEncoder):
+    name = 'orjson'
+
+    def __init__(self, default=None):
+        import orjson
+        StdlibEncoder.__init__(self, default)
+        self._orjson = orjson
+        self._options = orjson.OPT_NON_STR_KEYS
+
+    def dumps(self, value):
+        try:
+            return self._orjson.dumps(value, default=self.default,
+                                      option=self._options)
+        except TypeError:
+            # orjson.JSONEncodeError, e.g. for integers beyond 64 bits or
+            # lone surrogates, which the standard library encodes
+            return StdlibEncoder.dumps(self, value)
+
+    def loads(self, data):
+        return self._orjson.loads(data)
+
+
+class UjsonEncoder(StdlibEncoder):
+    name = 'ujson'
+
+    def __init__(self, default=None):
+        import ujson
+        StdlibEncoder.__init__(self, default)
+        self._ujson = ujson
+
+    def dumps(self, value):
+        try:
+            return self._ujson.dumps(value, ensure_ascii=False,
+                                     default=self.default).encode('utf-8')
+        except (TypeError, ValueError, OverflowError):
+            return StdlibEncoder.dumps(self, value)
+
+    def loads(self, data):
+        return self._ujson.loads(data)
+
+
+ENCODERS = {encoder.name: encoder
+            for encoder in (OrjsonEncoder, UjsonEncoder, StdlibEncoder)}
+
+
+def get_encoder(encoder=None, default=None):
+    # encoder is the name of one of ENCODERS, an encoder instance, or None
+    # for the fastest one installed
+    if encoder is not None and not isinstance(encoder, str):
+        return encoder
+    if encoder is not None:
+        if encoder not in ENCODERS:
+            raise LogzioException(
+                'Unknown JSON encoder {}, expected one of {}'.format(
+                    encoder, ', '.join(ENCODERS)))
+        return ENCODERS[encoder](default)
+
+    for encoder_class in ENCODERS.values():
+        try:
+            return encoder_class(default)
+        except ImportError:
+            continue
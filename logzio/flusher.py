@@ -1,21 +1,146 @@
+import asyncio
 import functools
+import inspect
 import logging
+from concurrent import futures
+from time import monotonic
+
+from .async_handler import AsyncLogzioHandler
+from .handler import LogzioHandler
+
+
+def logzio_handlers(logger):
+    # The Logz.io handlers records of logger reach, its own and the ones
+    # of the ancestors it propagates to
+    handlers = []
+    current = logger
+    while current is not None:
+        for handler in current.handlers:
+            if isinstance(handler, LogzioHandler) and handler not in handlers:
+                handlers.append(handler)
+        if not current.propagate:
+            break
+        current = current.parent
+    return handlers
+
+
+def flush_handlers(handlers, timeout=None):
+    # Flushes handlers at once, and returns whether all of them were
+    # flushed within timeout seconds. Handlers shipping from an event loop
+    # flush in this thread when no loop is running, so they're started
+    # last, each with what is left of timeout.
+    deadline = None if timeout is None else monotonic() + timeout
+    pending = []
+    for handler in sorted(
+            handlers, key=lambda h: isinstance(h, AsyncLogzioHandler)):
+        pending.append(handler.flush_async(_time_left(deadline)))
+    done, not_done = futures.wait(pending, _time_left(deadline))
+    return not not_done and all(future.result() for future in done)
+
+
+def _time_left(deadline):
+    return None if deadline is None else max(0, deadline - monotonic())
+
+
+async def aflush_handlers(handlers, timeout=None):
+    # Like flush_handlers(), without blocking the running event loop
+    awaitables = [
+        handler.aflush() if isinstance(handler, AsyncLogzioHandler)
+        else asyncio.wrap_future(handler.flush_async(timeout))
+        for handler in handlers]
+    try:
+        results = await asyncio.wait_for(asyncio.gather(*awaitables),
+                                         timeout)
+    except asyncio.TimeoutError:
+        return False
+    # aflush() returns None
+    return all(result is not False for result in results)
 
 
 class LogzioFlusher(logging.Logger):
+    # Decorates a function, e.g. the handler of a serverless function, to
+    # flush the Logz.io handlers of logger and its ancestors once it
+    # returns or raises. Coroutine functions are flushed without blocking
+    # the event loop, and generators once they are exhausted or closed.
+    # The handlers are flushed at once, for at most timeout seconds in all.
+    #
+    # It can also be used as a context manager, flushing the handlers when
+    # the block exits.
 
-    def __init__(self, logger):
+    def __init__(self, logger, timeout=10.0):
         self.logger = logger
+        self.timeout = timeout
+
+    def flush(self):
+        return flush_handlers(logzio_handlers(self.logger), self.timeout)
+
+    async def aflush(self):
+        return await aflush_handlers(logzio_handlers(self.logger),
+                                     self.timeout)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if isinstance(exc_value, Exception):
+            self._log_failure(exc_value)
+        self.flush()
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, exc_type, exc_value, traceback):
+        if isinstance(exc_value, Exception):
+            self._log_failure(exc_value)
+        await self.aflush()
+
+    def _log_failure(self, e):
+        self.logger.exception('call failed: {}'.format(e))
 
     def __call__(self, function):
-        @functools.wraps(function)
-        def wrapper(*args, **kwargs):
-            try:
-                return function(*args, **kwargs)
-            except Exception as e:
-                self.logger.exception('call failed: {}'.format(e))
-                raise
-            finally:
-                [h.flush() for h in self.logger.handlers]
+        if inspect.isasyncgenfunction(function):
+            @functools.wraps(function)
+            async def wrapper(*args, **kwargs):
+                try:
+                    async for item in function(*args, **kwargs):
+                        yield item
+                except Exception as e:
+                    self._log_failure(e)
+                    raise
+                finally:
+                    await self.aflush()
+
+        elif inspect.iscoroutinefunction(function):
+            @functools.wraps(function)
+            async def wrapper(*args, **kwargs):
+                try:
+                    return await function(*args, **kwargs)
+                except Exception as e:
+                    self._log_failure(e)
+                    raise
+                finally:
+                    await self.aflush()
+
+        elif inspect.isgeneratorfunction(function):
+            @functools.wraps(function)
+            def wrapper(*args, **kwargs):
+                try:
+                    return (yield from function(*args, **kwargs))
+                except Exception as e:
+                    self._log_failure(e)
+                    raise
+                finally:
+                    self.flush()
+
+        else:
+            @functools.wraps(function)
+            def wrapper(*args, **kwargs):
+                try:
+                    return function(*args, **kwargs)
+                except Exception as e:
+                    self._log_failure(e)
+                    raise
+                finally:
+                    self.flush()
 
         return wrapper
@@ -0,0 +1,353 @@
+# Compiles a handler's formatter into a plan for merging its output into the
+# log, once, instead of formatting and parsing it as JSON on every record
+import json
+import logging
+import re
+import string
+
+# First characters of anything json.loads accepts
+JSON_START = frozenset('{["-0123456789tfnNI')
+# Placeholders whose value can never be parsed as JSON, and so can't start
+# a JSON formatted message
+NON_JSON_FIELDS = frozenset(('asctime', 'levelname'))
+# Stands for the placeholders while the format is parsed as JSON
+MARKER = '\ue000{}\ue001'
+MARKER_PATTERN = re.compile('\ue000(\\d+)\ue001')
+PERCENT_PLACEHOLDER = re.compile(
+    r'%\((\w+)\)[#0+ -]*(\*|\d+)?(\.(\*|\d+))?[diouxefgcrsa%]', re.I)
+
+
+class _RecordFields:
+    # The values a format string is rendered with, like in
+    # logging.Formatter.format, computed only when used
+
+    def __init__(self, record, formatter):
+        self.record = record
+        self.formatter = formatter
+
+    def __getitem__(self, key):
+        if key == 'message':
+            return self.record.getMessage()
+        if key == 'asctime':
+            return self.formatter.formatTime(self.record,
+                                             self.formatter.datefmt)
+        try:
+            return self.record.__dict__[key]
+        except KeyError:
+            defaults = getattr(self.formatter._style, '_defaults', None)
+            if defaults and key in defaults:
+                return defaults[key]
+            raise
+
+
+def _tokenize(fmt, style):
+    # Splits a format string into literal text and (field, placeholder)
+    # tuples, with escapes in the literal text resolved
+    tokens = []
+    if style == '%':
+        position = 0
+        for match in PERCENT_PLACEHOLDER.finditer(fmt):
+            tokens.append(fmt[position:match.start()])
+            tokens.append((match.group(1), match.group(0)))
+            position = match.end()
+        tokens.append(fmt[position:])
+        return [token.replace('%%', '%') if isinstance(token, str)
+                else token for token in tokens]
+
+    if style == '{':
+        for literal, field, spec, conversion in string.Formatter().parse(fmt):
+            tokens.append(literal)
+            if field is not None:
+                placeholder = '{' + field
+                if conversion:
+                    placeholder += '!' + conversion
+                if spec:
+                    placeholder += ':' + spec
+                tokens.append((field, placeholder + '}'))
+        return tokens
+
+    position = 0
+    for match in string.Template.pattern.finditer(fmt):
+        tokens.append(fmt[position:match.start()])
+        if match.group('escaped') is not None:
+            tokens.append('$')
+        elif match.group('invalid') is not None:
+            raise ValueError('Invalid placeholder in {}'.format(fmt))
+        else:
+            field = match.group('named') or match.group('braced')
+            tokens.append((field, match.group(0)))
+        position = match.end()
+    tokens.append(fmt[position:])
+    return tokens
+
+
+def _escape(text, style):
+    if style == '%':
+        return text.replace('%', '%%')
+    if style == '{':
+        return text.replace('{', '{{').replace('}', '}}')
+    return text.replace('$', '$$')
+
+
+def _renderer(template, style):
+    if style == '%':
+        return lambda fields: template % fields
+    if style == '{':
+        return template.format_map
+    return string.Template(template).substitute
+
+
+class LegacyPlan:
+    # Formats the record and parses the result as JSON, for formatters this
+    # module can't see through
+
+    def apply(self, handler, record, return_json):
+        formatted_message = handler.format(record)
+        # Exception with multiple fields, apply them to log json.
+        if isinstance(formatted_message, dict):
+            return_json.update(formatted_message)
+        # No exception, apply default formatted message
+        elif not record.exc_info:
+            return_json['message'] = formatted_message
+
+
+class RenderedPlan:
+    # The format renders text that may or may not be JSON, which is only
+    # parsed if it starts like JSON
+
+    def __init__(self, formatter, loads):
+        self.formatter = formatter
+        self.loads = loads
+
+    def apply(self, handler, record, return_json):
+        message = self.formatter.format(record)
+        if record.exc_info:
+            # Only the first line, the exception is set already
+            message = message.split('\n')[0]
+        if message.lstrip()[:1] in JSON_START:
+            try:
+                message = self.loads(message)
+            except (TypeError, ValueError):
+                pass
+        if isinstance(message, dict):
+            return_json.update(message)
+        elif not record.exc_info:
+            return_json['message'] = message
+
+
+class MessagePlan:
+    # The format is the message itself, which is only parsed if it may be
+    # JSON
+
+    def __init__(self, loads):
+        self.loads = loads
+
+    def apply(self, handler, record, return_json):
+        if record.stack_info and not record.exc_info:
+            # The formatted message ends with the stack
+            return LegacyPlan().apply(handler, record, return_json)
+        if record.exc_info:
+            # The message is already set, unless the first line is JSON
+            message = return_json['message'].split('\n')[0]
+        else:
+            message = return_json['message']
+        if message.lstrip()[:1] not in JSON_START:
+            return
+        try:
+            parsed_message = self.loads(message)
+        except (TypeError, ValueError):
+            return
+        if isinstance(parsed_message, dict):
+            return_json.update(parsed_message)
+        elif not record.exc_info:
+            return_json['message'] = parsed_message
+
+
+class StaticPlan:
+    # The format is a constant JSON object
+
+    def __init__(self, fields):
+        self.fields = fields
+
+    def apply(self, handler, record, return_json):
+        return_json.update(self.fields)
+
+
+class TemplatePlan:
+    # The format is a JSON object whose placeholders are all inside string
+    # values, which are rendered on their own
+
+    def __init__(self, formatter, constants, templates):
+        self.formatter = formatter
+        self.constants = constants
+        self.templates = templates
+
+    def apply(self, handler, record, return_json):
+        return_json.update(self.constants)
+        fields = _RecordFields(record, self.formatter)
+        for key, render in self.templates:
+            return_json[key] = render(fields)
+
+
+class PlainTextPlan:
+    # The format can't render JSON, so its output is the message
+
+    def __init__(self, formatter):
+        self.formatter = formatter
+
+    def apply(self, handler, record, return_json):
+        if not record.exc_info:
+            return_json['message'] = self.formatter.format(record)
+
+
+def compile_format_plan(formatter, loads=json.loads):
+    if formatter is None:
+        return MessagePlan(loads)
+    # Subclasses may format records any way they like
+    if (type(formatter).format is not logging.Formatter.format or
+            type(formatter).formatMessage is not
+            logging.Formatter.formatMessage):
+        return LegacyPlan()
+
+    fmt = formatter._style._fmt
+    style = {logging.PercentStyle: '%', logging.StrFormatStyle: '{',
+             logging.StringTemplateStyle: '$'}.get(type(formatter._style))
+    if style is None:
+        return RenderedPlan(formatter, loads)
+    try:
+        tokens = [token for token in _tokenize(fmt, style) if token != '']
+    except (ValueError, KeyError):
+        return RenderedPlan(formatter, loads)
+    if not tokens:
+        return PlainTextPlan(formatter)
+
+    placeholders = [token for token in tokens if not isinstance(token, str)]
+    if len(tokens) == 1 and placeholders and placeholders[0][0] == 'message':
+        return MessagePlan(loads)
+
+    marked_format = ''.join(
+        token if isinstance(token, str) else MARKER.format(index)
+        for index, token in enumerate(tokens))
+    try:
+        parsed_format = json.loads(marked_format)
+    except ValueError:
+        parsed_format = None
+    if isinstance(parsed_format, dict):
+        if not placeholders:
+            return StaticPlan(parsed_format)
+        return _compile_template(formatter, style, tokens, parsed_format,
+                                 loads)
+
+    first_token = tokens[0]
+    if isinstance(first_token, str):
+        if first_token.lstrip()[:1] not in JSON_START:
+            return PlainTextPlan(formatter)
+    elif first_token[0] in NON_JSON_FIELDS:
+        return PlainTextPlan(formatter)
+    return RenderedPlan(formatter, loads)
+
+
+def _has_marker(value):
+    if isinstance(value, str):
+        return MARKER_PATTERN.search(value) is not None
+    if isinstance(value, dict):
+        return any(_has_marker(key) or _has_marker(item)
+                   for key, item in value.items())
+    if isinstance(value, list):
+        return any(_has_marker(item) for item in value)
+    return False
+
+
+def _compile_template(formatter, style, tokens, parsed_format, loads):
+    constants = {}
+    templates = []
+    for key, value in parsed_format.items():
+        if MARKER_PATTERN.search(key):
+            return RenderedPlan(formatter, loads)
+        if not isinstance(value, str):
+            if _has_marker(value):
+                # A placeholder nested deeper than the top level
+                return RenderedPlan(formatter, loads)
+            constants[key] = value
+            continue
+        if not MARKER_PATTERN.search(value):
+            constants[key] = value
+            continue
+
+        # Back to a format string of the style, with the JSON escapes
+        # resolved
+        parts = MARKER_PATTERN.split(value)
+        template = ''.join(
+            _escape(part, style) if index % 2 == 0
+            else tokens[int(part)][1]
+            for index, part in enumerate(parts))
+        templates.append((key, _renderer(template, style)))
+    return TemplatePlan(formatter, constants, templates)
+
+
+# Attributes logging sets on every record, which aren't extra fields
+RECORD_FIELDS = frozenset((
+    'args', 'asctime', 'created', 'exc_info', 'stack_info', 'exc_text',
+    'filename', 'funcName', 'levelname', 'levelno', 'lineno', 'module',
+    'msecs', 'message', 'msg', 'name', 'pathname', 'process',
+    'processName', 'relativeCreated', 'thread', 'threadName'))
+# Extra field values of these types are sent as is, others as their repr()
+JSON_TYPES = (str, bool, dict, float, int, list, type(None))
+# Entries kept by each cache of ExtraFieldsProjection
+MAX_CACHED_ENTRIES = 256
+
+
+class ExtraFieldsProjection:
+    # Picks the extra fields of records. The fields are looked up once per
+    # layout of record attributes, and whether a value is sent as is once
+    # per type. allowed limits the extra fields to the ones listed, and
+    # denied leaves the listed ones out.
+
+    def __init__(self, allowed=None, denied=None):
+        self.allowed = None if allowed is None else frozenset(allowed)
+        self.excluded = RECORD_FIELDS | frozenset(denied or ())
+        self._layouts = {}
+        self._sent_as_is = {}
+
+    def __call__(self, record):
+        attributes = record.__dict__
+        layout = tuple(attributes)
+        keys = self._layouts.get(layout)
+        if keys is None:
+            keys = self._compile_layout(layout)
+
+        sent_as_is = self._sent_as_is
+        extra_fields = {}
+        for key in keys:
+            value = attributes[key]
+            as_is = sent_as_is.get(type(value))
+            if as_is is None:
+                as_is = self._cache_type(type(value))
+            extra_fields[key] = value if as_is else repr(value)
+        return extra_fields
+
+    def _compile_layout(self, layout):
+        keys = tuple(key for key in layout if key not in self.excluded and
+                     (self.allowed is None or key in self.allowed))
+        if len(self._layouts) >= MAX_CACHED_ENTRIES:
+            self._layouts.clear()
+        self._layouts[layout] = keys
+        return keys
+
+    def _cache_type(self, value_type):
+        as_is = issubclass(value_type, JSON_TYPES)
+        if len(self._sent_as_is) >= MAX_CACHED_ENTRIES:
+            self._sent_as_is.clear()
+        self._sent_as_is[value_type] = as_is
+        return as_is
+
+
+def snapshot_record(record):
+    # A copy of the record to format later, with its message resolved, so
+    # the arguments may change meanwhile. Attribute values are shared, and
+    # the exception is formatted later from its traceback.
+    snapshot = object.__new__(type(record))
+    snapshot.__dict__.update(record.__dict__)
+    snapshot.msg = record.getMessage()
+    snapshot.args = None
+    return snapshot
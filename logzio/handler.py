@@ -1,12 +1,28 @@
-import datetime
-import json
 import logging
 import logging.handlers
-import sys
+import time
 import traceback
 
+from .dedup import RecordDeduplicator
 from .exceptions import LogzioException
-from .sender import LogzioSender
+from .formatting import (ExtraFieldsProjection, compile_format_plan,
+                         snapshot_record)
+from .sampling import RecordSampler
+from .sender import LogzioSender, MAX_BULK_SIZE_IN_BYTES
+from .spool import DEFAULT_SEGMENT_BYTES
+from .timestamps import TimestampFormatter
+
+
+def add_trace_context():
+    try:
+        from opentelemetry.instrumentation.logging import \
+            LoggingInstrumentor
+        LoggingInstrumentor().instrument(set_logging_format=True)
+    except ImportError:
+        print("""Can't add trace context.
+OpenTelemetry logging optional package isn't installed.
+Please install the following package:
+pip install 'logzio-python-handler[opentelemetry-logging]'""")
 
 
 class ExtraFieldsLogFilter(logging.Filter):
@@ -21,6 +37,12 @@ class ExtraFieldsLogFilter(logging.Filter):
 
 
 class LogzioHandler(logging.Handler):
+    # How the formatter's output is merged into logs, see formatting.py
+    _format_plan = None
+    _plan_formatter = None
+    defer_formatting = False
+    _sampler = None
+    _deduplicator = None
 
     def __init__(self,
                  token,
@@ -32,23 +54,52 @@ class LogzioHandler(logging.Handler):
                  network_timeout=10.0,
                  retries_no=4,
                  retry_timeout=2,
-                 add_context=False):
+                 add_context=False,
+                 max_queue_size=0,
+                 max_queue_bytes=0,
+                 overflow_policy='drop_newest',
+                 overflow_block_timeout=1.0,
+                 compression=None,
+                 compression_level=6,
+                 bulk_size_in_bytes=MAX_BULK_SIZE_IN_BYTES,
+                 linger_ms=None,
+                 shutdown_timeout=10.0,
+                 max_in_flight=1,
+                 spool_directory=None,
+                 spool_segment_bytes=DEFAULT_SEGMENT_BYTES,
+                 spool_fsync_interval=1.0,
+                 replay_backups=False,
+                 replay_directory=None,
+                 replay_bytes_per_second=1024 * 1024,
+                 replay_interval=30,
+                 max_retry_timeout=30,
+                 circuit_breaker_threshold=5,
+                 circuit_breaker_cooldown=30,
+                 json_encoder=None,
+                 allowed_extra_fields=None,
+                 denied_extra_fields=None,
+                 timestamp_precision='millis',
+                 defer_formatting=False,
+                 sampling_rules=None,
+                 sampling_summary_interval=60,
+                 dedup_window=None,
+                 dedup_max_keys=1024,
+                 stats_callback=None,
+                 serverless=False):
 
         if not token:
             raise LogzioException('Logz.io Token must be provided')
 
         self.logzio_type = logzio_type
+        # Records are formatted and encoded by the sending thread
+        self.defer_formatting = defer_formatting
+        self._init_record_pipeline(
+            allowed_extra_fields, denied_extra_fields, timestamp_precision,
+            sampling_rules, sampling_summary_interval, dedup_window,
+            dedup_max_keys)
 
         if add_context:
-            try:
-                from opentelemetry.instrumentation.logging import \
-                    LoggingInstrumentor
-                LoggingInstrumentor().instrument(set_logging_format=True)
-            except ImportError:
-                print("""Can't add trace context.
-OpenTelemetry logging optional package isn't installed.
-Please install the following package:
-pip install 'logzio-python-handler[opentelemetry-logging]'""")
+            add_trace_context()
         self.logzio_sender = LogzioSender(
             token=token,
             url=url,
@@ -57,47 +108,139 @@ pip install 'logzio-python-handler[opentelemetry-logging]'""")
             backup_logs=backup_logs,
             network_timeout=network_timeout,
             number_of_retries=retries_no,
-            retry_timeout=retry_timeout)
+            retry_timeout=retry_timeout,
+            max_queue_size=max_queue_size,
+            max_queue_bytes=max_queue_bytes,
+            overflow_policy=overflow_policy,
+            overflow_block_timeout=overflow_block_timeout,
+            compression=compression,
+            compression_level=compression_level,
+            bulk_size_in_bytes=bulk_size_in_bytes,
+            linger_ms=linger_ms,
+            shutdown_timeout=shutdown_timeout,
+            max_in_flight=max_in_flight,
+            spool_directory=spool_directory,
+            spool_segment_bytes=spool_segment_bytes,
+            spool_fsync_interval=spool_fsync_interval,
+            replay_backups=replay_backups,
+            replay_directory=replay_directory,
+            replay_bytes_per_second=replay_bytes_per_second,
+            replay_interval=replay_interval,
+            max_retry_timeout=max_retry_timeout,
+            circuit_breaker_threshold=circuit_breaker_threshold,
+            circuit_breaker_cooldown=circuit_breaker_cooldown,
+            json_encoder=json_encoder,
+            stats_callback=stats_callback,
+            serverless=serverless)
         logging.Handler.__init__(self)
 
     def __del__(self):
         del self.logzio_sender
 
+    def _init_record_pipeline(self, allowed_extra_fields,
+                              denied_extra_fields, timestamp_precision,
+                              sampling_rules, sampling_summary_interval,
+                              dedup_window, dedup_max_keys):
+        # What records go through before they are queued, shared by the
+        # handlers built on this one
+        self._project_extra_fields = ExtraFieldsProjection(
+            allowed_extra_fields, denied_extra_fields)
+        self._format_timestamp = TimestampFormatter(timestamp_precision)
+        if sampling_rules:
+            self._sampler = RecordSampler(
+                sampling_rules, sampling_summary_interval,
+                self._ship_suppression_summaries)
+        if dedup_window:
+            self._deduplicator = RecordDeduplicator(
+                self._emit_repeat_summary, dedup_window, dedup_max_keys)
+
     def extra_fields(self, message):
+        return self._project_extra_fields(message)
 
-        not_allowed_keys = (
-            'args', 'asctime', 'created', 'exc_info', 'stack_info', 'exc_text',
-            'filename', 'funcName', 'levelname', 'levelno', 'lineno', 'module',
-            'msecs', 'msecs', 'message', 'msg', 'name', 'pathname', 'process',
-            'processName', 'relativeCreated', 'thread', 'threadName')
+    def flush(self, timeout=None):
+        # See LogzioSender.flush()
+        self._ship_pending_summaries()
+        return self.logzio_sender.flush(timeout)
 
-        if sys.version_info < (3, 0):
-            # long and basestring don't exist in py3 so, NOQA
-            var_type = (basestring, bool, dict, float,  # NOQA
-                        int, long, list, type(None))  # NOQA
-        else:
-            var_type = (str, bool, dict, float, int, list, type(None))
+    def flush_async(self, timeout=None):
+        self._ship_pending_summaries()
+        return self.logzio_sender.flush_async(timeout)
+
+    def close(self):
+        self._ship_pending_summaries()
+        self.logzio_sender.shutdown()
+        logging.Handler.close(self)
 
-        extra_fields = {}
+    def filter(self, record):
+        # Sampling runs before the record is formatted, so suppressed
+        # records cost little
+        allowed = logging.Handler.filter(self, record)
+        if not allowed:
+            return allowed
+        if self._sampler is not None:
+            if self._sampler.summary_due():
+                self._ship_suppression_summaries()
+            if not self._sampler.allow(record):
+                return False
+        if (self._deduplicator is not None and
+                not self._deduplicator.admit(record)):
+            return False
+        return allowed
 
-        for key, value in message.__dict__.items():
-            if key not in not_allowed_keys:
-                if isinstance(value, var_type):
-                    extra_fields[key] = value
-                else:
-                    extra_fields[key] = repr(value)
+    def _ship_pending_summaries(self):
+        if self._deduplicator is not None:
+            self._deduplicator.close_all()
+        self._ship_suppression_summaries()
+
+    def _emit_repeat_summary(self, record, first_created, last_created):
+        # The record standing for the repeats of a record, which skips the
+        # filters that held them back
+        record.first_timestamp = self._format_timestamp(first_created)
+        record.last_timestamp = self._format_timestamp(last_created)
+        self.acquire()
+        try:
+            self.emit(record)
+        except Exception:
+            self.handleError(record)
+        finally:
+            self.release()
 
-        return extra_fields
+    def _ship_suppression_summaries(self):
+        if self._sampler is None:
+            return
+        for rule, suppressed in self._sampler.take_summaries():
+            level = logging.getLevelName(rule.max_level)
+            self.logzio_sender.append({
+                'logger': rule.logger or 'root',
+                'log_level': 'INFO',
+                'type': self.logzio_type,
+                'message': '{} records of {} at {} or below were '
+                           'suppressed by sampling'.format(
+                               suppressed, rule.logger or 'all loggers',
+                               level),
+                'suppressed_records': suppressed,
+                '@timestamp': self._format_timestamp(time.time())
+            })
 
-    def flush(self):
-        self.logzio_sender.flush()
+    def setFormatter(self, fmt):
+        logging.Handler.setFormatter(self, fmt)
+        self._get_format_plan()
+
+    def _get_format_plan(self):
+        # Compiled once per formatter, also when it was assigned directly
+        if (self._format_plan is None or
+                self._plan_formatter is not self.formatter):
+            self._format_plan = compile_format_plan(
+                self.formatter, self.logzio_sender.encoder.loads)
+            self._plan_formatter = self.formatter
+        return self._format_plan
 
     def format(self, record):
         message = super(LogzioHandler, self).format(record)
         try:
             if record.exc_info:
                 message = message.split("\n")[0]  # only keep the original formatted message part
-            return json.loads(message)
+            return self.logzio_sender.encoder.loads(message)
         except (TypeError, ValueError):
             return message
 
@@ -105,10 +248,6 @@ pip install 'logzio-python-handler[opentelemetry-logging]'""")
         return '\n'.join(traceback.format_exception(*exc_info))
 
     def format_message(self, message):
-        now = datetime.datetime.now(datetime.timezone.utc)
-        timestamp = now.strftime('%Y-%m-%dT%H:%M:%S') + \
-                    '.%03d' % (now.microsecond / 1000) + 'Z'
-
         return_json = {
             'logger': message.name,
             'line_number': message.lineno,
@@ -116,7 +255,7 @@ pip install 'logzio-python-handler[opentelemetry-logging]'""")
             'log_level': message.levelname,
             'type': self.logzio_type,
             'message': message.getMessage(),
-            '@timestamp': timestamp
+            '@timestamp': self._format_timestamp(message.created)
         }
 
         if message.exc_info:
@@ -124,17 +263,14 @@ pip install 'logzio-python-handler[opentelemetry-logging]'""")
 
         # # We want to ignore default logging formatting on exceptions
         # # As we handle those differently directly into exception field
-
-        formatted_message = self.format(message)
-        # Exception with multiple fields, apply them to log json.
-        if isinstance(formatted_message, dict):
-            return_json.update(formatted_message)
-        # No exception, apply default formatted message
-        elif not message.exc_info:
-            return_json['message'] = formatted_message
+        self._get_format_plan().apply(self, message, return_json)
 
         return_json.update(self.extra_fields(message))
         return return_json
 
     def emit(self, record):
-        self.logzio_sender.append(self.format_message(record))
+        if self.defer_formatting:
+            self.logzio_sender.append_deferred(self.format_message,
+                                               snapshot_record(record))
+        else:
+            self.logzio_sender.append(self.format_message(record))
@@ -0,0 +1,278 @@
+# Bounded, thread safe queue holding the UTF-8 encoded logs waiting to be
+# shipped
+import queue
+import threading
+from collections import deque
+from time import monotonic
+
+from .exceptions import LogzioException
+
+DROP_NEWEST = 'drop_newest'
+DROP_OLDEST = 'drop_oldest'
+BLOCK = 'block'
+SPILL = 'spill'
+OVERFLOW_POLICIES = (DROP_NEWEST, DROP_OLDEST, BLOCK, SPILL)
+
+
+class Bulk(list):
+    # Logs taken off the queue together, remembering when the oldest of
+    # them was queued (monotonic time), and its sequence number
+    enqueued_at = None
+    first_sequence = None
+
+
+# Limits of 0 mean unbounded. When a new log does not fit, the overflow
+# policy decides its fate: drop_newest drops it, drop_oldest drops the oldest
+# logs to make room, block waits up to block_timeout seconds for room, and
+# spill hands it to spill_function instead of holding it in memory.
+# Every log that doesn't make it into the queue is counted in `dropped`.
+class LogsQueue(queue.Queue):
+    # Size of the last log that didn't fit, the queue stays at its limits
+    # while such a log still doesn't
+    _overflow_size = 0
+
+    def __init__(self, max_size=0, max_bytes=0,
+                 overflow_policy=DROP_NEWEST, block_timeout=1.0,
+                 spill_function=None, bulk_size=0):
+        if overflow_policy not in OVERFLOW_POLICIES:
+            raise LogzioException(
+                'Unknown overflow policy {}, expected one of {}'.format(
+                    overflow_policy, ', '.join(OVERFLOW_POLICIES)))
+        if overflow_policy == SPILL and spill_function is None:
+            raise LogzioException(
+                'The spill overflow policy requires a spill function')
+
+        self.max_bytes = max_bytes
+        self.overflow_policy = overflow_policy
+        self.block_timeout = block_timeout
+        self.spill_function = spill_function
+        self.bulk_size = bulk_size
+        self.dropped = 0
+        self.spilled = 0
+        # Logs let into the queue so far
+        self.enqueued = 0
+        # Logs taken off the queue so far, the next one taken is number
+        # taken + 1 in the order logs are queued
+        self.taken = 0
+        queue.Queue.__init__(self, maxsize=max_size)
+
+    # The underscore methods below are queue.Queue's storage hooks, they
+    # are always called with self.mutex held.
+    def _init(self, maxsize):
+        self.queue = deque()
+        self._sizes = deque()
+        self._enqueue_times = deque()
+        self.bytes = 0
+        self._woken = False
+
+    def _put(self, item):
+        size = len(item)
+        self.queue.append(item)
+        self._sizes.append(size)
+        self._enqueue_times.append(monotonic())
+        self.bytes += size
+
+    def _get(self):
+        self.bytes -= self._sizes.popleft()
+        self._enqueue_times.popleft()
+        self.taken += 1
+        return self.queue.popleft()
+
+    def _bulk_queued(self):
+        # A full bulk, by the size of the queued logs once joined by
+        # newlines, or the queue at its limits, so the logs that don't fit
+        # don't wait for the linger time to be let in
+        if 0 < self.bulk_size <= self.bytes + self._qsize() - 1:
+            return True
+        return self._is_full(self._overflow_size)
+
+    def _time_to_bulk(self, linger):
+        # Seconds until there is a bulk worth sending: right away once a
+        # full bulk is queued or the oldest log waited for linger seconds,
+        # never (None) while the queue is empty
+        if not self._qsize():
+            return None
+        if self._bulk_queued():
+            return 0
+        return max(0, self._oldest_enqueue_time() + linger - monotonic())
+
+    def _oldest_enqueue_time(self):
+        return self._enqueue_times[0]
+
+    def _is_full(self, size):
+        if 0 < self.maxsize <= self._qsize():
+            return True
+        # A single log bigger than max_bytes is still let into an empty
+        # queue, otherwise it could never be shipped.
+        return 0 < self.max_bytes < self.bytes + size and self._qsize() > 0
+
+    def _drop_oldest(self):
+        self._get()
+        self.dropped += 1
+        self.unfinished_tasks -= 1
+        if self.unfinished_tasks == 0:
+            self.all_tasks_done.notify_all()
+
+    def last_sequence(self):
+        # Sequence number of the newest queued log
+        with self.mutex:
+            return self.taken + self._qsize()
+
+    def oldest_log_age(self):
+        # Seconds the oldest queued log has been waiting, 0 if none is
+        with self.mutex:
+            if not self._qsize():
+                return 0
+            return monotonic() - self._oldest_enqueue_time()
+
+    def time_to_bulk(self, linger):
+        with self.mutex:
+            return self._time_to_bulk(linger)
+
+    def bulk_ready(self, linger):
+        return self.time_to_bulk(linger) == 0
+
+    def wait_for_bulk(self, linger, timeout=None):
+        # Sleeps until there is a bulk worth sending, wake() is called or
+        # timeout passes. Returns False on timeout.
+        deadline = None if timeout is None else monotonic() + timeout
+        with self.not_empty:
+            while not self._woken:
+                wait = self._time_to_bulk(linger)
+                if wait == 0:
+                    return True
+                if deadline is not None:
+                    remaining = deadline - monotonic()
+                    if remaining <= 0:
+                        return False
+                    wait = remaining if wait is None else min(wait, remaining)
+                self.not_empty.wait(wait)
+            self._woken = False
+            return True
+
+    def wait_for_wake(self, timeout=None):
+        # Sleeps until wake() is called or timeout passes, whatever is
+        # queued. Returns False on timeout.
+        deadline = None if timeout is None else monotonic() + timeout
+        with self.not_empty:
+            while not self._woken:
+                remaining = None
+                if deadline is not None:
+                    remaining = deadline - monotonic()
+                    if remaining <= 0:
+                        return False
+                self.not_empty.wait(remaining)
+            self._woken = False
+            return True
+
+    def wake(self):
+        with self.not_empty:
+            self._woken = True
+            self.not_empty.notify_all()
+
+    def get_bulk(self, max_bytes=None):
+        # Pops the oldest logs whose newline separated size fits in
+        # max_bytes (bulk_size by default), and at least one log even if
+        # it's bigger than that
+        max_bytes = max_bytes or self.bulk_size
+        bulk = Bulk()
+        with self.not_empty:
+            if self._qsize():
+                bulk.enqueued_at = self._oldest_enqueue_time()
+            bulk.first_sequence = self.taken + 1
+            bulk_size = -1
+            while self._qsize():
+                size = self._sizes[0] + 1
+                if bulk and bulk_size + size > max_bytes:
+                    break
+                bulk.append(self._get())
+                bulk_size += size
+            if bulk:
+                self.not_full.notify_all()
+        return bulk
+
+    def reset_after_fork(self):
+        # Called in a forked child. The queued logs are left to the parent,
+        # and the lock may have been held by one of its threads.
+        self.mutex = threading.Lock()
+        self.not_empty = threading.Condition(self.mutex)
+        self.not_full = threading.Condition(self.mutex)
+        self.all_tasks_done = threading.Condition(self.mutex)
+        self.unfinished_tasks = 0
+        self.dropped = 0
+        self.spilled = 0
+        self.enqueued = 0
+        self.taken = 0
+        self._forget_queued()
+
+    def _forget_queued(self):
+        self._init(self.maxsize)
+
+    def ack(self, bulk):
+        # Called once a bulk from get_bulk() was shipped, or given up on.
+        # Logs held in memory are gone as soon as they are taken off the
+        # queue, so there is nothing to release.
+        pass
+
+    def close(self):
+        pass
+
+    def time_to_sync(self):
+        # Seconds until queued logs are due to be synced to disk, None if
+        # none are waiting for it. Logs held in memory never are.
+        return None
+
+    def sync_if_due(self):
+        pass
+
+    def put(self, item, block=True, timeout=None):
+        # timeout is only here for queue.Queue compatibility, the overflow
+        # policy decides what happens when the queue is full. With
+        # block=False, the block policy lets the log in over the limits
+        # rather than wait, for logs put by the thread that makes room.
+        size = len(item)
+        over_limits = False
+        with self.not_full:
+            if self._is_full(size):
+                was_bulk_queued = self._bulk_queued()
+                self._overflow_size = size
+                if not was_bulk_queued:
+                    self.not_empty.notify_all()
+                if self.overflow_policy == DROP_NEWEST:
+                    self.dropped += 1
+                    return False
+                if self.overflow_policy == DROP_OLDEST:
+                    while self._qsize() and self._is_full(size):
+                        self._drop_oldest()
+                elif self.overflow_policy == BLOCK and not block:
+                    over_limits = True
+                elif self.overflow_policy == BLOCK:
+                    deadline = monotonic() + self.block_timeout
+                    while self._is_full(size):
+                        remaining = deadline - monotonic()
+                        if remaining <= 0:
+                            self.dropped += 1
+                            return False
+                        self.not_full.wait(remaining)
+
+            if over_limits or not self._is_full(size):
+                was_bulk_queued = self._bulk_queued()
+                self._put(item)
+                self.unfinished_tasks += 1
+                self.enqueued += 1
+                # Only wake the consumer when its wait time changes: when
+                # the first log starts lingering, or a full bulk is queued
+                # or the queue reaches its limits.
+                # notify_all, since a forked child inherits the waiters of
+                # the parent's threads, which would swallow a notify().
+                if self._qsize() == 1 or (
+                        self._bulk_queued() and not was_bulk_queued):
+                    self.not_empty.notify_all()
+                return True
+
+            self.dropped += 1
+            self.spilled += 1
+
+        # Only the spill policy gets here, disk I/O happens outside the lock
+        self.spill_function([item])
+        return False
@@ -0,0 +1,304 @@
+# A relay daemon shipping the logs of every process on a host through one
+# LogzioSender, and the handler processes send their logs to it with.
+#
+# Run the daemon with:
+#   LOGZIO_TOKEN=<token> python -m logzio.relay [--socket PATH] [--url URL]
+import argparse
+import logging
+import os
+import signal
+import socket
+import socketserver
+import threading
+from concurrent import futures
+from time import monotonic, sleep
+
+from .encoder import get_encoder
+from .exceptions import LogzioException
+from .handler import LogzioHandler, add_trace_context
+from .logger import get_stdout_logger
+from .sender import LogzioSender, MAX_BULK_SIZE_IN_BYTES
+
+DEFAULT_SOCKET_PATH = '/tmp/logzio-relay.sock'
+# Longer lines are dropped by the relay, Logz.io drops logs over 500 KB
+MAX_LOG_BYTES = 512 * 1024
+READ_SIZE = 64 * 1024
+# Seconds between checks whether the relay stopped, while clients are quiet
+READ_TIMEOUT = 0.2
+# How long a stopping relay keeps reading from clients that don't pause
+STOP_READ_TIMEOUT = 2
+
+
+class _RelayRequestHandler(socketserver.BaseRequestHandler):
+    # Reads the logs of one client, a JSON line each
+
+    def handle(self):
+        server = self.server
+        server.connections.add(self.request)
+        self.request.settimeout(READ_TIMEOUT)
+        buffer = b''
+        # Whether the rest of a line that was too long is being skipped
+        skipping = False
+        try:
+            while True:
+                try:
+                    chunk = self.request.recv(READ_SIZE)
+                except socket.timeout:
+                    # Once stopped, the relay reads until clients pause
+                    if server.stopping:
+                        break
+                    continue
+                if not chunk:
+                    # A line cut short by the client going away is dropped
+                    break
+                lines = (buffer + chunk).split(b'\n')
+                buffer = lines.pop()
+                for line in lines:
+                    if skipping:
+                        skipping = False
+                        continue
+                    log = line.rstrip(b'\r')
+                    if len(log) > server.max_log_bytes:
+                        server.dropped += 1
+                    elif log:
+                        server.sender.append_encoded(log)
+                if len(buffer) > server.max_log_bytes:
+                    if not skipping:
+                        server.dropped += 1
+                    skipping = True
+                    buffer = b''
+        finally:
+            server.connections.discard(self.request)
+
+
+# Accepts clients on a Unix domain socket at socket_path, and appends the
+# JSON lines they write to sender, which ships the logs of all of them in
+# the same bulks. A socket file left behind by a relay that is gone is
+# replaced.
+class RelayServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    daemon_threads = True
+
+    def __init__(self, sender, socket_path=DEFAULT_SOCKET_PATH,
+                 socket_mode=0o600, max_log_bytes=MAX_LOG_BYTES):
+        self.sender = sender
+        self.max_log_bytes = max_log_bytes
+        self.connections = set()
+        self.dropped = 0
+        self.stopping = False
+        _remove_stale_socket(socket_path)
+        socketserver.UnixStreamServer.__init__(self, socket_path,
+                                               _RelayRequestHandler)
+        os.chmod(socket_path, socket_mode)
+
+    def stop(self, timeout=None):
+        # Called from another thread than serve_forever(), or once it
+        # returned. Stops accepting clients, reads what the connected ones
+        # wrote so far, and ships it. Returns True if everything was
+        # shipped in time, like LogzioSender.shutdown().
+        self.stopping = True
+        self.shutdown()
+        # Clients that connected but weren't accepted yet
+        self.socket.setblocking(False)
+        while True:
+            try:
+                request, client_address = self.get_request()
+            except OSError:
+                break
+            self.process_request(request, client_address)
+        self.server_close()
+        try:
+            os.remove(self.server_address)
+        except FileNotFoundError:
+            pass
+        deadline = monotonic() + STOP_READ_TIMEOUT
+        while self.connections and monotonic() < deadline:
+            sleep(READ_TIMEOUT / 10)
+        return self.sender.shutdown(timeout)
+
+
+def _remove_stale_socket(socket_path):
+    if not os.path.exists(socket_path):
+        return
+    probe = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        probe.connect(socket_path)
+    except OSError:
+        os.remove(socket_path)
+        return
+    finally:
+        probe.close()
+    raise LogzioException(
+        'A relay is already listening on {}'.format(socket_path))
+
+
+class RelaySender:
+    # Takes the place of LogzioSender in processes logging through a relay:
+    # logs are written to the relay's socket, a JSON line each. While the
+    # relay can't be reached, logs are dropped and counted in dropped_logs,
+    # and connecting is tried again every reconnect_interval seconds.
+
+    def __init__(self, socket_path=DEFAULT_SOCKET_PATH, debug=False,
+                 network_timeout=1.0, reconnect_interval=1.0,
+                 json_encoder=None):
+        self.socket_path = socket_path
+        self.stdout_logger = get_stdout_logger(debug)
+        self.network_timeout = network_timeout
+        self.reconnect_interval = reconnect_interval
+        self.encoder = get_encoder(json_encoder)
+        self.dropped_logs = 0
+        self._reset()
+
+    def _reset(self):
+        # Also called in a forked child, whose socket is the parent's
+        self._pid = os.getpid()
+        self._lock = threading.Lock()
+        self._socket = None
+        self._next_connect = 0
+
+    def append(self, logs_message):
+        data = self.encoder.dumps(logs_message) + b'\n'
+        if self._pid != os.getpid():
+            self._reset()
+        with self._lock:
+            if self._socket is None and not self._connect():
+                self.dropped_logs += 1
+                return
+            try:
+                self._socket.sendall(data)
+            except OSError as e:
+                # The relay drops a line cut short by the socket closing
+                self.stdout_logger.debug(
+                    'Could not write to the Logz.io relay at %s, dropping '
+                    'the log. Exception: %s', self.socket_path, e)
+                self._close()
+                self.dropped_logs += 1
+
+    def _connect(self):
+        if monotonic() < self._next_connect:
+            return False
+        relay_socket = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        relay_socket.settimeout(self.network_timeout)
+        try:
+            relay_socket.connect(self.socket_path)
+        except OSError as e:
+            relay_socket.close()
+            self._next_connect = monotonic() + self.reconnect_interval
+            self.stdout_logger.debug(
+                'Could not connect to the Logz.io relay at %s. '
+                'Exception: %s', self.socket_path, e)
+            return False
+        self._socket = relay_socket
+        return True
+
+    def _close(self):
+        if self._socket is not None:
+            self._socket.close()
+            self._socket = None
+        self._next_connect = monotonic() + self.reconnect_interval
+
+    def flush(self, timeout=None):
+        # Logs are handed to the relay as they are appended
+        return True
+
+    def flush_async(self, timeout=None):
+        future = futures.Future()
+        future.set_result(True)
+        return future
+
+    def shutdown(self, timeout=None):
+        with self._lock:
+            if self._socket is not None:
+                self._socket.close()
+                self._socket = None
+        return True
+
+
+class LogzioRelayHandler(LogzioHandler):
+    # Formats records like LogzioHandler, and writes them to a relay
+    # started with `python -m logzio.relay`, which holds the token
+
+    def __init__(self,
+                 socket_path=DEFAULT_SOCKET_PATH,
+                 logzio_type="python",
+                 debug=False,
+                 network_timeout=1.0,
+                 add_context=False,
+                 json_encoder=None,
+                 allowed_extra_fields=None,
+                 denied_extra_fields=None,
+                 timestamp_precision='millis',
+                 sampling_rules=None,
+                 sampling_summary_interval=60,
+                 dedup_window=None,
+                 dedup_max_keys=1024):
+        self.logzio_type = logzio_type
+        self._init_record_pipeline(
+            allowed_extra_fields, denied_extra_fields, timestamp_precision,
+            sampling_rules, sampling_summary_interval, dedup_window,
+            dedup_max_keys)
+
+        if add_context:
+            add_trace_context()
+        self.logzio_sender = RelaySender(
+            socket_path=socket_path,
+            debug=debug,
+            network_timeout=network_timeout,
+            json_encoder=json_encoder)
+        logging.Handler.__init__(self)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        prog='python -m logzio.relay',
+        description='Ships the logs LogzioRelayHandler writes to a Unix '
+                    'domain socket, from every process on the host, to '
+                    'Logz.io in shared bulks.')
+    parser.add_argument('--socket', default=DEFAULT_SOCKET_PATH,
+                        help='Path of the socket, default %(default)s')
+    parser.add_argument('--socket-mode', type=lambda mode: int(mode, 8),
+                        default=0o600,
+                        help='Permissions of the socket, default 600')
+    parser.add_argument('--token', default=os.environ.get('LOGZIO_TOKEN'),
+                        help='Logz.io token, default $LOGZIO_TOKEN')
+    parser.add_argument('--url', default='https://listener.logz.io:8071')
+    parser.add_argument('--compression', choices=('gzip',))
+    parser.add_argument('--bulk-size', type=int,
+                        default=MAX_BULK_SIZE_IN_BYTES,
+                        help='Bytes per bulk, default %(default)s')
+    parser.add_argument('--linger-ms', type=int, default=1000,
+                        help='How long a log may wait for its bulk to fill '
+                             'up, default %(default)s')
+    parser.add_argument('--max-queue-bytes', type=int, default=0)
+    parser.add_argument('--max-in-flight', type=int, default=1)
+    parser.add_argument('--spool-directory',
+                        help='Keep queued logs on disk, in this directory')
+    parser.add_argument('--debug', action='store_true')
+    args = parser.parse_args(argv)
+    if not args.token:
+        parser.error('--token or $LOGZIO_TOKEN is required')
+
+    sender = LogzioSender(
+        token=args.token,
+        url=args.url,
+        debug=args.debug,
+        compression=args.compression,
+        bulk_size_in_bytes=args.bulk_size,
+        linger_ms=args.linger_ms,
+        max_queue_bytes=args.max_queue_bytes,
+        max_in_flight=args.max_in_flight,
+        spool_directory=args.spool_directory)
+    server = RelayServer(sender, args.socket, socket_mode=args.socket_mode)
+
+    def stop(signum, frame):
+        # shutdown() waits for serve_forever() to return, in this thread
+        threading.Thread(target=server.shutdown).start()
+
+    signal.signal(signal.SIGTERM, stop)
+    signal.signal(signal.SIGINT, stop)
+    sender.stdout_logger.info('Relaying logs from %s', args.socket)
+    server.serve_forever()
+    return 0 if server.stop() else 1
+
+
+if __name__ == '__main__':
+    raise SystemExit(main())
@@ -0,0 +1,189 @@
+# Ships the logzio-failures-*.txt backups again, from a thread of its own,
+# once Logz.io can be reached
+import os
+import threading
+from time import monotonic, time
+
+from .spool import _pid_alive
+
+BACKUP_PREFIX = 'logzio-failures-'
+BACKUP_SUFFIX = '.txt'
+REPLAY_SUFFIX = '.replay'
+OFFSET_SUFFIX = '.offset'
+# Backups modified more recently may still be written to
+MIN_BACKUP_AGE = 2
+
+# Backups replayed by this process, so that two replayers on the same
+# directory don't ship them twice
+_claimed_backups = set()
+_claim_lock = threading.Lock()
+
+
+def _reset_claim_lock():
+    # Held by the parent's replay thread, if it was claiming backups when
+    # the process forked
+    global _claim_lock
+    _claim_lock = threading.Lock()
+
+
+if hasattr(os, 'register_at_fork'):
+    os.register_at_fork(after_in_child=_reset_claim_lock)
+
+
+# A backup is claimed by renaming it to <backup>.<pid>.replay, and shipped
+# in bulks of up to bulk_size bytes, at most bytes_per_second. The offset
+# shipped so far is kept in a .offset file next to it, and the backup is
+# deleted once it was shipped entirely. Backups claimed by processes that
+# are gone are resumed from their offset.
+#
+# send_function gets a list of logs and returns True once they were sent or
+# dropped by Logz.io, or False if they should be tried again later. The
+# replay then stops until the next pass, interval seconds later.
+class BackupReplayer:
+
+    def __init__(self, send_function, logger, directory=None,
+                 bulk_size=1024 * 1024, bytes_per_second=1024 * 1024,
+                 interval=30):
+        self.send_function = send_function
+        self.logger = logger
+        self.directory = directory or os.getcwd()
+        self.bulk_size = bulk_size
+        self.bytes_per_second = bytes_per_second
+        self.interval = interval
+        self._stopped = threading.Event()
+        self.thread = threading.Thread(target=self._run)
+        self.thread.daemon = True
+        self.thread.name = 'logzio-replay-thread'
+
+    def start(self):
+        self.thread.start()
+
+    def stop(self, timeout=None):
+        self._stopped.set()
+        if self.thread.is_alive():
+            self.thread.join(timeout)
+
+    def _run(self):
+        while not self._stopped.is_set():
+            try:
+                self.replay_backups()
+            except Exception as e:
+                self.logger.debug(
+                    'Unexpected exception while replaying backups to '
+                    'Logz.io, swallowing. Exception: %s', e)
+            self._stopped.wait(self.interval)
+
+    def replay_backups(self):
+        # One pass over the directory. Returns False if Logz.io couldn't be
+        # reached, or the replayer was stopped.
+        for path in self._claim_backups():
+            try:
+                if not self._replay(path):
+                    return False
+            finally:
+                with _claim_lock:
+                    _claimed_backups.discard(path)
+        return True
+
+    def _claim_backups(self):
+        pid = os.getpid()
+        claimed = []
+        with _claim_lock:
+            for name in os.listdir(self.directory):
+                if not name.startswith(BACKUP_PREFIX):
+                    continue
+                path = os.path.join(self.directory, name)
+                if name.endswith(BACKUP_SUFFIX):
+                    backup = name
+                elif name.endswith(REPLAY_SUFFIX):
+                    backup, owner = name[:-len(REPLAY_SUFFIX)].rsplit('.', 1)
+                    if not owner.isdigit() or (
+                            int(owner) != pid and _pid_alive(int(owner))):
+                        continue
+                else:
+                    continue
+
+                claimed_path = os.path.join(
+                    self.directory,
+                    '{}.{}{}'.format(backup, pid, REPLAY_SUFFIX))
+                if claimed_path in _claimed_backups:
+                    continue
+                try:
+                    if name.endswith(BACKUP_SUFFIX):
+                        if os.path.getmtime(path) > time() - MIN_BACKUP_AGE:
+                            continue
+                        if os.path.exists(claimed_path):
+                            # The name of an older backup that is still
+                            # being replayed, try again on the next pass
+                            continue
+                    if claimed_path != path:
+                        os.rename(path, claimed_path)
+                except OSError:
+                    # Claimed by another process in the meantime
+                    continue
+                if claimed_path != path:
+                    try:
+                        os.rename(path + OFFSET_SUFFIX,
+                                  claimed_path + OFFSET_SUFFIX)
+                    except FileNotFoundError:
+                        pass
+                _claimed_backups.add(claimed_path)
+                claimed.append(claimed_path)
+
+        return sorted(claimed, key=os.path.getmtime)
+
+    def _replay(self, path):
+        offset = self._read_offset(path)
+        with open(path, 'rb') as f:
+            f.seek(offset)
+            while True:
+                if self._stopped.is_set():
+                    return False
+                logs_list, end = self._read_bulk(f)
+                if not logs_list:
+                    break
+                started = monotonic()
+                if not self.send_function(logs_list):
+                    return False
+                offset = end
+                with open(path + OFFSET_SUFFIX, 'w') as offset_file:
+                    offset_file.write(str(offset))
+
+                # Rate limit, by the bytes shipped
+                bulk_bytes = len(logs_list) + sum(map(len, logs_list))
+                pause = (bulk_bytes / self.bytes_per_second -
+                         (monotonic() - started))
+                if pause > 0:
+                    self._stopped.wait(pause)
+
+        self.logger.info('Replayed %s to Logz.io', path)
+        for done_path in (path, path + OFFSET_SUFFIX):
+            try:
+                os.remove(done_path)
+            except FileNotFoundError:
+                pass
+        return True
+
+    def _read_offset(self, path):
+        try:
+            with open(path + OFFSET_SUFFIX) as f:
+                return int(f.read())
+        except (OSError, ValueError):
+            return 0
+
+    def _read_bulk(self, f):
+        # Reads logs up to bulk_size bytes, and at least one. Returns them
+        # and the offset right after them.
+        logs_list = []
+        bulk_size = -1
+        end = f.tell()
+        for line in iter(f.readline, b''):
+            log = line.rstrip(b'\r\n')
+            if log:
+                if logs_list and bulk_size + len(log) + 1 > self.bulk_size:
+                    break
+                logs_list.append(log)
+                bulk_size += len(log) + 1
+            end = f.tell()
+        f.seek(end)
+        return logs_list, end
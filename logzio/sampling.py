@@ -0,0 +1,186 @@
+# Samples and rate limits records by logger and level, before they are
+# formatted
+import logging
+import os
+import random
+import threading
+import weakref
+from time import monotonic
+
+from .exceptions import LogzioException
+
+# (logger name, level) pairs whose rule is remembered by a RecordSampler
+MAX_CACHED_ENTRIES = 256
+_NO_RULE = object()
+# Samplers in use, reset in forked children
+_live_samplers = weakref.WeakSet()
+
+
+def _reset_samplers_after_fork():
+    for sampler in list(_live_samplers):
+        sampler._reset_after_fork()
+
+
+if hasattr(os, 'register_at_fork'):
+    os.register_at_fork(after_in_child=_reset_samplers_after_fork)
+
+
+def _level_number(level):
+    if isinstance(level, int):
+        return level
+    number = logging.getLevelName(str(level).upper())
+    if not isinstance(number, int):
+        raise LogzioException('Unknown logging level {}'.format(level))
+    return number
+
+
+# Applies to records of logger and its children, at max_level or below, so
+# e.g. errors can be kept while info logs are sampled. Records are kept
+# with probability sample_rate, and then at most max_per_second of them,
+# with bursts of up to burst records (max_per_second by default, and at
+# least 1, so rates below one per second let records through).
+class SamplingRule:
+
+    def __init__(self, logger='', max_level=logging.CRITICAL,
+                 sample_rate=1.0, max_per_second=None, burst=None):
+        if not 0 <= sample_rate <= 1:
+            raise LogzioException(
+                'sample_rate must be between 0 and 1, got {}'.format(
+                    sample_rate))
+        if max_per_second is not None and max_per_second <= 0:
+            raise LogzioException(
+                'max_per_second must be positive, got {}'.format(
+                    max_per_second))
+        if burst is not None and burst < 1:
+            raise LogzioException(
+                'burst must be at least 1, got {}'.format(burst))
+        if burst is None and max_per_second is not None:
+            burst = max(1, max_per_second)
+        self.logger = logger
+        self.max_level = _level_number(max_level)
+        self.sample_rate = sample_rate
+        self.max_per_second = max_per_second
+        self.burst = burst
+        self.suppressed = 0
+        self._tokens = self.burst
+        self._last_refill = monotonic()
+        self._lock = threading.Lock()
+
+    def matches(self, logger_name, levelno):
+        if levelno > self.max_level:
+            return False
+        return (not self.logger or logger_name == self.logger or
+                logger_name.startswith(self.logger + '.'))
+
+    def allow(self):
+        if self.sample_rate < 1 and random.random() >= self.sample_rate:
+            self._suppress()
+            return False
+        if self.max_per_second is None:
+            return True
+        with self._lock:
+            now = monotonic()
+            self._tokens = min(
+                self.burst,
+                self._tokens + (now - self._last_refill) *
+                self.max_per_second)
+            self._last_refill = now
+            if self._tokens >= 1:
+                self._tokens -= 1
+                return True
+            self.suppressed += 1
+            return False
+
+    def _suppress(self):
+        with self._lock:
+            self.suppressed += 1
+
+    def take_suppressed(self):
+        with self._lock:
+            suppressed, self.suppressed = self.suppressed, 0
+            return suppressed
+
+    def _reset_after_fork(self):
+        # The records suppressed so far are reported by the parent
+        self._lock = threading.Lock()
+        self.suppressed = 0
+
+
+# Picks the first of rules matching a record, SamplingRule instances or
+# dicts of their arguments, as from logging.config.dictConfig. Records no
+# rule matches are all kept.
+#
+# Once a record is suppressed, summary_function is called when the
+# summary is due, from a timer, so it's shipped even if no more records
+# come in.
+class RecordSampler:
+
+    def __init__(self, rules, summary_interval=60, summary_function=None):
+        self.rules = [rule if isinstance(rule, SamplingRule)
+                      else SamplingRule(**rule) for rule in rules]
+        self.summary_interval = summary_interval
+        self.summary_function = summary_function
+        self._next_summary = monotonic() + summary_interval
+        self._rules_by_record = {}
+        self._timer = None
+        self._timer_lock = threading.Lock()
+        _live_samplers.add(self)
+
+    def _reset_after_fork(self):
+        # The timer's thread is gone, and its lock may have been held by
+        # one of the parent's threads
+        self._timer = None
+        self._timer_lock = threading.Lock()
+        for rule in self.rules:
+            rule._reset_after_fork()
+
+    def allow(self, record):
+        key = (record.name, record.levelno)
+        rule = self._rules_by_record.get(key, _NO_RULE)
+        if rule is _NO_RULE:
+            rule = self._find_rule(key)
+        if rule is None or rule.allow():
+            return True
+        if self.summary_function is not None and self._timer is None:
+            self._start_timer()
+        return False
+
+    def _start_timer(self):
+        with self._timer_lock:
+            if self._timer is not None:
+                return
+            self._timer = threading.Timer(
+                max(0, self._next_summary - monotonic()), self._on_timer)
+            self._timer.daemon = True
+            self._timer.start()
+
+    def _on_timer(self):
+        with self._timer_lock:
+            self._timer = None
+        self.summary_function()
+
+    def _find_rule(self, key):
+        rule = next((rule for rule in self.rules if rule.matches(*key)),
+                    None)
+        if len(self._rules_by_record) >= MAX_CACHED_ENTRIES:
+            self._rules_by_record.clear()
+        self._rules_by_record[key] = rule
+        return rule
+
+    def summary_due(self):
+        return monotonic() >= self._next_summary
+
+    def take_summaries(self):
+        # [(rule, records it suppressed)] since the last summaries. The
+        # timer is started again by the next suppressed record.
+        with self._timer_lock:
+            if self._timer is not None:
+                self._timer.cancel()
+                self._timer = None
+        self._next_summary = monotonic() + self.summary_interval
+        summaries = []
+        for rule in self.rules:
+            suppressed = rule.take_suppressed()
+            if suppressed:
+                summaries.append((rule, suppressed))
+        return summaries
@@ -1,32 +1,146 @@
 # This class is responsible for handling all asynchronous Logz.io's
 # communication
+import atexit
+import heapq
+import itertools
 import json
-import sys
-from datetime import datetime
+import os
+import random
+import weakref
+import zlib
+from concurrent import futures
+from datetime import datetime, timezone
+from email.utils import parsedate_to_datetime
 from importlib.metadata import version
-from threading import Thread, Lock, enumerate
-from time import sleep
+from threading import BoundedSemaphore, Thread, Lock
+from time import monotonic, sleep
 
 import requests
 
+from .exceptions import LogzioException
 from .logger import get_stdout_logger
+from .encoder import get_encoder
+from .logs_queue import LogsQueue, DROP_NEWEST
+from .replay import BackupReplayer
+from .spool import SpoolQueue, DEFAULT_SEGMENT_BYTES
+from .stats import SenderStats, ACK, BACKUP, CIRCUIT_OPEN, REQUEST
 
-if sys.version[0] == '2':
-    import Queue as queue
-else:
-    import queue as queue
 PACKAGE_NAME = "logzio-python-handler"
 PACKAGE_VERSION = version(PACKAGE_NAME)
 SHIPPER_HEADER = {"user-agent": f"{PACKAGE_NAME}-version-{PACKAGE_VERSION}-logs"}
 MAX_BULK_SIZE_IN_BYTES = 1 * 1024 * 1024  # 1 MB
+GZIP = 'gzip'
+GZIP_WBITS = 16 + zlib.MAX_WBITS  # zlib writes a gzip header and trailer
+# Logs appended with append_deferred() that may wait for the sending thread,
+# unless max_queue_size is set
+MAX_DEFERRED_LOGS = 10000
+
+# Senders still running, shut down when the interpreter exits
+_live_senders = weakref.WeakSet()
+
+
+def _shutdown_live_senders():
+    for sender in list(_live_senders):
+        sender.shutdown()
+
+
+atexit.register(_shutdown_live_senders)
+
+
+def _reset_senders_after_fork():
+    for sender in list(_live_senders):
+        sender._reset_after_fork()
+
+
+if hasattr(os, 'register_at_fork'):
+    os.register_at_fork(after_in_child=_reset_senders_after_fork)
+
+
+# Outcomes of a bulk request
+SENT = 'sent'
+DROPPED = 'dropped'
+RETRY = 'retry'
+
+
+def prepare_bulk(logs_list, compression=None, compression_level=6):
+    # Returns the request headers, the request body and its size before
+    # compression
+    headers = {"Content-type": "text/plain", **SHIPPER_HEADER}
+    data = b'\n'.join(logs_list)
+    if not compression:
+        return headers, data, len(data)
+
+    headers["Content-Encoding"] = compression
+    return (headers, zlib.compress(data, compression_level, GZIP_WBITS),
+            len(data))
+
+
+def check_response(status_code, text, logs_count, current_try,
+                   number_of_retries, logger):
+    if status_code == 200:
+        logger.debug(
+            'Successfully sent bulk of %s logs to Logz.io!', logs_count)
+        return SENT
+
+    if status_code == 400:
+        logger.info(
+            'Got 400 code from Logz.io. This means that some of your logs '
+            'are too big, or badly formatted. response: %s', text)
+        return DROPPED
+
+    if status_code == 401:
+        logger.info(
+            'You are not authorized with Logz.io! Token OK? dropping logs...')
+        return DROPPED
+
+    logger.info(
+        'Got %s while sending logs to Logz.io, Try (%s/%s). Response: %s',
+        status_code, current_try + 1, number_of_retries, text)
+    return RETRY
+
+
+def rejected_lines(text, logs_count):
+    # Logs of a bulk a 400 rejected, Logz.io takes in the others and says
+    # how many of each it found
+    try:
+        body = json.loads(text)
+        rejected = sum(body.get(field, 0) for field in (
+            'malformedLines', 'oversizedLines', 'emptyLogLines'))
+    except (AttributeError, TypeError, ValueError):
+        return logs_count
+    return min(logs_count, rejected)
+
+
+def retry_after(response):
+    # Seconds to wait before trying again, if the listener said so
+    value = response.headers.get('Retry-After')
+    if response.status_code not in (429, 503) or value is None:
+        return None
+    try:
+        return max(0, float(value))
+    except ValueError:
+        pass
+    try:
+        retry_time = parsedate_to_datetime(value)
+        return max(0, (retry_time - datetime.now(timezone.utc))
+                   .total_seconds())
+    except (TypeError, ValueError):
+        return None
 
 
 def backup_logs(logs, logger):
     timestamp = datetime.now().strftime('%d%m%Y-%H%M%S')
     logger.info(
         'Backing up your logs to logzio-failures-%s.txt', timestamp)
-    with open('logzio-failures-{}.txt'.format(timestamp), 'a') as f:
-        f.writelines('\n'.join(logs))
+    _write_backup_file(logs, timestamp)
+
+
+def _write_backup_file(logs, timestamp=None):
+    timestamp = timestamp or datetime.now().strftime('%d%m%Y-%H%M%S')
+    # One log per line, so backups written in the same second can share
+    # a file
+    with open('logzio-failures-{}.txt'.format(timestamp), 'ab') as f:
+        f.writelines(log + b'\n' for log in logs)
 
 
 class LogzioSender:
@@ -37,154 +151,786 @@ class LogzioSender:
                  backup_logs=True,
                  network_timeout=10.0,
                  number_of_retries=4,
-                 retry_timeout=2):
+                 retry_timeout=2,
+                 max_queue_size=0,
+                 max_queue_bytes=0,
+                 overflow_policy=DROP_NEWEST,
+                 overflow_block_timeout=1.0,
+                 compression=None,
+                 compression_level=6,
+                 bulk_size_in_bytes=MAX_BULK_SIZE_IN_BYTES,
+                 linger_ms=None,
+                 shutdown_timeout=10.0,
+                 max_in_flight=1,
+                 spool_directory=None,
+                 spool_segment_bytes=DEFAULT_SEGMENT_BYTES,
+                 spool_fsync_interval=1.0,
+                 replay_backups=False,
+                 replay_directory=None,
+                 replay_bytes_per_second=1024 * 1024,
+                 replay_interval=30,
+                 max_retry_timeout=30,
+                 circuit_breaker_threshold=5,
+                 circuit_breaker_cooldown=30,
+                 json_encoder=None,
+                 stats_callback=None,
+                 serverless=False):
+        if compression not in (None, GZIP):
+            raise LogzioException(
+                'Unsupported compression {}, only {} is supported'.format(
+                    compression, GZIP))
+
         self.token = token
         self.url = '{}/?token={}'.format(url, token)
         self.logs_drain_timeout = logs_drain_timeout
         self.stdout_logger = get_stdout_logger(debug)
         self.backup_logs = backup_logs
+        self._stats = SenderStats(stats_callback, self.stdout_logger)
         self.network_timeout = network_timeout
-        self.requests_session = requests.Session()
+        self.encoder = get_encoder(json_encoder)
+        self.max_in_flight = max_in_flight
+        self.requests_session = self._new_session()
         self.number_of_retries = number_of_retries
         self.retry_timeout = retry_timeout
+        self.max_retry_timeout = max_retry_timeout
+        self.circuit_breaker_threshold = circuit_breaker_threshold
+        self.circuit_breaker_cooldown = circuit_breaker_cooldown
+        self._consecutive_failures = 0
+        self._circuit_open_until = 0
+        # Bulks waiting for another try, as (retry time, order, try, logs,
+        # request) tuples
+        self._retries = []
+        self._retries_order = itertools.count()
+        self._retries_lock = Lock()
+        self.compression = compression
+        self.compression_level = compression_level
+        self.bulk_size_in_bytes = bulk_size_in_bytes
+        # How long a log may wait for its bulk to fill up before it is sent
+        self.linger = (logs_drain_timeout if linger_ms is None
+                       else linger_ms / 1000.0)
+        self.uncompressed_bytes = 0
+        self.compressed_bytes = 0
+        self._counters_lock = Lock()
+        self.shutdown_timeout = shutdown_timeout
+        self._stopping = False
+        # Set while shutting down, or while a serverless sender flushes
+        self._deadline = None
+        self.serverless = serverless
+        self.spool_directory = spool_directory
+        self._bulks_left_in_spool = 0
 
-        # Function to see if the main thread is alive
-        self.is_main_thread_active = lambda: any(
-            (i.name == 'MainThread') and i.is_alive() for i in enumerate())
+        # Create a queue to hold logs, on disk if a spool directory is set
+        queue_options = dict(max_size=max_queue_size,
+                             max_bytes=max_queue_bytes,
+                             overflow_policy=overflow_policy,
+                             block_timeout=overflow_block_timeout,
+                             spill_function=_write_backup_file,
+                             bulk_size=bulk_size_in_bytes)
+        if spool_directory is None:
+            self.queue = LogsQueue(**queue_options)
+        else:
+            self.queue = SpoolQueue(spool_directory,
+                                    segment_bytes=spool_segment_bytes,
+                                    fsync_interval=spool_fsync_interval,
+                                    **queue_options)
+        # Logs appended with append_deferred(), as (build_message, item)
+        # pairs the sending thread turns into encoded logs
+        self._deferred = []
+        self._deferred_lock = Lock()
+        self.max_deferred = max_queue_size or MAX_DEFERRED_LOGS
+        self._flush_lock = Lock()
+        self._initialize_flushes()
+        if serverless:
+            # Logs are only sent by flush() and shutdown(), from the
+            # calling thread, so nothing runs while the runtime is frozen
+            # between invocations. The thread is never started.
+            self._initialize_upload_executor()
+            self.sending_thread = Thread(target=self._drain_queue)
+        else:
+            self._initialize_sending_thread()
 
-        # Create a queue to hold logs
-        self.queue = queue.Queue()
-        self._flush_lock = Lock() 
-        self._initialize_sending_thread()
+        # Ships logzio-failures-*.txt backups again once Logz.io is reachable
+        self._replayer = None
+        if replay_backups:
+            self._replayer = BackupReplayer(
+                self._replay_bulk, self.stdout_logger,
+                directory=replay_directory,
+                bulk_size=bulk_size_in_bytes,
+                bytes_per_second=replay_bytes_per_second,
+                interval=replay_interval)
+            self._replayer.start()
+        _live_senders.add(self)
 
     def __del__(self):
-        del self.stdout_logger
-        del self.backup_logs
-        del self.queue
+        # __init__ may have raised before setting them all
+        for name in ('stdout_logger', 'backup_logs', 'queue'):
+            self.__dict__.pop(name, None)
+
+    def _new_session(self):
+        session = requests.Session()
+        if self.max_in_flight > 1:
+            # One connection per bulk in flight
+            adapter = requests.adapters.HTTPAdapter(
+                pool_maxsize=self.max_in_flight)
+            session.mount('http://', adapter)
+            session.mount('https://', adapter)
+        return session
+
+    def _reset_after_fork(self):
+        # Runs in a forked child, where the parent's threads are gone. Logs
+        # queued or retried by the parent are left to it, so each is
+        # shipped once, and locks the parent's threads may have held, as
+        # well as connections shared with the parent, are replaced. The
+        # sending thread is started again by the first append().
+        self._flush_lock = Lock()
+        self._retries_lock = Lock()
+        self._counters_lock = Lock()
+        self._deferred_lock = Lock()
+        self._deferred = []
+        self._stats = SenderStats(self._stats.callback, self.stdout_logger)
+        self._initialize_flushes()
+        self._retries = []
+        self._bulks_left_in_spool = 0
+        self.queue.reset_after_fork()
+        self.requests_session = self._new_session()
+        self._initialize_upload_executor()
+        # Backups are replayed by the parent
+        self._replayer = None
+
+    def _initialize_flushes(self):
+        # First sequence numbers of the bulks taken off the queue and not
+        # acknowledged yet
+        self._unacked_bulks = set()
+        self._unacked_lock = Lock()
+        # The (last sequence number, future) of each flush_async() call
+        # waiting, and the sequence number the sending thread sends up to
+        self._flushes = []
+        self._flush_through = 0
 
     def _initialize_sending_thread(self):
+        self._initialize_upload_executor()
         self.sending_thread = Thread(target=self._drain_queue)
-        self.sending_thread.daemon = False
+        # Daemon, so the interpreter doesn't wait for it on exit. The
+        # atexit hook runs the final drain instead, bounded by a deadline.
+        self.sending_thread.daemon = True
         self.sending_thread.name = 'logzio-sending-thread'
         self.sending_thread.start()
 
-    def append(self, logs_message):
-        if not self.sending_thread.is_alive():
+    def _ensure_sending_thread(self):
+        # Started again after a fork, or if it died
+        if (not self.serverless and not self.sending_thread.is_alive() and
+                not self._stopping):
             self._initialize_sending_thread()
 
+    def _initialize_upload_executor(self):
+        # With max_in_flight > 1, bulks are uploaded by a pool of threads.
+        # Also called when the sending thread is restarted after a fork,
+        # since the pool threads don't survive it either.
+        self._in_flight = BoundedSemaphore(self.max_in_flight)
+        self._pending_uploads = set()
+        self._pending_uploads_lock = Lock()
+        self._upload_executor = None
+        if self.max_in_flight > 1:
+            self._upload_executor = futures.ThreadPoolExecutor(
+                max_workers=self.max_in_flight,
+                thread_name_prefix='logzio-upload-thread')
+
+    def append(self, logs_message):
+        self._ensure_sending_thread()
+
+        # Logs are encoded once here, so bulks are cut on their exact size.
         # Queue lib is thread safe, no issue here
-        self.queue.put(json.dumps(logs_message))
+        self.queue.put(self.encoder.dumps(logs_message))
 
-    def flush(self):
-        self._flush_queue()
+    def append_encoded(self, log):
+        # Appends a log encoded already, as a UTF-8 JSON line without the
+        # newline
+        self._ensure_sending_thread()
+        self.queue.put(log)
 
-    def _drain_queue(self):
-        last_try = False
+    def append_deferred(self, build_message, item):
+        # Like append(build_message(item)), but the message is built and
+        # encoded by the sending thread. Once max_deferred logs wait for it,
+        # messages are built right away again, so a sending thread that
+        # can't keep up slows callers down instead of piling logs up.
+        self._ensure_sending_thread()
+
+        with self._deferred_lock:
+            waiting = len(self._deferred)
+            if waiting < self.max_deferred:
+                self._deferred.append((build_message, item))
+        if waiting >= self.max_deferred:
+            self.append(build_message(item))
+        elif not waiting:
+            self.queue.wake()
 
-        while not last_try:
-            # If main is exited, we should run one last time and try to remove
-            # all logs
-            if not self.is_main_thread_active():
+    def _encode_deferred(self):
+        # Deferred logs were accepted already, and the sending thread would
+        # wait for itself to make room for them, so they don't block
+        with self._deferred_lock:
+            deferred, self._deferred = self._deferred, []
+        for build_message, item in deferred:
+            try:
+                self.queue.put(self.encoder.dumps(build_message(item)),
+                               block=False)
+            except Exception as e:
                 self.stdout_logger.debug(
-                    'Identified quit of main thread, sending logs one '
-                    'last time')
-                last_try = True
+                    'Could not build a deferred log, dropping it. '
+                    'Exception: %s', e)
+            # Lets threads that log take the GIL, rather than wait for the
+            # interpreter's switch interval (5ms by default)
+            sleep(0)
+
+    def flush(self, timeout=None):
+        # Sends the logs queued before the call, not the ones queued
+        # meanwhile, and returns whether all of them were acknowledged:
+        # sent, rejected, or backed up. Without a timeout, each bulk gets
+        # a single try, from this thread. With one, the sending thread
+        # sends them, and tries again the ones that fail, while this waits
+        # up to timeout seconds.
+        if self.serverless:
+            return self._flush_here(timeout)
+        if timeout is not None:
+            try:
+                return self.flush_async().result(timeout)
+            except futures.TimeoutError:
+                return False
+        self._encode_deferred()
+        through = self.queue.last_sequence()
+        self._flush_queue(drain_all=False, through=through)
+        self._wait_for_uploads()
+        return self._acked_through() >= through
+
+    def flush_async(self, timeout=None):
+        # Like flush(timeout), but returns a concurrent.futures.Future right
+        # away, whose result is whether the logs queued before the call were
+        # acknowledged. It's False if the sender shut down first. timeout
+        # only bounds the flush of a serverless sender, which runs on a
+        # thread of its own.
+        if self.serverless:
+            return self._flush_here_async(timeout)
+        self._ensure_sending_thread()
+        self._encode_deferred()
+        future = futures.Future()
+        through = self.queue.last_sequence()
+        with self._unacked_lock:
+            self._flushes.append((through, future))
+            self._flush_through = max(self._flush_through, through)
+        self._resolve_flushes(
+            final=self._stopping and not self.sending_thread.is_alive())
+        if not future.done():
+            self.queue.wake()
+        return future
+
+    def _flush_here(self, timeout):
+        # Serverless senders flush from the calling thread, and try the
+        # bulks that fail again while it's due before the deadline. The
+        # others wait for the next flush, e.g. at the end of the next
+        # invocation.
+        self._encode_deferred()
+        through = self.queue.last_sequence()
+        deadline = None if timeout is None else monotonic() + timeout
+        self._deadline = deadline
+        try:
+            self._flush_queue(drain_all=False, through=through)
+            self._wait_for_uploads()
+            while self._acked_through() < through:
+                time_to_next_retry = self._time_to_next_retry()
+                if (time_to_next_retry is None or deadline is None or
+                        monotonic() + time_to_next_retry > deadline):
+                    break
+                sleep(time_to_next_retry)
+                with self._flush_lock:
+                    self._send_due_retries()
+                self._wait_for_uploads()
+        except Exception as e:
+            # Not the caller's problem, like on the sending thread
+            self.stdout_logger.debug(
+                'Unexpected exception while flushing to Logz.io, '
+                'swallowing. Exception: %s', e)
+        finally:
+            self._deadline = None
+        return self._acked_through() >= through
+
+    def _flush_here_async(self, timeout):
+        future = futures.Future()
+
+        def flush():
+            if future.set_running_or_notify_cancel():
+                future.set_result(self._flush_here(timeout))
 
+        Thread(target=flush, name='logzio-flush-thread', daemon=True).start()
+        return future
+
+    def _acked_through(self):
+        # Every log up to this sequence number was acknowledged
+        with self._unacked_lock:
+            return self._acked_through_locked()
+
+    def _acked_through_locked(self):
+        if self._unacked_bulks:
+            return min(self._unacked_bulks) - 1
+        return self.queue.taken
+
+    def _resolve_flushes(self, final=False):
+        # Completes the flushes whose logs were all acknowledged, and all
+        # of them when final
+        with self._unacked_lock:
+            if not self._flushes:
+                return
+            acked_through = self._acked_through_locked()
+            due = [(through, future) for through, future in self._flushes
+                   if final or through <= acked_through]
+            self._flushes = [flush for flush in self._flushes
+                             if flush not in due]
+        for through, future in due:
+            # Unless the caller cancelled it
+            if future.set_running_or_notify_cancel():
+                future.set_result(through <= acked_through)
+
+    def shutdown(self, timeout=None):
+        # Sends everything queued and stops the sending thread, giving up
+        # after timeout seconds (shutdown_timeout by default). Logs that
+        # could not be sent by then are backed up to disk. Returns True if
+        # everything was drained in time.
+        if self._stopping:
+            return not self.sending_thread.is_alive()
+        timeout = self.shutdown_timeout if timeout is None else timeout
+        self._deadline = monotonic() + timeout
+        self._stopping = True
+        _live_senders.discard(self)
+        self.queue.wake()
+
+        if self.sending_thread.is_alive():
+            self.sending_thread.join(timeout)
+        else:
+            # The thread may be gone already, e.g. in a forked child
+            self._final_drain()
+        if self._upload_executor is not None:
+            self._upload_executor.shutdown(wait=False)
+        if self._replayer is not None:
+            self._replayer.stop(
+                max(0, self._deadline - monotonic()))
+        if (not self.sending_thread.is_alive() and
+                not self._pending_uploads and not self._retries and
+                not self._bulks_left_in_spool and not self._deferred and
+                self.queue.empty()):
+            self.queue.close()
+            self._resolve_flushes(final=True)
+            return True
+
+        self.stdout_logger.info(
+            'Could not drain the queue within %s seconds of shutdown',
+            timeout)
+        self._encode_deferred()
+        # Logs left in a spool are sent by the next sender using it
+        if self.backup_logs and self.spool_directory is None:
+            with self._retries_lock:
+                retries, self._retries = self._retries, []
+            for _, _, _, logs_list, _ in retries:
+                self._back_up(logs_list)
+                self._ack(logs_list)
+            while True:
+                logs_list = self._get_messages_up_to_max_allowed_size()
+                if not logs_list:
+                    break
+                self._back_up(logs_list)
+                self._ack(logs_list)
+        self.queue.close()
+        self._resolve_flushes(final=True)
+        return False
+
+    @property
+    def dropped_logs(self):
+        # Logs that didn't fit in the queue, including spilled ones
+        return self.queue.dropped
+
+    @property
+    def spilled_logs(self):
+        return self.queue.spilled
+
+    @property
+    def compression_ratio(self):
+        # Uncompressed size / compressed size of everything sent so far
+        if not self.compressed_bytes:
+            return None
+        return self.uncompressed_bytes / self.compressed_bytes
+
+    def stats(self):
+        # A snapshot of the counters, gauges and histograms of the sender,
+        # see stats.py. Render it with stats.prometheus_text().
+        counters, histograms = self._stats.snapshot()
+        counters.update(logs_enqueued=self.queue.enqueued,
+                        logs_dropped=self.queue.dropped,
+                        logs_spilled=self.queue.spilled)
+        with self._retries_lock:
+            retries_pending = len(self._retries)
+        gauges = {
+            'queued_logs': self.queue.qsize(),
+            'queued_bytes': self.queue.bytes,
+            'oldest_log_age_seconds': self.queue.oldest_log_age(),
+            'deferred_logs': len(self._deferred),
+            'retries_pending': retries_pending,
+            'uploads_in_flight': len(self._pending_uploads),
+            'circuit_open': bool(self._circuit_closes_in()),
+        }
+        return {'counters': counters, 'gauges': gauges,
+                'histograms': histograms}
+
+    def _prepare_bulk(self, logs_list):
+        headers, data, uncompressed_size = prepare_bulk(
+            logs_list, self.compression, self.compression_level)
+        self._stats.observe('bulk_bytes', uncompressed_size)
+        if self.compression:
+            with self._counters_lock:
+                self.uncompressed_bytes += uncompressed_size
+                self.compressed_bytes += len(data)
+            self.stdout_logger.debug(
+                'Compressed bulk from %s to %s bytes (ratio %.2f)',
+                uncompressed_size, len(data), uncompressed_size / len(data))
+        return headers, data
+
+    def _drain_queue(self):
+        while not self._stopping:
+            # Sleeps until a full bulk is queued, the oldest log lingered
+            # long enough, a bulk is due for another try, spooled logs are
+            # due to be synced, or shutdown() wakes it up
+            timeout = self._time_to_next_retry()
+            time_to_sync = self.queue.time_to_sync()
+            if time_to_sync is not None:
+                timeout = (time_to_sync if timeout is None
+                           else min(timeout, time_to_sync))
+            circuit_closes_in = self._circuit_closes_in()
+            if circuit_closes_in and self._circuit_holds_queue():
+                self.queue.wait_for_wake(
+                    circuit_closes_in if timeout is None
+                    else min(timeout, circuit_closes_in))
+            else:
+                self.queue.wait_for_bulk(self.linger, timeout)
+            if self._stopping:
+                break
             try:
-                self._flush_queue()
+                self.queue.sync_if_due()
+                # Up to the logs of the latest flush_async()
+                self._flush_queue(drain_all=False,
+                                  through=self._flush_through)
+                self._resolve_flushes()
             except Exception as e:
                 self.stdout_logger.debug(
                     'Unexpected exception while draining queue to Logz.io, '
                     'swallowing. Exception: %s', e)
 
-            if not last_try:
-                sleep(self.logs_drain_timeout)
+        self._final_drain()
+
+    def _final_drain(self):
+        self.stdout_logger.debug(
+            'Shutting down, sending logs one last time')
+        try:
+            self._flush_queue()
+            self._drain_retries()
+        except Exception as e:
+            self.stdout_logger.debug(
+                'Unexpected exception while draining queue to Logz.io, '
+                'swallowing. Exception: %s', e)
 
-    def _flush_queue(self):
+    def _flush_queue(self, drain_all=True, through=0):
+        # The sending thread only sends bulks that are full or lingered
+        # long enough, the final drain sends everything, and flushes the
+        # logs up to sequence number through. Either way, each bulk gets
+        # a single try here, and bulks that failed get their next try once
+        # it is due, from the sending thread.
         with self._flush_lock:
-            while not self.queue.empty():
+            self._encode_deferred()
+            self._send_due_retries()
+            while (self.queue.taken < through and not self.queue.empty() or
+                   (not self.queue.empty() if drain_all
+                    else self.queue.bulk_ready(self.linger))):
+                deadline = self._deadline
+                if deadline is not None and monotonic() >= deadline:
+                    # Left for the next flush, or backed up by shutdown()
+                    break
+                if self._circuit_closes_in():
+                    # No network I/O until the cool-down is over
+                    if self._circuit_holds_queue():
+                        break
+                    logs_list = self._get_messages_up_to_max_allowed_size()
+                    self._back_up(logs_list)
+                    self._ack(logs_list)
+                    continue
+
                 logs_list = self._get_messages_up_to_max_allowed_size()
                 if not logs_list:
                     break
                 self.stdout_logger.debug(
                     'Starting to drain %s logs to Logz.io', len(logs_list))
+                self._dispatch(logs_list)
 
-                sleep_between_retries = self.retry_timeout
-                self.number_of_retries = self.number_of_retries
-
-                should_backup_to_disk = True
-                headers = {"Content-type": "text/plain", **SHIPPER_HEADER}
-
-                for current_try in range(self.number_of_retries):
-                    should_retry = False
-                    try:
-                        response = self.requests_session.post(
-                            self.url, headers=headers, data='\n'.join(logs_list),
-                            timeout=self.network_timeout)
-                        if response.status_code != 200:
-                            if response.status_code == 400:
-                                self.stdout_logger.info(
-                                    'Got 400 code from Logz.io. This means that '
-                                    'some of your logs are too big, or badly '
-                                    'formatted. response: %s', response.text)
-                                should_backup_to_disk = False
-                                break
-
-                            if response.status_code == 401:
-                                self.stdout_logger.info(
-                                    'You are not authorized with Logz.io! Token '
-                                    'OK? dropping logs...')
-                                should_backup_to_disk = False
-                                break
-                            else:
-                                self.stdout_logger.info(
-                                    'Got %s while sending logs to Logz.io, '
-                                    'Try (%s/%s). Response: %s',
-                                    response.status_code,
-                                    current_try + 1,
-                                    self.number_of_retries,
-                                    response.text)
-                                should_retry = True
-                        else:
-                            self.stdout_logger.debug(
-                                'Successfully sent bulk of %s logs to '
-                                'Logz.io!', len(logs_list))
-                            should_backup_to_disk = False
-                            break
-                    except Exception as e:
-                        self.stdout_logger.warning(
-                            'Got exception while sending logs to Logz.io, '
-                            'Try (%s/%s). Message: %s',
-                            current_try + 1, self.number_of_retries, e)
-                        should_retry = True
-
-                    if should_retry:
-                        sleep(sleep_between_retries)
-
-                if should_backup_to_disk and self.backup_logs:
-                    self.stdout_logger.error(
-                        'Could not send logs to Logz.io after %s tries, '
-                        'backing up to local file system', self.number_of_retries)
-                    backup_logs(logs_list, self.stdout_logger)
-
-                del logs_list
+            if drain_all:
+                self._wait_for_uploads()
 
-    def _get_messages_up_to_max_allowed_size(self):
-        logs_list = []
-        current_size = 0
-        while True:
-            try:
-                current_log = self.queue.get(block=False)
-            except queue.Empty:
-                break
+    def _dispatch(self, logs_list, current_try=0, request=None):
+        if self._upload_executor is None:
+            self._ship_bulk(logs_list, current_try, request)
+            return
+
+        # Blocks while max_in_flight bulks are being uploaded
+        self._in_flight.acquire()
+        try:
+            future = self._upload_executor.submit(
+                self._ship_bulk, logs_list, current_try, request)
+        except RuntimeError:
+            # The executor was shut down, send from this thread
+            self._in_flight.release()
+            self._ship_bulk(logs_list, current_try, request)
+            return
+        with self._pending_uploads_lock:
+            self._pending_uploads.add(future)
+        future.add_done_callback(self._upload_done)
+
+    def _upload_done(self, future):
+        with self._pending_uploads_lock:
+            self._pending_uploads.discard(future)
+        self._in_flight.release()
+        if not future.cancelled() and future.exception():
+            self.stdout_logger.debug(
+                'Unexpected exception while sending a bulk to Logz.io, '
+                'swallowing. Exception: %s', future.exception())
+
+    def _wait_for_uploads(self):
+        with self._pending_uploads_lock:
+            pending_uploads = list(self._pending_uploads)
+        timeout = None
+        if self._deadline is not None:
+            timeout = max(0, self._deadline - monotonic())
+        futures.wait(pending_uploads, timeout=timeout)
+
+    def _ship_bulk(self, logs_list, current_try=0, request=None):
+        done = True
+        try:
+            done = self._send_bulk(logs_list, current_try, request)
+        finally:
+            # Sent, dropped or backed up, the queue can let go of it
+            if done:
+                self._ack(logs_list)
+
+    def _ack(self, logs_list):
+        self.queue.ack(logs_list)
+        with self._unacked_lock:
+            self._unacked_bulks.discard(
+                getattr(logs_list, 'first_sequence', None))
+        self._resolve_flushes()
+        enqueued_at = getattr(logs_list, 'enqueued_at', None)
+        # Logs resumed from a spool were queued at a time unknown
+        if enqueued_at is None or enqueued_at == float('-inf'):
+            return
+        seconds = monotonic() - enqueued_at
+        self._stats.observe('enqueue_to_ack_seconds', seconds)
+        self._stats.notify(ACK, logs=len(logs_list), seconds=seconds)
 
+    def _send_bulk(self, logs_list, current_try=0, request=None):
+        # Sends the bulk once. Returns False if it is waiting for another
+        # try, or was left in the spool.
+        headers, data = request or self._prepare_bulk(logs_list)
+        network_timeout = self.network_timeout
+        deadline = self._deadline
+        if deadline is not None:
+            network_timeout = min(network_timeout, deadline - monotonic())
+
+        result = RETRY
+        delay = None
+        if network_timeout > 0:
+            status_code = text = None
+            started = monotonic()
             try:
-                current_size += sys.getsizeof(current_log)
-            except TypeError:
-                # pypy do not support sys.getsizeof
-                current_size += len(current_log) * 4
+                response = self.requests_session.post(
+                    self.url, headers=headers, data=data,
+                    timeout=network_timeout)
+                status_code = response.status_code
+                text = response.text
+                result = check_response(
+                    response.status_code, response.text, len(logs_list),
+                    current_try, self.number_of_retries, self.stdout_logger)
+                if result == RETRY:
+                    delay = retry_after(response)
+            except Exception as e:
+                self.stdout_logger.warning(
+                    'Got exception while sending logs to Logz.io, '
+                    'Try (%s/%s). Message: %s',
+                    current_try + 1, self.number_of_retries, e)
+            self._record_request(result, status_code, text, logs_list,
+                                 data, monotonic() - started, current_try)
+            self._record_result(result)
+        if result != RETRY:
+            return True
+
+        if delay is None:
+            delay = self._backoff(current_try)
+        retry_time = monotonic() + delay
+        # A serverless flush's deadline only puts the next try off
+        past_deadline = (self._stopping and deadline is not None and
+                         retry_time > deadline)
+        next_try = current_try + 1
+        if (next_try == self.number_of_retries and self.serverless and
+                not self._stopping):
+            # Tried again by later flushes rather than backed up, as the
+            # working directory of serverless runtimes is often read-only
+            next_try = 0
+        if next_try < self.number_of_retries and not past_deadline:
+            with self._retries_lock:
+                heapq.heappush(self._retries, (
+                    retry_time, next(self._retries_order), next_try,
+                    logs_list, (headers, data)))
+                is_next_retry = self._retries[0][3] is logs_list
+            self._stats.count(retries=1)
+            if is_next_retry:
+                # The sending thread may be sleeping past it
+                self.queue.wake()
+            return False
+        return self._give_up(logs_list, past_deadline)
+
+    def _give_up(self, logs_list, past_deadline):
+        if past_deadline and self.spool_directory is not None:
+            # Resumed by the next sender using the spool
+            self._bulks_left_in_spool += 1
+            return False
+        if self.backup_logs:
+            self.stdout_logger.error(
+                'Could not send logs to Logz.io after %s tries, '
+                'backing up to local file system', self.number_of_retries)
+            self._back_up(logs_list)
+        return True
+
+    def _back_up(self, logs_list):
+        # Logs that can't be written are lost, but the bulks after them are
+        # still sent or backed up
+        try:
+            backup_logs(logs_list, self.stdout_logger)
+        except OSError as e:
+            self.stdout_logger.error(
+                'Could not back up %s logs to local file system, dropping '
+                'them. Exception: %s', len(logs_list), e)
+            return
+        self._stats.count(bulks_backed_up=1, logs_backed_up=len(logs_list))
+        self._stats.notify(BACKUP, logs=len(logs_list))
+
+    def _backoff(self, current_try):
+        delay = min(self.max_retry_timeout,
+                    self.retry_timeout * 2 ** current_try)
+        # Equal jitter, so that bulks which failed together don't all try
+        # again at once
+        return delay / 2 + random.uniform(0, delay / 2)
 
-            logs_list.append(current_log)
-            if current_size >= MAX_BULK_SIZE_IN_BYTES:
+    def _record_request(self, result, status_code, text, logs_list, data,
+                        seconds, current_try):
+        self._stats.observe('request_seconds', seconds)
+        if result == SENT:
+            self._stats.count(bulks_sent=1, logs_sent=len(logs_list),
+                              bytes_sent=len(data))
+        elif result == DROPPED:
+            rejected = len(logs_list)
+            if status_code == 400:
+                rejected = rejected_lines(text, rejected)
+            self._stats.count(bulks_rejected=1, logs_rejected=rejected,
+                              logs_sent=len(logs_list) - rejected)
+        else:
+            self._stats.count(failed_requests=1)
+        self._stats.notify(REQUEST, result=result, status_code=status_code,
+                           logs=len(logs_list), bytes=len(data),
+                           seconds=seconds, current_try=current_try)
+
+    def _record_result(self, result):
+        # The circuit breaker opens after circuit_breaker_threshold failed
+        # tries in a row, and stays open for circuit_breaker_cooldown
+        # seconds. The next try after that closes it if it succeeds, or
+        # opens it again.
+        with self._counters_lock:
+            if result != RETRY:
+                self._consecutive_failures = 0
+                return
+            self._consecutive_failures += 1
+            if (not self.circuit_breaker_threshold or
+                    self._consecutive_failures <
+                    self.circuit_breaker_threshold):
+                return
+            self._circuit_open_until = (monotonic() +
+                                        self.circuit_breaker_cooldown)
+        self._stats.count(circuit_breaker_opens=1)
+        self._stats.notify(CIRCUIT_OPEN,
+                           cooldown=self.circuit_breaker_cooldown)
+        self.stdout_logger.info(
+            'Logz.io failed %s tries in a row, not sending logs for %s '
+            'seconds', self._consecutive_failures,
+            self.circuit_breaker_cooldown)
+
+    def _circuit_holds_queue(self):
+        # While the circuit breaker is open, queued logs stay in the spool,
+        # or in memory if they can't be backed up to disk or the sender is
+        # serverless
+        return (self.spool_directory is not None or not self.backup_logs or
+                self.serverless)
+
+    def _circuit_closes_in(self):
+        # Seconds until the circuit breaker closes, 0 if it's closed
+        return max(0, self._circuit_open_until - monotonic())
+
+    def _time_to_next_retry(self):
+        with self._retries_lock:
+            if not self._retries:
+                return None
+            retry_time = self._retries[0][0]
+        return max(0, retry_time - monotonic(), self._circuit_closes_in())
+
+    def _send_due_retries(self):
+        while not self._circuit_closes_in():
+            with self._retries_lock:
+                if not self._retries or self._retries[0][0] > monotonic():
+                    return
+                _, _, current_try, logs_list, request = heapq.heappop(
+                    self._retries)
+            self._dispatch(logs_list, current_try, request)
+
+    def _drain_retries(self):
+        # Shutting down, bulks waiting for another try get it if it's due
+        # before the shutdown deadline, and are given up on otherwise
+        while True:
+            self._wait_for_uploads()
+            time_to_next_retry = self._time_to_next_retry()
+            if time_to_next_retry is None:
+                return
+            if monotonic() + time_to_next_retry > self._deadline:
                 break
+            sleep(time_to_next_retry)
+            with self._flush_lock:
+                self._send_due_retries()
+
+        with self._retries_lock:
+            retries, self._retries = self._retries, []
+        for _, _, _, logs_list, _ in retries:
+            if self._give_up(logs_list, past_deadline=True):
+                self._ack(logs_list)
+
+    def _replay_bulk(self, logs_list):
+        # A single try, the replayer tries again on its next pass
+        headers, data = self._prepare_bulk(logs_list)
+        try:
+            response = self.requests_session.post(
+                self.url, headers=headers, data=data,
+                timeout=self.network_timeout)
+            result = check_response(
+                response.status_code, response.text, len(logs_list), 0, 1,
+                self.stdout_logger)
+        except Exception as e:
+            self.stdout_logger.warning(
+                'Got exception while replaying backed up logs to Logz.io. '
+                'Message: %s', e)
+            return False
+        return result != RETRY
+
+    def _get_messages_up_to_max_allowed_size(self):
+        # Registered under the lock, so a bulk is never taken off the queue
+        # without being counted as unacknowledged
+        with self._unacked_lock:
+            logs_list = self.queue.get_bulk(self.bulk_size_in_bytes)
+            if logs_list:
+                self._unacked_bulks.add(logs_list.first_sequence)
         return logs_list
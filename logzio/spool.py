@@ -0,0 +1,424 @@
+# Disk backed LogsQueue. Logs are appended to segment files in a spool
+# directory as they are queued, so they survive a crash of the process, and
+# are read back through mmap when they are shipped.
+import mmap
+import os
+import threading
+from collections import deque
+from time import monotonic, time_ns
+
+from .logs_queue import Bulk, LogsQueue, DROP_NEWEST
+
+SEGMENT_PREFIX = 'logzio-spool-'
+SEGMENT_SUFFIX = '.log'
+ACK_SUFFIX = '.ack'
+DEFAULT_SEGMENT_BYTES = 16 * 1024 * 1024  # 16 MB
+
+# Segments owned by the spools of this process, so that another spool opened
+# on the same directory doesn't adopt them
+_claimed_segments = set()
+_claim_lock = threading.Lock()
+_last_segment_id = 0
+
+
+def _reset_claim_lock():
+    # One of the parent's threads may have held it while forking
+    global _claim_lock
+    _claim_lock = threading.Lock()
+
+
+if hasattr(os, 'register_at_fork'):
+    os.register_at_fork(after_in_child=_reset_claim_lock)
+
+
+def _new_segment_id():
+    # Segment ids are creation times, so sorting segment names sorts them
+    # in the order their logs were queued, across processes too
+    global _last_segment_id
+    with _claim_lock:
+        _last_segment_id = max(_last_segment_id + 1, time_ns())
+        return _last_segment_id
+
+
+def _segment_name(segment_id, pid):
+    return '{}{:020d}-{}{}'.format(
+        SEGMENT_PREFIX, segment_id, pid, SEGMENT_SUFFIX)
+
+
+def _parse_segment_name(name):
+    # Returns the segment id and the pid of the process that wrote it
+    segment_id, pid = name[len(SEGMENT_PREFIX):-len(SEGMENT_SUFFIX)].split('-')
+    return int(segment_id), int(pid)
+
+
+def _pid_alive(pid):
+    if os.name == 'nt':
+        # os.kill() would terminate it. Renaming the segment of a live
+        # process fails on Windows anyway, which keeps it from being adopted.
+        return False
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        return True
+    return True
+
+
+class _Segment:
+    def __init__(self, path, size=0, acked=0):
+        self.path = path
+        self.size = size
+        # Logs before read_offset were taken off the queue, and the ones
+        # before acked were shipped
+        self.read_offset = acked
+        self.acked = acked
+        self.fd = None  # Only the segment being written is open
+        self.map = None
+
+
+class SpoolBulk(Bulk):
+    # A bulk taken off a SpoolQueue, remembering where it ends in the spool
+    position = None
+
+
+# Logs are written newline terminated, with one unbuffered write each, to
+# the segment being written, which is rolled over once it reaches
+# segment_bytes. Writes are fsynced at most every fsync_interval seconds
+# (None leaves it to the OS, 0 fsyncs every log), and at most
+# fsync_interval seconds after they were written, by the sending thread
+# calling sync_if_due().
+#
+# Segments are deleted once all their logs were acknowledged with ack(), the
+# offset acknowledged so far in the oldest one is kept in a .ack file next to
+# it. Segments of processes that are gone, and the logs in them that weren't
+# acknowledged, are resumed when a spool is opened on the directory. Logs in
+# flight when the process died are sent again.
+#
+# max_size and max_bytes bound the logs that were not taken off the queue
+# yet, like with LogsQueue.
+class SpoolQueue(LogsQueue):
+
+    def __init__(self, directory, segment_bytes=DEFAULT_SEGMENT_BYTES,
+                 fsync_interval=1.0, max_size=0, max_bytes=0,
+                 overflow_policy=DROP_NEWEST, block_timeout=1.0,
+                 spill_function=None, bulk_size=0):
+        self.directory = directory
+        self.segment_bytes = segment_bytes
+        self.fsync_interval = fsync_interval
+        os.makedirs(directory, exist_ok=True)
+        LogsQueue.__init__(self, max_size=max_size, max_bytes=max_bytes,
+                           overflow_policy=overflow_policy,
+                           block_timeout=block_timeout,
+                           spill_function=spill_function,
+                           bulk_size=bulk_size)
+
+    def _init(self, maxsize):
+        self._segments = deque()
+        self._tail = None  # The segment being written
+        # [segment, offset, shipped] of the bulks taken off the queue, in
+        # order, until everything before them was shipped too
+        self._unacked = deque()
+        self._count = 0
+        self.bytes = 0
+        # When each queued log was queued, after the resumed ones, which
+        # were queued by an earlier process at a time unknown
+        self._enqueue_times = deque()
+        self._resumed = 0
+        self._woken = False
+        self._next_fsync = 0
+        self._unsynced = False
+        self._pid = os.getpid()
+        self._recover()
+
+    def _recover(self):
+        names = sorted(name for name in os.listdir(self.directory)
+                       if name.startswith(SEGMENT_PREFIX) and
+                       name.endswith(SEGMENT_SUFFIX))
+        with _claim_lock:
+            for name in names:
+                try:
+                    segment_id, pid = _parse_segment_name(name)
+                except ValueError:
+                    continue
+                path = os.path.join(self.directory, name)
+                if path in _claimed_segments or (
+                        pid != self._pid and _pid_alive(pid)):
+                    continue
+
+                # Renaming claims the segment, only one process can
+                # adopt it
+                claimed_path = os.path.join(
+                    self.directory, _segment_name(segment_id, self._pid))
+                if claimed_path != path:
+                    try:
+                        os.rename(path, claimed_path)
+                    except OSError:
+                        continue
+                    try:
+                        os.rename(path + ACK_SUFFIX,
+                                  claimed_path + ACK_SUFFIX)
+                    except FileNotFoundError:
+                        pass
+                _claimed_segments.add(claimed_path)
+                self._load_segment(claimed_path)
+        self._resumed = self._count
+
+    def _load_segment(self, path):
+        with open(path, 'rb+') as f:
+            data = f.read()
+            # A log cut short by a crash is dropped
+            size = data.rfind(b'\n') + 1
+            if size < len(data):
+                f.truncate(size)
+
+        segment = _Segment(path, size, self._read_ack(path, size))
+        count = data.count(b'\n', segment.acked, size)
+        if not count:
+            self._delete(segment)
+            return
+        self._segments.append(segment)
+        self._count += count
+        self.bytes += size - segment.acked - count
+
+    def _read_ack(self, path, size):
+        try:
+            with open(path + ACK_SUFFIX) as f:
+                return min(int(f.read()), size)
+        except (OSError, ValueError):
+            return 0
+
+    def _write_ack(self, segment):
+        with open(segment.path + ACK_SUFFIX, 'w') as f:
+            f.write(str(segment.acked))
+
+    def _delete(self, segment):
+        self._unmap(segment)
+        if segment.fd is not None:
+            os.close(segment.fd)
+            segment.fd = None
+        for path in (segment.path, segment.path + ACK_SUFFIX):
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+        _claimed_segments.discard(segment.path)
+
+    def _unmap(self, segment):
+        if segment.map is not None:
+            segment.map.close()
+            segment.map = None
+
+    def _check_pid(self):
+        # A forked child leaves the parent's segments to the parent, and
+        # starts a spool of its own
+        if self._pid == os.getpid():
+            return
+        for segment in self._segments:
+            self._unmap(segment)
+            if segment.fd is not None:
+                os.close(segment.fd)
+        self._segments = deque()
+        self._tail = None
+        self._unacked.clear()
+        self._count = 0
+        self.bytes = 0
+        self._enqueue_times = deque()
+        self._resumed = 0
+        self._unsynced = False
+        self._pid = os.getpid()
+
+    def _forget_queued(self):
+        self._check_pid()
+        self._woken = False
+
+    def _roll(self):
+        if self._tail is not None:
+            self._seal(self._tail)
+        path = os.path.join(
+            self.directory, _segment_name(_new_segment_id(), self._pid))
+        segment = _Segment(path)
+        segment.fd = os.open(
+            path, os.O_WRONLY | os.O_CREAT | os.O_APPEND |
+            getattr(os, 'O_BINARY', 0), 0o600)
+        with _claim_lock:
+            _claimed_segments.add(path)
+        self._segments.append(segment)
+        self._tail = segment
+
+    def _seal(self, segment):
+        if self.fsync_interval is not None:
+            os.fsync(segment.fd)
+            self._unsynced = False
+        os.close(segment.fd)
+        segment.fd = None
+        if segment is self._tail:
+            self._tail = None
+        self._remove_acked_segments()
+
+    def _remove_acked_segments(self):
+        while self._segments:
+            segment = self._segments[0]
+            if segment is self._tail or segment.acked < segment.size:
+                break
+            self._delete(self._segments.popleft())
+
+    # queue.Queue's storage hooks, called with self.mutex held
+    def _qsize(self):
+        return self._count
+
+    def _put(self, item):
+        self._check_pid()
+        if self._tail is None or self._tail.size >= self.segment_bytes:
+            self._roll()
+        os.write(self._tail.fd, item + b'\n')
+        self._tail.size += len(item) + 1
+        self._enqueue_times.append(monotonic())
+        self._count += 1
+        self.bytes += len(item)
+
+        if self.fsync_interval is not None:
+            if monotonic() >= self._next_fsync:
+                self._fsync()
+            else:
+                # Synced by sync_if_due() once the interval is over
+                self._unsynced = True
+
+    def _fsync(self):
+        os.fsync(self._tail.fd)
+        self._unsynced = False
+        self._next_fsync = monotonic() + self.fsync_interval
+
+    def _get(self):
+        segment, start, end = self._next_record()
+        log = self._take(segment, start, end)
+        # Nothing ships it (it's dropped by the drop_oldest policy), so it's
+        # acknowledged right away
+        self._unacked.append([segment, end + 1, True])
+        self._release_shipped(persist=False)
+        return log
+
+    def _oldest_enqueue_time(self):
+        # Resumed logs are sent right away
+        if self._resumed:
+            return float('-inf')
+        return self._enqueue_times[0]
+
+    def oldest_log_age(self):
+        age = LogsQueue.oldest_log_age(self)
+        # Resumed logs were queued by an earlier process, at a time unknown
+        return 0 if age == float('inf') else age
+
+    def _next_record(self):
+        # The segment, start and end offsets of the oldest queued log
+        for segment in self._segments:
+            if segment.read_offset < segment.size:
+                break
+        if segment.map is None or len(segment.map) < segment.size:
+            # The segment being written grew since it was mapped
+            self._unmap(segment)
+            with open(segment.path, 'rb') as f:
+                segment.map = mmap.mmap(f.fileno(), segment.size,
+                                        access=mmap.ACCESS_READ)
+        end = segment.map.find(b'\n', segment.read_offset, segment.size)
+        return segment, segment.read_offset, end
+
+    def _take(self, segment, start, end):
+        log = segment.map[start:end]
+        segment.read_offset = end + 1
+        if segment.read_offset == segment.size and segment is not self._tail:
+            self._unmap(segment)
+        self._count -= 1
+        self.bytes -= end - start
+        self.taken += 1
+        if self._resumed:
+            self._resumed -= 1
+        else:
+            self._enqueue_times.popleft()
+        return log
+
+    def _release_shipped(self, persist=True):
+        # Everything before the first bulk that wasn't shipped yet can go
+        shipped = None
+        while self._unacked and self._unacked[0][2]:
+            shipped = self._unacked.popleft()
+        if shipped is None:
+            return
+
+        segment, offset, _ = shipped
+        for earlier_segment in self._segments:
+            if earlier_segment is segment:
+                break
+            earlier_segment.acked = earlier_segment.size
+        segment.acked = offset
+        self._remove_acked_segments()
+        if persist and self._segments and self._segments[0] is segment:
+            self._write_ack(segment)
+
+    def get_bulk(self, max_bytes=None):
+        max_bytes = max_bytes or self.bulk_size
+        bulk = SpoolBulk()
+        with self.not_empty:
+            self._check_pid()
+            if self._count:
+                bulk.enqueued_at = self._oldest_enqueue_time()
+            bulk.first_sequence = self.taken + 1
+            bulk_size = -1
+            while self._count:
+                segment, start, end = self._next_record()
+                size = end - start + 1
+                if bulk and bulk_size + size > max_bytes:
+                    break
+                bulk.append(self._take(segment, start, end))
+                bulk.position = [segment, end + 1, False]
+                bulk_size += size
+            if bulk:
+                self._unacked.append(bulk.position)
+                self.not_full.notify_all()
+        return bulk
+
+    def ack(self, bulk):
+        # Bulks may be acknowledged out of order, the spool is only
+        # truncated up to the oldest bulk that wasn't
+        if not bulk:
+            return
+        with self.mutex:
+            bulk.position[2] = True
+            self._release_shipped()
+
+    def put(self, item, block=True, timeout=None):
+        try:
+            return LogsQueue.put(self, item, block, timeout)
+        except OSError:
+            # e.g. the disk is full
+            with self.mutex:
+                self.dropped += 1
+            return False
+
+    def sync(self):
+        with self.mutex:
+            if self._tail is not None:
+                self._fsync()
+
+    def time_to_sync(self):
+        with self.mutex:
+            if not self._unsynced:
+                return None
+            return max(0, self._next_fsync - monotonic())
+
+    def sync_if_due(self):
+        with self.mutex:
+            if (self._unsynced and self._tail is not None and
+                    monotonic() >= self._next_fsync):
+                self._fsync()
+
+    def close(self):
+        # Logs that are still queued are resumed by the next spool opened
+        # on the directory
+        with self.mutex:
+            if self._tail is not None:
+                self._seal(self._tail)
+            with _claim_lock:
+                for segment in self._segments:
+                    self._unmap(segment)
+                    _claimed_segments.discard(segment.path)
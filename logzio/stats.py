@@ -0,0 +1,163 @@
+# Counters and histograms of a LogzioSender, updated once per bulk rather
+# than per log, and an exporter to the Prometheus text format
+import bisect
+import math
+import threading
+
+# Upper bounds of the buckets of latency histograms, in seconds
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5,
+                   10, 30, 60, 300)
+# Upper bounds of the buckets of the bulk size histogram, in bytes
+BULK_SIZE_BUCKETS = (1024, 4096, 16384, 65536, 262144, 1048576, 4194304)
+
+COUNTERS = (
+    # Bulks, and their logs and bytes, Logz.io accepted
+    'bulks_sent', 'logs_sent', 'bytes_sent',
+    # Rejected with a 400 or 401, which are never tried again. A 400 may
+    # reject only some of the logs of a bulk, the others count as sent.
+    'bulks_rejected', 'logs_rejected',
+    # Tries that failed, with a response asking to try again or no response
+    'failed_requests',
+    # Bulks scheduled for another try
+    'retries',
+    'bulks_backed_up', 'logs_backed_up',
+    'circuit_breaker_opens',
+)
+
+# Events passed to the callback of SenderStats. A request comes with its
+# result, status_code (None without a response), logs, bytes, seconds and
+# current_try, an ack with the logs of the bulk and the seconds since the
+# oldest of them was queued, a backup with its logs, and the circuit
+# breaker opening with its cooldown.
+REQUEST = 'request'
+ACK = 'ack'
+BACKUP = 'backup'
+CIRCUIT_OPEN = 'circuit_open'
+
+
+class Histogram:
+    # Counts observations per bucket, bounds being the buckets' upper
+    # bounds. Observations bigger than all of them fall in a last bucket.
+
+    def __init__(self, bounds):
+        self.bounds = tuple(bounds)
+        self.counts = [0] * (len(self.bounds) + 1)
+        self.sum = 0
+        self.count = 0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.bounds, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    def snapshot(self):
+        # Cumulative counts, as (upper bound, observations up to it) pairs,
+        # like Prometheus buckets
+        buckets = []
+        cumulative = 0
+        for bound, count in zip(self.bounds + (math.inf,), self.counts):
+            cumulative += count
+            buckets.append((bound, cumulative))
+        return {'buckets': buckets, 'sum': self.sum, 'count': self.count}
+
+
+class SenderStats:
+    # callback(event, fields) is called with every event above, from the
+    # thread sending the bulk. Exceptions it raises are logged to logger and
+    # swallowed.
+
+    def __init__(self, callback=None, logger=None):
+        self.callback = callback
+        self.logger = logger
+        self.counters = dict.fromkeys(COUNTERS, 0)
+        self.histograms = {
+            'bulk_bytes': Histogram(BULK_SIZE_BUCKETS),
+            'request_seconds': Histogram(LATENCY_BUCKETS),
+            'enqueue_to_ack_seconds': Histogram(LATENCY_BUCKETS),
+        }
+        self._lock = threading.Lock()
+
+    def count(self, **increments):
+        with self._lock:
+            for counter, increment in increments.items():
+                self.counters[counter] += increment
+
+    def observe(self, histogram, value):
+        with self._lock:
+            self.histograms[histogram].observe(value)
+
+    def notify(self, event, **fields):
+        if self.callback is None:
+            return
+        try:
+            self.callback(event, fields)
+        except Exception as e:
+            if self.logger is not None:
+                self.logger.debug(
+                    'Stats callback failed on %s, swallowing. Exception: '
+                    '%s', event, e)
+
+    def snapshot(self):
+        with self._lock:
+            return dict(self.counters), {
+                name: histogram.snapshot()
+                for name, histogram in self.histograms.items()}
+
+
+def _escape_label_value(value):
+    return (str(value).replace('\\', '\\\\').replace('"', '\\"')
+            .replace('\n', '\\n'))
+
+
+def _format_labels(labels):
+    if not labels:
+        return ''
+    return '{' + ','.join(
+        '{}="{}"'.format(name, _escape_label_value(value))
+        for name, value in labels.items()) + '}'
+
+
+def _format_value(value):
+    if value == math.inf:
+        return '+Inf'
+    if isinstance(value, bool):
+        return str(int(value))
+    return repr(value)
+
+
+def prometheus_text(stats, prefix='logzio_sender', labels=None):
+    # Renders LogzioSender.stats() in the Prometheus text exposition format.
+    # stats may also be a list of (labels, stats) pairs, e.g. one per
+    # sender, which are rendered as the series of the same metrics.
+    if isinstance(stats, dict):
+        stats = [(labels or {}, stats)]
+    lines = []
+
+    def add_metric(name, metric_type, samples):
+        lines.append('# TYPE {} {}'.format(name, metric_type))
+        for suffix, sample_labels, value in samples:
+            lines.append('{}{}{} {}'.format(
+                name, suffix, _format_labels(sample_labels),
+                _format_value(value)))
+
+    first = stats[0][1] if stats else {}
+    for counter in first.get('counters', ()):
+        add_metric('{}_{}_total'.format(prefix, counter), 'counter', [
+            ('', sample_labels, snapshot['counters'][counter])
+            for sample_labels, snapshot in stats])
+    for gauge in first.get('gauges', ()):
+        add_metric('{}_{}'.format(prefix, gauge), 'gauge', [
+            ('', sample_labels, snapshot['gauges'][gauge])
+            for sample_labels, snapshot in stats])
+    for histogram in first.get('histograms', ()):
+        samples = []
+        for sample_labels, snapshot in stats:
+            values = snapshot['histograms'][histogram]
+            for bound, count in values['buckets']:
+                samples.append((
+                    '_bucket', dict(sample_labels, le=_format_value(bound)),
+                    count))
+            samples.append(('_sum', sample_labels, values['sum']))
+            samples.append(('_count', sample_labels, values['count']))
+        add_metric('{}_{}'.format(prefix, histogram), 'histogram', samples)
+    return '\n'.join(lines) + '\n'
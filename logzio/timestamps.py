@@ -0,0 +1,38 @@
+# Formats the @timestamp of logs from the time of the event, record.created
+import time
+
+from .exceptions import LogzioException
+
+TIMESTAMP_PRECISIONS = ('millis', 'micros', 'nanos')
+
+
+class TimestampFormatter:
+    # millis and micros format an ISO 8601 UTC timestamp, with 3 or 6
+    # fractional digits. nanos gives the nanoseconds since the epoch, as an
+    # integer, within the ~250ns a float of record.created keeps.
+    #
+    # The YYYY-MM-DDTHH:MM:SS prefix is formatted once per second, so only
+    # the fraction is formatted for each record.
+
+    def __init__(self, precision='millis'):
+        if precision not in TIMESTAMP_PRECISIONS:
+            raise LogzioException(
+                'Unknown timestamp precision {}, expected one of {}'.format(
+                    precision, ', '.join(TIMESTAMP_PRECISIONS)))
+        self.precision = precision
+        # (second, prefix), replaced as a whole so threads can share it
+        self._cached_prefix = (None, None)
+
+    def __call__(self, created):
+        if self.precision == 'nanos':
+            return round(created * 1e9)
+        # Rounded in whole microseconds, as created * 1000 % 1000 may be
+        # just below the millisecond it stands for
+        second, microsecond = divmod(round(created * 1e6), 1000000)
+        cached_second, prefix = self._cached_prefix
+        if cached_second != second:
+            prefix = time.strftime('%Y-%m-%dT%H:%M:%S', time.gmtime(second))
+            self._cached_prefix = (second, prefix)
+        if self.precision == 'millis':
+            return '%s.%03dZ' % (prefix, microsecond // 1000)
+        return '%s.%06dZ' % (prefix, microsecond)
@@ -20,7 +20,8 @@ setup(
         "protobuf>=3.20.2"
     ],
     extras_require={
-        "opentelemetry-logging": ["opentelemetry-instrumentation-logging==0.60b1"]
+        "opentelemetry-logging": ["opentelemetry-instrumentation-logging==0.60b1"],
+        "aiohttp": ["aiohttp>=3.8.0"]
     },
     test_requires=[
         "future"
@@ -1,50 +1,107 @@
 # noinspection PyUnresolvedReferences
 import future
+import gzip
+import json
+import random
 import socket
-from http.server import BaseHTTPRequestHandler, HTTPServer
-from threading import Thread
+import struct
+import time
+from collections import Counter, deque
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from threading import Lock, Thread
 
 from .logsList import logs_list
 from .persistentFlags import persistent_flags
 
+# Faults a bulk can be answered with instead of being accepted
+SERVER_ERROR = 'server_error'  # 500
+THROTTLE = 'throttle'  # 429, with a Retry-After header
+RESET = 'reset'  # The connection is reset, without a response
+FAULTS = (SERVER_ERROR, THROTTLE, RESET)
+
 
 class ListenerHandler(BaseHTTPRequestHandler):
+    # Keeps connections alive, like the Logz.io listener
+    protocol_version = 'HTTP/1.1'
+
     def do_POST(self):
-        try:
-            content_length = int(self.headers.get("Content-Length"))
-            all_logs = self.rfile.read(content_length).decode("utf-8").split('\n')
-            if len(all_logs) == 0:
-                self._set_response(400, "Bad Request", b"Bad request you got there, pal")
-                return
-
-            for log in all_logs:
-                if log != "":
-                    if persistent_flags.get_server_error():
-                        self._set_response(500, "Issue!!!!!!!", b"Not good, not good at all.")
-                        return
-
-                    logs_list.list.append(log)
-
-            self._set_response(200, "OK", b"Shabam! got logs.")
+        listener = self.server.listener
+        content_length = int(self.headers.get("Content-Length") or 0)
+        body = self.rfile.read(content_length)
+        if listener.latency:
+            time.sleep(listener.latency)
+
+        fault = listener.next_fault()
+        if fault == RESET:
+            self._reset_connection()
+            return
+        if fault == THROTTLE:
+            self._set_response(429, "Too Many Requests", b"Slow down, pal",
+                               {"Retry-After": str(listener.retry_after)})
+            return
+        if fault == SERVER_ERROR or persistent_flags.get_server_error():
+            self._set_response(500, "Issue!!!!!!!", b"Not good, not good at all.")
             return
 
-        except IndexError:
-            self._set_response(400, "Bad Request", b"Bad request you got there, pal")
+        if self.headers.get("Content-Encoding") == "gzip":
+            body = gzip.decompress(body)
+        rejected, accepted = listener.receive(body)
+        if rejected:
+            # Logz.io keeps the well formed logs of a bulk, and answers with
+            # a 400 counting the others
+            self._set_response(400, "Bad Request", json.dumps({
+                "malformedLines": rejected, "successfulLines": accepted,
+                "oversizedLines": 0, "emptyLogLines": 0}).encode())
             return
+        self._set_response(200, "OK", b"Shabam! got logs.")
 
-    def _set_response(self, http_code, http_description, byte_body):
+    def _set_response(self, http_code, http_description, byte_body,
+                      headers=None):
         self.send_response(http_code, http_description)
         self.send_header('Content-type', 'text/html')
+        self.send_header('Content-Length', str(len(byte_body)))
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
         self.end_headers()
         self.wfile.write(byte_body)
+        self.server.listener.count_response(http_code)
+
+    def _reset_connection(self):
+        # Closing with a zero linger time sends a RST instead of a FIN
+        self.connection.setsockopt(socket.SOL_SOCKET, socket.SO_LINGER,
+                                   struct.pack('ii', 1, 0))
+        self.connection.close()
+        self.close_connection = True
+        self.server.listener.count_response(None)
+
+    def log_message(self, format, *args):
+        pass
 
 
 class MockLogzioListener:
-    def __init__(self):
-        self.port = _find_available_port()
+    # Accepts bulks like the Logz.io listener, from a thread per connection.
+    #
+    # latency is how long every response takes, in seconds. Bulks are
+    # answered with the faults queued by add_fault() first, and then with
+    # each of fault_rates' faults with its probability. Logs containing
+    # reject_marker are rejected with a partial 400. With store_logs=False,
+    # logs are only counted, in logs_received, so the listener keeps up with
+    # benchmarks.
+    def __init__(self, latency=0, store_logs=True, fault_rates=None,
+                 retry_after=1, reject_marker=None):
         self.host = "localhost"
-
-        self.server = HTTPServer((self.host, self.port), ListenerHandler)
+        self.latency = latency
+        self.store_logs = store_logs
+        self.fault_rates = fault_rates or {}
+        self.retry_after = retry_after
+        self.reject_marker = reject_marker
+        self._faults = deque()
+        self._lock = Lock()
+        self._reset_counters()
+
+        self.server = ThreadingHTTPServer((self.host, 0), ListenerHandler)
+        self.server.listener = self
+        self.port = self.server.server_address[1]
 
         self.listening_thread = Thread(target=self._start_listening)
         self.listening_thread.daemon = True
@@ -56,6 +113,58 @@ class MockLogzioListener:
     def _start_listening(self):
         self.server.serve_forever()
 
+    def _reset_counters(self):
+        self.bulks_received = 0
+        self.logs_received = 0
+        self.bytes_received = 0
+        # Responses by status code, None for connections reset
+        self.responses = Counter()
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def add_fault(self, fault, count=1):
+        if fault not in FAULTS:
+            raise ValueError('Unknown fault {}'.format(fault))
+        with self._lock:
+            self._faults.extend([fault] * count)
+
+    def next_fault(self):
+        with self._lock:
+            if self._faults:
+                return self._faults.popleft()
+        for fault, rate in self.fault_rates.items():
+            if random.random() < rate:
+                return fault
+        return None
+
+    def receive(self, body):
+        # Takes the logs of a bulk, returns how many were rejected and
+        # accepted
+        if self.store_logs or self.reject_marker is not None:
+            logs = [log for log in body.split(b'\n') if log]
+            accepted = [log for log in logs if self.reject_marker is None or
+                        self.reject_marker.encode() not in log]
+            rejected = len(logs) - len(accepted)
+            if self.store_logs:
+                self.logs_list.extend(log.decode('utf-8')
+                                      for log in accepted)
+            accepted = len(accepted)
+        else:
+            # Sent logs are never empty, nor have newlines in them
+            accepted = body.count(b'\n') + 1 if body else 0
+            rejected = 0
+        with self._lock:
+            self.bulks_received += 1
+            self.logs_received += accepted
+            self.bytes_received += len(body)
+        return rejected, accepted
+
+    def count_response(self, status_code):
+        with self._lock:
+            self.responses[status_code] += 1
+
     def get_port(self):
         return self.port
 
@@ -70,22 +179,17 @@ class MockLogzioListener:
         return False
 
     def get_number_of_logs(self):
+        if not self.store_logs:
+            return self.logs_received
         return len(self.logs_list)
 
     def clear_logs_buffer(self):
         self.logs_list.clear()
+        with self._lock:
+            self._reset_counters()
 
     def set_server_error(self):
         self.persistent_flags.set_server_error()
 
     def clear_server_error(self):
         self.persistent_flags.clear_server_error()
-
-
-def _find_available_port():
-    sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-    sock.bind(("", 0))
-    sock.listen(1)
-    port = sock.getsockname()[1]
-    sock.close()
-    return port
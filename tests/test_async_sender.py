@@ -0,0 +1,179 @@
+import asyncio
+import logging
+import threading
+import time
+from unittest import IsolatedAsyncioTestCase, TestCase
+
+from logzio.async_handler import AsyncLogzioHandler
+from logzio.async_sender import AsyncLogzioSender, RequestsTransport
+from logzio.exceptions import LogzioException
+
+from .mockLogzioListener import listener
+
+
+class FakeTransport:
+    def __init__(self, status_codes=(200,)):
+        self.status_codes = list(status_codes)
+        self.bulks = []
+        self.closed = False
+
+    async def post(self, url, headers, data, timeout):
+        self.bulks.append(data)
+        await asyncio.sleep(0)
+        status_code = self.status_codes.pop(0) if len(self.status_codes) > 1 else self.status_codes[0]
+        return status_code, 'response'
+
+    async def close(self):
+        self.closed = True
+
+
+class TestAsyncLogzioSender(IsolatedAsyncioTestCase):
+
+    def _sender(self, transport, **kwargs):
+        return AsyncLogzioSender(token='token', transport=transport,
+                                 logs_drain_timeout=60, backup_logs=False,
+                                 retry_timeout=0.01, **kwargs)
+
+    async def test_flush(self):
+        transport = FakeTransport()
+        sender = self._sender(transport)
+        sender.append({'message': 'Test async flush'})
+        await sender.flush()
+
+        self.assertEqual(len(transport.bulks), 1)
+        self.assertIn(b'Test async flush', transport.bulks[0])
+        await sender.aclose()
+
+    async def test_log_is_sent_after_linger(self):
+        transport = FakeTransport()
+        sender = self._sender(transport, linger_ms=50)
+        sender.append({'message': 'Test async linger'})
+        await asyncio.sleep(0.3)
+
+        self.assertEqual(len(transport.bulks), 1)
+        await sender.aclose()
+
+    async def test_append_from_another_thread(self):
+        transport = FakeTransport()
+        sender = self._sender(transport, linger_ms=50)
+        sender.append({'message': 'Test from the loop'})
+        await asyncio.to_thread(sender.append, {'message': 'Test from a thread'})
+        await asyncio.sleep(0.3)
+
+        self.assertEqual(b''.join(transport.bulks).count(b'Test from'), 2)
+        await sender.aclose()
+
+    async def test_retries(self):
+        transport = FakeTransport(status_codes=(500,))
+        sender = self._sender(transport, number_of_retries=3)
+        sender.append({'message': 'Test async retries'})
+        await sender.flush()
+
+        self.assertEqual(len(transport.bulks), 3)
+        await sender.aclose()
+
+    async def test_bad_request_is_not_retried(self):
+        transport = FakeTransport(status_codes=(400,))
+        sender = self._sender(transport, number_of_retries=3)
+        sender.append({'message': 'Test async bad request'})
+        await sender.flush()
+
+        self.assertEqual(len(transport.bulks), 1)
+        await sender.aclose()
+
+    async def test_aclose_drains_queue(self):
+        transport = FakeTransport()
+        sender = self._sender(transport, bulk_size_in_bytes=100)
+        for counter in range(10):
+            sender.append({'message': 'Test async close {}'.format(counter)})
+        await sender.aclose()
+
+        self.assertTrue(sender.queue.empty())
+        self.assertEqual(b'\n'.join(transport.bulks).count(b'Test async close'), 10)
+        self.assertTrue(transport.closed)
+
+    def test_block_policy_is_refused(self):
+        with self.assertRaises(LogzioException):
+            AsyncLogzioSender(token='token', overflow_policy='block',
+                              transport=FakeTransport())
+
+
+class TestAsyncLogzioHandler(TestCase):
+    def setUp(self):
+        self.logzio_listener = listener.MockLogzioListener()
+        self.logzio_listener.clear_logs_buffer()
+        self.logzio_listener.clear_server_error()
+        self.handler = AsyncLogzioHandler(
+            'token',
+            url="http://" + self.logzio_listener.get_host() + ":" + str(self.logzio_listener.get_port()),
+            logs_drain_timeout=60,
+            transport=RequestsTransport())
+        self.logger = logging.getLogger('test_async')
+        self.logger.addHandler(self.handler)
+        self.logger.setLevel(logging.INFO)
+
+    def tearDown(self):
+        self.logger.removeHandler(self.handler)
+
+    def test_aflush(self):
+        async def main():
+            self.logger.info('Test async handler')
+            await self.handler.aflush()
+            await self.handler.aclose()
+
+        asyncio.run(main())
+        self.assertTrue(self.logzio_listener.find_log('Test async handler'))
+
+    def test_flush_from_another_thread(self):
+        loop = asyncio.new_event_loop()
+        loop_thread = threading.Thread(target=loop.run_forever, daemon=True)
+        loop_thread.start()
+
+        async def log(message):
+            self.logger.info(message)
+
+        asyncio.run_coroutine_threadsafe(
+            log('Test flush from thread'), loop).result(5)
+        self.assertTrue(self.handler.flush(timeout=5))
+        self.assertTrue(self.logzio_listener.find_log('Test flush from thread'))
+
+        asyncio.run_coroutine_threadsafe(
+            log('Test flush_async from thread'), loop).result(5)
+        self.assertTrue(self.handler.flush_async(timeout=5).result(5))
+        self.assertTrue(
+            self.logzio_listener.find_log('Test flush_async from thread'))
+
+        asyncio.run_coroutine_threadsafe(self.handler.aclose(),
+                                         loop).result(5)
+        loop.call_soon_threadsafe(loop.stop)
+        loop_thread.join()
+        loop.close()
+
+    def test_flush_async_without_running_loop(self):
+        self.logger.info('Test flush_async without loop')
+        self.assertTrue(self.handler.flush_async(timeout=5).result(5))
+        self.assertTrue(
+            self.logzio_listener.find_log('Test flush_async without loop'))
+
+    def test_flush_without_running_loop_is_bounded(self):
+        class HangingTransport(FakeTransport):
+            async def post(self, url, headers, data, timeout):
+                self.bulks.append(data)
+                await asyncio.sleep(60)
+
+        transport = HangingTransport()
+        handler = AsyncLogzioHandler('token', backup_logs=False,
+                                     shutdown_timeout=0.2,
+                                     transport=transport)
+        handler.emit(logging.makeLogRecord({'msg': 'Test hanging flush'}))
+
+        started = time.monotonic()
+        self.assertFalse(handler.flush())
+        self.assertLess(time.monotonic() - started, 5)
+        self.assertEqual(len(transport.bulks), 1)
+
+    def test_close_without_running_loop(self):
+        self.logger.info('Test async handler close')
+        self.handler.close()
+
+        self.assertTrue(self.logzio_listener.find_log('Test async handler close'))
@@ -0,0 +1,81 @@
+import logging
+import sys
+import time
+from unittest import TestCase
+from unittest.mock import patch
+
+from logzio.handler import LogzioHandler
+
+
+class TestLogzioHandlerDedup(TestCase):
+    def setUp(self):
+        self.handler = LogzioHandler('moo', dedup_window=0.3,
+                                     dedup_max_keys=2)
+        self.appended = []
+        self.handler.logzio_sender.append = self.appended.append
+        self.logger = logging.getLogger('dedup-test')
+        self.logger.propagate = False
+        self.logger.setLevel(logging.INFO)
+        self.logger.addHandler(self.handler)
+
+    def tearDown(self):
+        self.logger.removeHandler(self.handler)
+
+    def _fail(self, order_id):
+        try:
+            raise ValueError('Payment declined')
+        except ValueError:
+            self.logger.exception('Order %s failed', order_id)
+
+    def test_repeats_are_summarized_after_the_window(self):
+        # The window doesn't end while the records are logged, however
+        # long that takes
+        with patch('logzio.dedup.monotonic', return_value=time.monotonic()):
+            for order_id in range(1000):
+                self._fail(order_id)
+            self.logger.info('Test other')
+
+        self.assertEqual([log['message'] for log in self.appended],
+                         ['Order 0 failed', 'Test other'])
+        # Shipped by a timer once the window is over
+        for _ in range(20):
+            if len(self.appended) == 3:
+                break
+            time.sleep(0.1)
+        summary = self.appended[2]
+        self.assertEqual(summary['message'], 'Order 999 failed')
+        self.assertEqual(summary['repeat_count'], 999)
+        self.assertEqual(summary['repeated_args'],
+                         ['(1,)', '(2,)', '(3,)', '(4,)', '(5,)'])
+        self.assertLessEqual(summary['first_timestamp'],
+                             summary['last_timestamp'])
+        self.assertIn('ValueError: Payment declined', summary['exception'])
+
+        self._fail(1000)
+        self.assertEqual(self.appended[3]['message'], 'Order 1000 failed')
+
+    def test_different_records_are_not_merged(self):
+        self.logger.info('Test %s', 'first')
+        self.logger.warning('Test %s', 'first')
+        self._fail(1)
+        self.logger.info('Test %s', 'second')
+
+        self.assertEqual(len(self.appended), 4)
+
+    def test_oldest_window_is_closed_for_new_fingerprints(self):
+        for _ in range(2):
+            self.logger.info('Test first')
+        self.logger.info('Test second')
+        self.logger.info('Test third')
+
+        self.assertEqual(
+            [(log['message'], log.get('repeat_count')) for log in self.appended],
+            [('Test first', None), ('Test second', None),
+             ('Test first', 1), ('Test third', None)])
+
+    def test_flush_ships_summaries(self):
+        for _ in range(3):
+            self.logger.info('Test flushed')
+        self.handler.flush()
+
+        self.assertEqual(self.appended[-1]['repeat_count'], 2)
@@ -0,0 +1,113 @@
+import datetime
+import json
+import logging
+import uuid
+from unittest import TestCase, skipUnless
+from unittest.mock import patch
+
+from logzio.encoder import (ENCODERS, OrjsonEncoder, StdlibEncoder,
+                            TypeDispatcher, get_encoder)
+from logzio.exceptions import LogzioException
+from logzio.handler import LogzioHandler
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+
+class Unserializable:
+    def __repr__(self):
+        return 'Unserializable()'
+
+
+class EncoderTests:
+    encoder_class = None
+
+    def setUp(self):
+        self.encoder = self.encoder_class()
+
+    def test_utf8_output(self):
+        self.assertEqual(self.encoder.dumps({'message': 'חתול'}),
+                         '{"message":"חתול"}'.encode('utf-8'))
+
+    def test_nested_unserializable_values(self):
+        log = {'extra': {'when': datetime.datetime(2024, 1, 2, 3, 4, 5),
+                         'id': uuid.UUID(int=1),
+                         'tags': {'only'},
+                         'object': [Unserializable()]}}
+        self.assertEqual(json.loads(self.encoder.dumps(log)), {'extra': {
+            'when': '2024-01-02T03:04:05',
+            'id': '00000000-0000-0000-0000-000000000001',
+            'tags': ['only'],
+            'object': ['Unserializable()']}})
+
+    def test_lone_surrogate_is_escaped(self):
+        self.assertEqual(json.loads(self.encoder.dumps({'path': 'a\udcff'})),
+                         {'path': 'a\udcff'})
+
+    def test_big_integer(self):
+        self.assertEqual(json.loads(self.encoder.dumps({'big': 2 ** 70})),
+                         {'big': 2 ** 70})
+
+    def test_loads(self):
+        self.assertEqual(self.encoder.loads('{"key": "value"}'),
+                         {'key': 'value'})
+
+
+class TestStdlibEncoder(EncoderTests, TestCase):
+    encoder_class = StdlibEncoder
+
+
+@skipUnless(orjson, 'orjson is not installed')
+class TestOrjsonEncoder(EncoderTests, TestCase):
+    encoder_class = OrjsonEncoder
+
+
+class TestGetEncoder(TestCase):
+    def test_fastest_installed_encoder_by_default(self):
+        expected = 'orjson' if orjson else None
+        encoder = get_encoder()
+        self.assertIn(encoder.name, ENCODERS)
+        if expected:
+            self.assertEqual(encoder.name, expected)
+
+    def test_encoder_by_name(self):
+        self.assertIsInstance(get_encoder('json'), StdlibEncoder)
+
+    def test_unknown_encoder(self):
+        with self.assertRaises(LogzioException):
+            get_encoder('yaml')
+
+
+class TestTypeDispatcher(TestCase):
+    def test_subclasses_use_registered_converter(self):
+        class Base:
+            pass
+
+        class Child(Base):
+            pass
+
+        dispatcher = TypeDispatcher()
+        self.assertTrue(dispatcher(Child()).startswith('<'))
+        dispatcher.register(Base, lambda value: 'base')
+        self.assertEqual(dispatcher(Child()), 'base')
+
+
+class TestHandlerEncoding(TestCase):
+    @patch('logzio.sender.requests.Session')
+    def test_unserializable_extra_does_not_raise(self, mock_session):
+        mock_session.return_value.post.return_value.status_code = 200
+        handler = LogzioHandler('token', logs_drain_timeout=60,
+                                json_encoder='json')
+        logger = logging.getLogger('test_encoder')
+        logger.addHandler(handler)
+        logger.propagate = False
+
+        logger.warning('Test encoding', extra={'payload': {'object': Unserializable()}})
+        handler.flush()
+        logger.removeHandler(handler)
+        handler.close()
+
+        log = json.loads(mock_session.return_value.post.call_args.kwargs['data'])
+        self.assertEqual(log['payload'], {'object': 'Unserializable()'})
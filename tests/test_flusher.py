@@ -0,0 +1,128 @@
+import asyncio
+import logging
+import threading
+import time
+from concurrent import futures
+from unittest import TestCase
+from unittest.mock import AsyncMock, MagicMock
+
+from logzio.async_handler import AsyncLogzioHandler
+from logzio.flusher import LogzioFlusher
+from logzio.handler import LogzioHandler
+
+
+def _handler(flush_seconds=0):
+    # A LogzioHandler whose flush takes flush_seconds on another thread
+    handler = MagicMock(spec=LogzioHandler)
+    handler.level = logging.NOTSET
+
+    def flush_async(timeout=None):
+        future = futures.Future()
+        threading.Timer(flush_seconds, future.set_result, (True,)).start()
+        return future
+
+    handler.flush_async.side_effect = flush_async
+    return handler
+
+
+class TestLogzioFlusher(TestCase):
+    def setUp(self):
+        self.parent = logging.getLogger('flusher_test')
+        self.logger = logging.getLogger('flusher_test.child')
+        self.handler = _handler()
+        self.parent_handler = _handler()
+        self.other_handler = MagicMock(spec=logging.Handler)
+        self.other_handler.level = logging.NOTSET
+        self.logger.handlers = [self.handler, self.other_handler]
+        self.parent.handlers = [self.parent_handler]
+
+    def tearDown(self):
+        self.logger.handlers = []
+        self.parent.handlers = []
+
+    def test_flushes_logzio_handlers_of_ancestors(self):
+        @LogzioFlusher(self.logger)
+        def function(value):
+            return value * 2
+
+        self.assertEqual(function(21), 42)
+        self.handler.flush_async.assert_called_once()
+        self.parent_handler.flush_async.assert_called_once()
+        self.other_handler.flush.assert_not_called()
+
+    def test_handlers_are_flushed_at_once(self):
+        self.handler.flush_async.side_effect = \
+            _handler(0.3).flush_async.side_effect
+        self.parent_handler.flush_async.side_effect = \
+            _handler(0.3).flush_async.side_effect
+        flusher = LogzioFlusher(self.logger)
+
+        start_time = time.time()
+        self.assertTrue(flusher.flush())
+        self.assertLess(time.time() - start_time, 0.5)
+
+        # A flush that doesn't end is waited for up to the timeout
+        self.handler.flush_async.side_effect = \
+            lambda timeout: futures.Future()
+        flusher.timeout = 0.2
+        start_time = time.time()
+        self.assertFalse(flusher.flush())
+        self.assertLess(time.time() - start_time, 0.4)
+
+    def test_async_handlers_share_the_timeout(self):
+        # Without a running loop, an AsyncLogzioHandler flushes in the
+        # calling thread, up to the timeout it's given
+        def flush_async(timeout=None):
+            time.sleep(timeout)
+            future = futures.Future()
+            future.set_result(False)
+            return future
+
+        async_handlers = [MagicMock(spec=AsyncLogzioHandler)
+                          for _ in range(2)]
+        for async_handler in async_handlers:
+            async_handler.level = logging.NOTSET
+            async_handler.flush_async.side_effect = flush_async
+        self.parent.handlers = async_handlers
+        flusher = LogzioFlusher(self.logger, timeout=0.3)
+
+        start_time = time.time()
+        self.assertFalse(flusher.flush())
+        self.assertLess(time.time() - start_time, 0.5)
+        self.handler.flush_async.assert_called_once()
+
+    def test_generator_is_flushed_once_exhausted(self):
+        @LogzioFlusher(self.logger)
+        def generate():
+            yield 1
+            yield 2
+
+        items = generate()
+        self.assertEqual(next(items), 1)
+        self.handler.flush_async.assert_not_called()
+        self.assertEqual(list(items), [2])
+        self.handler.flush_async.assert_called_once()
+
+    def test_coroutine_function(self):
+        async_handler = MagicMock(spec=AsyncLogzioHandler)
+        async_handler.level = logging.NOTSET
+        async_handler.aflush = AsyncMock()
+        self.parent.handlers = [async_handler]
+
+        @LogzioFlusher(self.logger)
+        async def function():
+            await asyncio.sleep(0)
+            raise ValueError('Test coroutine failure')
+
+        with self.assertRaises(ValueError):
+            asyncio.run(function())
+        async_handler.aflush.assert_awaited_once()
+        self.handler.flush_async.assert_called_once()
+
+    def test_context_manager(self):
+        with self.assertRaises(ValueError):
+            with LogzioFlusher(self.logger):
+                raise ValueError('Test block failure')
+        self.handler.flush_async.assert_called_once()
+        self.assertAlmostEqual(self.handler.flush_async.call_args[0][0],
+                               10.0, places=1)
@@ -0,0 +1,124 @@
+import logging
+import sys
+from unittest import TestCase
+from unittest.mock import Mock
+
+from logzio.formatting import (LegacyPlan, MessagePlan, PlainTextPlan,
+                               RenderedPlan, StaticPlan, TemplatePlan,
+                               compile_format_plan)
+from logzio.handler import LogzioHandler
+
+
+def _record(msg='this is a test: moo.', exc_info=None):
+    return logging.LogRecord(name='my-logger', level=logging.INFO,
+                             pathname='handler_test.py', lineno=10, msg=msg,
+                             args=(), exc_info=exc_info, func='test_format')
+
+
+class TestCompileFormatPlan(TestCase):
+    def test_plans(self):
+        self.assertIsInstance(compile_format_plan(None), MessagePlan)
+        self.assertIsInstance(
+            compile_format_plan(logging.Formatter('%(message)s')),
+            MessagePlan)
+        self.assertIsInstance(
+            compile_format_plan(logging.Formatter('{"app": "moo"}',
+                                                  validate=False)),
+            StaticPlan)
+        self.assertIsInstance(
+            compile_format_plan(logging.Formatter(
+                '{{"logger": "{name}", "text": "{message}"}}', style='{')),
+            TemplatePlan)
+        self.assertIsInstance(
+            compile_format_plan(logging.Formatter(
+                '%(asctime)s %(levelname)s %(message)s')),
+            PlainTextPlan)
+        # Placeholders outside string values can render anything
+        self.assertIsInstance(
+            compile_format_plan(logging.Formatter('{"line": %(lineno)d}')),
+            RenderedPlan)
+        self.assertIsInstance(
+            compile_format_plan(logging.Formatter(
+                '%(name)s - %(levelname)s - %(message)s')),
+            RenderedPlan)
+        self.assertIsInstance(
+            compile_format_plan(logging.Formatter(
+                '[%(levelname)s] %(message)s')),
+            RenderedPlan)
+
+    def test_formatter_subclasses_are_formatted(self):
+        class UpperFormatter(logging.Formatter):
+            def format(self, record):
+                return super().format(record).upper()
+
+        self.assertIsInstance(compile_format_plan(UpperFormatter()),
+                              LegacyPlan)
+
+
+class TestLogzioHandlerFormatting(TestCase):
+    def setUp(self):
+        self.handler = LogzioHandler('moo')
+
+    def test_template_values_are_escaped(self):
+        self.handler.setFormatter(logging.Formatter(
+            '{"severity": "%(levelname)s", "text": "%(message)s 100%%"}'))
+
+        formatted_message = self.handler.format_message(
+            _record('say "moo"\nand\\more'))
+        self.assertEqual(formatted_message['severity'], 'INFO')
+        self.assertEqual(formatted_message['text'],
+                         'say "moo"\nand\\more 100%')
+
+    def test_template_with_exception(self):
+        self.handler.setFormatter(logging.Formatter(
+            '{"appname": "$name"}', style='$'))
+        try:
+            raise ValueError('oops.')
+        except ValueError:
+            exc_info = sys.exc_info()
+
+        formatted_message = self.handler.format_message(
+            _record(exc_info=exc_info))
+        self.assertEqual(formatted_message['appname'], 'my-logger')
+        self.assertEqual(formatted_message['message'], 'this is a test: moo.')
+        self.assertIn('ValueError: oops.', formatted_message['exception'])
+
+    def test_plain_text_is_not_parsed(self):
+        loads = self.handler.logzio_sender.encoder.loads = Mock()
+        self.handler.setFormatter(logging.Formatter(
+            '%(levelname)s %(message)s'))
+
+        formatted_message = self.handler.format_message(_record('{"a": 1}'))
+        self.assertEqual(formatted_message['message'], 'INFO {"a": 1}')
+        loads.assert_not_called()
+
+    def test_rendered_text_is_parsed_only_if_it_starts_like_json(self):
+        encoder = self.handler.logzio_sender.encoder
+        loads = encoder.loads = Mock(side_effect=encoder.loads)
+        self.handler.setFormatter(logging.Formatter(
+            '%(name)s - %(message)s'))
+
+        formatted_message = self.handler.format_message(_record())
+        self.assertEqual(formatted_message['message'],
+                         'my-logger - this is a test: moo.')
+        loads.assert_not_called()
+
+        # The logger name may well be a number
+        formatted_message = self.handler.format_message(logging.LogRecord(
+            name='[1]', level=logging.INFO, pathname='handler_test.py',
+            lineno=10, msg='moo', args=(), exc_info=None))
+        self.assertEqual(formatted_message['message'], '[1] - moo')
+        loads.assert_called_once()
+
+    def test_json_message(self):
+        formatted_message = self.handler.format_message(
+            _record('{"user": "moo"}'))
+        self.assertEqual(formatted_message['user'], 'moo')
+
+    def test_replaced_formatter_is_compiled(self):
+        self.handler.setFormatter(logging.Formatter('%(message)s'))
+        self.handler.formatter = logging.Formatter('{"app": "moo"}',
+                                                   validate=False)
+
+        formatted_message = self.handler.format_message(_record())
+        self.assertEqual(formatted_message['app'], 'moo')
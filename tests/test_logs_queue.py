@@ -0,0 +1,166 @@
+import threading
+import time
+from unittest import TestCase
+
+from logzio.exceptions import LogzioException
+from logzio.logs_queue import LogsQueue
+
+
+class TestLogsQueue(TestCase):
+
+    def _drain(self, logs_queue):
+        logs = []
+        while not logs_queue.empty():
+            logs.append(logs_queue.get(block=False))
+        return logs
+
+    def test_unbounded_by_default(self):
+        logs_queue = LogsQueue()
+        for i in range(1000):
+            self.assertTrue(logs_queue.put('log {}'.format(i)))
+
+        self.assertEqual(logs_queue.qsize(), 1000)
+        self.assertEqual(logs_queue.dropped, 0)
+
+    def test_bytes_are_tracked(self):
+        logs_queue = LogsQueue()
+        logs_queue.put('12345')
+        logs_queue.put('123')
+        self.assertEqual(logs_queue.bytes, 8)
+
+        logs_queue.get(block=False)
+        self.assertEqual(logs_queue.bytes, 3)
+
+    def test_drop_newest(self):
+        logs_queue = LogsQueue(max_size=2)
+        logs_queue.put('first')
+        logs_queue.put('second')
+        self.assertFalse(logs_queue.put('third'))
+
+        self.assertEqual(self._drain(logs_queue), ['first', 'second'])
+        self.assertEqual(logs_queue.dropped, 1)
+
+    def test_drop_oldest(self):
+        logs_queue = LogsQueue(max_size=2, overflow_policy='drop_oldest')
+        for log in ('first', 'second', 'third'):
+            self.assertTrue(logs_queue.put(log))
+
+        self.assertEqual(self._drain(logs_queue), ['second', 'third'])
+        self.assertEqual(logs_queue.dropped, 1)
+
+    def test_max_bytes(self):
+        logs_queue = LogsQueue(max_bytes=10, overflow_policy='drop_oldest')
+        logs_queue.put('aaaa')
+        logs_queue.put('bbbb')
+        logs_queue.put('cccccc')
+
+        self.assertEqual(self._drain(logs_queue), ['bbbb', 'cccccc'])
+        self.assertEqual(logs_queue.dropped, 1)
+
+    def test_log_bigger_than_max_bytes_fits_empty_queue(self):
+        logs_queue = LogsQueue(max_bytes=4)
+        self.assertTrue(logs_queue.put('too big for the queue'))
+        self.assertFalse(logs_queue.put('more'))
+        self.assertEqual(logs_queue.dropped, 1)
+
+    def test_block_times_out(self):
+        logs_queue = LogsQueue(max_size=1, overflow_policy='block',
+                               block_timeout=0.1)
+        logs_queue.put('first')
+
+        start_time = time.time()
+        self.assertFalse(logs_queue.put('second'))
+        self.assertGreaterEqual(time.time() - start_time, 0.1)
+        self.assertEqual(logs_queue.dropped, 1)
+
+    def test_block_waits_for_room(self):
+        logs_queue = LogsQueue(max_size=1, overflow_policy='block',
+                               block_timeout=5)
+        logs_queue.put('first')
+        consumer = threading.Timer(0.1, logs_queue.get)
+        consumer.start()
+
+        self.assertTrue(logs_queue.put('second'))
+        consumer.join()
+        self.assertEqual(self._drain(logs_queue), ['second'])
+        self.assertEqual(logs_queue.dropped, 0)
+
+    def test_spill(self):
+        spilled = []
+        logs_queue = LogsQueue(max_size=1, overflow_policy='spill',
+                               spill_function=spilled.extend)
+        logs_queue.put('first')
+        self.assertFalse(logs_queue.put('second'))
+
+        self.assertEqual(spilled, ['second'])
+        self.assertEqual(self._drain(logs_queue), ['first'])
+        self.assertEqual(logs_queue.dropped, 1)
+        self.assertEqual(logs_queue.spilled, 1)
+
+    def test_unknown_policy(self):
+        with self.assertRaises(LogzioException):
+            LogsQueue(overflow_policy='drop_everything')
+
+    def test_get_bulk_cuts_on_exact_size(self):
+        logs_queue = LogsQueue()
+        for _ in range(5):
+            logs_queue.put(b'x' * 9)
+
+        # Three 9 bytes logs and their two separating newlines are 29 bytes
+        self.assertEqual(len(logs_queue.get_bulk(29)), 3)
+        self.assertEqual(len(logs_queue.get_bulk(18)), 1)
+        self.assertEqual(len(logs_queue.get_bulk(29)), 1)
+        self.assertEqual(logs_queue.get_bulk(29), [])
+        self.assertEqual(logs_queue.bytes, 0)
+
+    def test_get_bulk_returns_oversized_log(self):
+        logs_queue = LogsQueue()
+        logs_queue.put(b'x' * 100)
+        logs_queue.put(b'y')
+
+        self.assertEqual(logs_queue.get_bulk(10), [b'x' * 100])
+        self.assertEqual(logs_queue.get_bulk(10), [b'y'])
+
+    def test_wait_for_bulk_times_out_on_empty_queue(self):
+        logs_queue = LogsQueue(bulk_size=100)
+        self.assertFalse(logs_queue.wait_for_bulk(linger=0, timeout=0.05))
+
+    def test_wait_for_bulk_returns_on_full_bulk(self):
+        logs_queue = LogsQueue(bulk_size=29)
+        producer = threading.Timer(
+            0.05, lambda: [logs_queue.put(b'x' * 9) for _ in range(3)])
+        producer.start()
+
+        start_time = time.time()
+        self.assertTrue(logs_queue.wait_for_bulk(linger=60, timeout=5))
+        self.assertLess(time.time() - start_time, 1)
+        producer.join()
+
+    def test_wait_for_bulk_returns_on_full_queue(self):
+        logs_queue = LogsQueue(max_bytes=20, bulk_size=1000)
+        logs_queue.put(b'x' * 15)
+        self.assertFalse(logs_queue.bulk_ready(linger=60))
+
+        # A log that doesn't fit makes the queued ones worth sending
+        logs_queue.put(b'y' * 10)
+        self.assertTrue(logs_queue.bulk_ready(linger=60))
+        logs_queue.get_bulk()
+        self.assertFalse(logs_queue.bulk_ready(linger=60))
+
+    def test_wait_for_bulk_returns_after_linger(self):
+        logs_queue = LogsQueue(bulk_size=1000)
+        logs_queue.put(b'lonely log')
+
+        start_time = time.time()
+        self.assertFalse(logs_queue.bulk_ready(linger=0.1))
+        self.assertTrue(logs_queue.wait_for_bulk(linger=0.1, timeout=5))
+        self.assertGreaterEqual(time.time() - start_time, 0.09)
+        self.assertTrue(logs_queue.bulk_ready(linger=0.1))
+
+    def test_wake(self):
+        logs_queue = LogsQueue(bulk_size=1000)
+        waker = threading.Timer(0.05, logs_queue.wake)
+        waker.start()
+
+        self.assertTrue(logs_queue.wait_for_bulk(linger=60, timeout=5))
+        waker.join()
@@ -2,7 +2,10 @@ import logging
 import os
 import re
 import sys
+import threading
+import time
 from unittest import TestCase
+from unittest.mock import patch
 
 from logzio.handler import LogzioHandler
 
@@ -186,3 +189,99 @@ class TestLogzioHandler(TestCase):
             },
             formatted_message
         )
+
+    def test_allowed_and_denied_extra_fields(self):
+        record = logging.LogRecord(
+            name='my-logger',
+            level=0,
+            pathname='handler_test.py',
+            lineno=10,
+            msg="this is a test: moo.",
+            args=[],
+            exc_info=None,
+            func='test_json'
+        )
+        record.__dict__.update(user='moo', request={'id': 1},
+                               session=object(), password='secret')
+
+        denied_handler = LogzioHandler('moo', denied_extra_fields=['password'])
+        extra_fields = self._remove_version_specific_fields(
+            denied_handler.extra_fields(record))
+        self.assertEqual(set(extra_fields), {'user', 'request', 'session'})
+        self.assertEqual(extra_fields['session'], repr(record.session))
+
+        allowed_handler = LogzioHandler('moo',
+                                        allowed_extra_fields=['user', 'lineno'])
+        self.assertEqual(allowed_handler.extra_fields(record), {'user': 'moo'})
+        # Cached by the attributes of the record
+        del record.user
+        self.assertEqual(allowed_handler.extra_fields(record), {})
+
+
+class TestLogzioHandlerDeferredFormatting(TestCase):
+    @patch('logzio.sender.requests.Session')
+    def test_records_are_formatted_by_the_sending_thread(self, mock_session):
+        mock_session.return_value.post.return_value.status_code = 200
+        handler = LogzioHandler('moo', defer_formatting=True)
+        formatting_threads = []
+        format_message = handler.format_message
+
+        def recording_format_message(record):
+            formatting_threads.append(threading.current_thread())
+            return format_message(record)
+
+        handler.format_message = recording_format_message
+        users = ['moo']
+        record = logging.LogRecord('my-logger', logging.INFO, 'test.py', 10,
+                                   'users: %s', (users,), None)
+        handler.emit(record)
+        # The message was resolved by emit
+        users.append('cow')
+        for _ in range(50):
+            if handler.logzio_sender.queue.qsize():
+                break
+            time.sleep(0.1)
+        handler.flush()
+
+        self.assertIn(b"users: ['moo']",
+                      mock_session.return_value.post.call_args.kwargs['data'])
+        self.assertEqual(formatting_threads,
+                         [handler.logzio_sender.sending_thread])
+        self.assertTrue(handler.logzio_sender.shutdown())
+
+    @patch('logzio.sender.requests.Session')
+    def test_records_are_formatted_right_away_when_too_many_wait(
+            self, mock_session):
+        handler = LogzioHandler('moo', defer_formatting=True,
+                                max_queue_size=1, backup_logs=False)
+        # Keeps the sending thread from building the deferred log
+        with handler.logzio_sender._flush_lock:
+            handler.emit(logging.LogRecord('my-logger', logging.INFO,
+                                           'test.py', 10, 'first', (), None))
+            handler.emit(logging.LogRecord('my-logger', logging.INFO,
+                                           'test.py', 10, 'second', (), None))
+
+            self.assertEqual(len(handler.logzio_sender._deferred), 1)
+            self.assertEqual(handler.logzio_sender.queue.qsize(), 1)
+        handler.logzio_sender.shutdown(timeout=0)
+
+    @patch('logzio.sender.requests.Session')
+    def test_deferred_records_do_not_block_the_sending_thread(
+            self, mock_session):
+        post = mock_session.return_value.post
+        post.return_value.status_code = 200
+        handler = LogzioHandler('moo', defer_formatting=True,
+                                max_queue_size=5, overflow_policy='block',
+                                overflow_block_timeout=0.5)
+        start_time = time.time()
+        for counter in range(12):
+            handler.emit(logging.LogRecord(
+                'my-logger', logging.INFO, 'test.py', 10,
+                'Test deferred %s', (counter,), None))
+        self.assertTrue(handler.flush())
+
+        self.assertLess(time.time() - start_time, 0.5)
+        self.assertEqual(handler.logzio_sender.dropped_logs, 0)
+        self.assertEqual(sum(len(call.kwargs['data'].split(b'\n'))
+                             for call in post.call_args_list), 12)
+        self.assertTrue(handler.logzio_sender.shutdown())
@@ -1,8 +1,17 @@
 import fnmatch
+import gzip
 import logging.config
 import os
+import subprocess
+import sys
+import threading
 import time
-from unittest import TestCase
+from unittest import TestCase, skipIf
+from unittest.mock import MagicMock, patch
+
+from logzio.exceptions import LogzioException
+from logzio.handler import LogzioHandler
+from logzio.sender import LogzioSender, retry_after
 
 from .mockLogzioListener import listener
 
@@ -104,7 +113,8 @@ class TestLogzioSender(TestCase):
         # Make sure no file is present
         self.assertEqual(len(_find("logzio-failures-*.txt", ".")), 0)
 
-        time.sleep(self.retries_no * self.retry_timeout * 2 * 2)  # All of the retries
+        # All of the retries, backing off exponentially
+        time.sleep(self.logs_drain_timeout + self.retry_timeout * (2 ** (self.retries_no - 1) - 1) + 3)
 
         failure_files = _find("logzio-failures-*.txt", ".")
         self.assertEqual(len(failure_files), 1)
@@ -122,7 +132,8 @@ class TestLogzioSender(TestCase):
         # Make sure no file is present
         self.assertEqual(len(_find("logzio-failures-*.txt", ".")), 0)
 
-        time.sleep(self.retries_no * self.retry_timeout * 2 * 2)  # All of the retries
+        # All of the retries, backing off exponentially
+        time.sleep(self.logs_drain_timeout + self.retry_timeout * (2 ** (self.retries_no - 1) - 1) + 3)
 
         # Make sure no file was created
         self.assertEqual(len(_find("logzio-failures-*.txt", ".")), 0)
@@ -147,3 +158,490 @@ class TestLogzioSender(TestCase):
         # Ensure listener receive all log messages
         self.assertTrue(self.logzio_listener.find_log(child_log_message))
         self.assertTrue(self.logzio_listener.find_log(parent_log_message))
+
+
+class TestLogzioSenderCompression(TestCase):
+    def setUp(self):
+        self.logzio_listener = listener.MockLogzioListener()
+        self.logzio_listener.clear_logs_buffer()
+        self.logzio_listener.clear_server_error()
+        self.sender = LogzioSender(
+            token='token',
+            url="http://" + self.logzio_listener.get_host() + ":" + str(self.logzio_listener.get_port()),
+            logs_drain_timeout=60,
+            compression='gzip',
+            compression_level=1)
+
+    def test_compressed_logs_drain(self):
+        for counter in range(100):
+            self.sender.append({'message': 'Test compressed log ' + str(counter)})
+        self.sender.flush()
+
+        self.assertEqual(self.logzio_listener.get_number_of_logs(), 100)
+        self.assertTrue(self.logzio_listener.find_log('Test compressed log 99'))
+        self.assertGreater(self.sender.compression_ratio, 1)
+
+    def test_content_encoding_header(self):
+        with patch.object(self.sender.requests_session, 'post') as post:
+            post.return_value.status_code = 200
+            self.sender.append({'message': 'Test content encoding'})
+            self.sender.flush()
+
+        headers = post.call_args.kwargs['headers']
+        self.assertEqual(headers['Content-Encoding'], 'gzip')
+        body = gzip.decompress(post.call_args.kwargs['data'])
+        self.assertIn(b'Test content encoding', body)
+
+    def test_unsupported_compression(self):
+        with self.assertRaises(LogzioException):
+            LogzioSender(token='token', compression='brotli')
+
+
+class TestLogzioSenderBulkSize(TestCase):
+    @patch('logzio.sender.requests.Session')
+    def test_bulks_are_cut_on_wire_size(self, mock_session):
+        mock_session.return_value.post.return_value.status_code = 200
+        sender = LogzioSender(token='token', logs_drain_timeout=60,
+                              bulk_size_in_bytes=1000)
+        for counter in range(50):
+            sender.append({'message': 'חתול שחור {:03d}'.format(counter)})
+        sender.flush()
+
+        bulks = [call.kwargs['data'] for call in mock_session.return_value.post.call_args_list]
+        self.assertEqual(sum(len(bulk.split(b'\n')) for bulk in bulks), 50)
+        for bulk in bulks:
+            self.assertLessEqual(len(bulk), 1000)
+        # Bulks are filled up to the limit, not cut early
+        self.assertGreater(len(bulks[0]), 1000 - len(bulks[-1].split(b'\n')[0]) - 1)
+
+
+class TestLogzioSenderDrainTriggers(TestCase):
+    @patch('logzio.sender.requests.Session')
+    def test_log_is_sent_after_linger(self, mock_session):
+        post = mock_session.return_value.post
+        post.return_value.status_code = 200
+        sender = LogzioSender(token='token', logs_drain_timeout=60,
+                              linger_ms=100)
+        sender.append({'message': 'Test linger'})
+        time.sleep(0.5)
+
+        self.assertEqual(post.call_count, 1)
+        self.assertIn(b'Test linger', post.call_args.kwargs['data'])
+
+    @patch('logzio.sender.requests.Session')
+    def test_full_bulk_is_sent_right_away(self, mock_session):
+        post = mock_session.return_value.post
+        post.return_value.status_code = 200
+        sender = LogzioSender(token='token', logs_drain_timeout=60,
+                              linger_ms=60000, bulk_size_in_bytes=1000)
+        for counter in range(40):
+            sender.append({'message': 'Test full bulk {:02d}'.format(counter)})
+        time.sleep(0.5)
+
+        # Only full bulks are sent, the remainder keeps lingering
+        self.assertGreaterEqual(post.call_count, 1)
+        self.assertFalse(sender.queue.empty())
+        for call in post.call_args_list:
+            self.assertGreater(len(call.kwargs['data']), 900)
+
+    @patch('logzio.sender.requests.Session')
+    def test_full_queue_is_sent_right_away(self, mock_session):
+        post = mock_session.return_value.post
+        post.return_value.status_code = 200
+        sender = LogzioSender(token='token', logs_drain_timeout=60,
+                              max_queue_size=10, overflow_policy='block',
+                              overflow_block_timeout=1)
+        start_time = time.time()
+        for counter in range(20):
+            sender.append({'message': 'Test full queue {}'.format(counter)})
+
+        # Blocked logs are let in once the queue is sent, before the linger
+        # time or the block timeout pass
+        self.assertLess(time.time() - start_time, 1)
+        self.assertEqual(sender.dropped_logs, 0)
+        self.assertTrue(sender.shutdown())
+        self.assertEqual(sum(len(call.kwargs['data'].split(b'\n'))
+                             for call in post.call_args_list), 20)
+
+
+class TestLogzioSenderShutdown(TestCase):
+    @patch('logzio.sender.requests.Session')
+    def test_shutdown_drains_queue_right_away(self, mock_session):
+        post = mock_session.return_value.post
+        post.return_value.status_code = 200
+        sender = LogzioSender(token='token', logs_drain_timeout=60)
+        sender.append({'message': 'Test shutdown'})
+
+        start_time = time.time()
+        self.assertTrue(sender.shutdown(timeout=5))
+        self.assertLess(time.time() - start_time, 1)
+        self.assertFalse(sender.sending_thread.is_alive())
+        self.assertIn(b'Test shutdown', post.call_args.kwargs['data'])
+
+    @patch('logzio.sender.requests.Session')
+    def test_shutdown_is_bounded_by_timeout(self, mock_session):
+        mock_session.return_value.post.side_effect = Exception('Listener is down')
+        sender = LogzioSender(token='token', logs_drain_timeout=60,
+                              backup_logs=False, number_of_retries=4,
+                              retry_timeout=2)
+        sender.append({'message': 'Test shutdown deadline'})
+
+        start_time = time.time()
+        sender.shutdown(timeout=0.5)
+        self.assertLess(time.time() - start_time, 1.5)
+
+    @patch('logzio.sender.requests.Session')
+    def test_handler_close_shuts_down_sender(self, mock_session):
+        mock_session.return_value.post.return_value.status_code = 200
+        handler = LogzioHandler('token', logs_drain_timeout=60)
+        handler.close()
+
+        self.assertFalse(handler.logzio_sender.sending_thread.is_alive())
+
+    def test_process_exits_without_waiting_for_drain_timeout(self):
+        logzio_listener = listener.MockLogzioListener()
+        logzio_listener.clear_logs_buffer()
+        logzio_listener.clear_server_error()
+        script = (
+            "from logzio.sender import LogzioSender\n"
+            "sender = LogzioSender(token='token', url='http://{}:{}', logs_drain_timeout=60)\n"
+            "sender.append({{'message': 'Test exit drain'}})\n"
+        ).format(logzio_listener.get_host(), logzio_listener.get_port())
+
+        start_time = time.time()
+        subprocess.run([sys.executable, '-c', script], check=True, timeout=30)
+        self.assertLess(time.time() - start_time, 5)
+        self.assertTrue(logzio_listener.find_log('Test exit drain'))
+
+
+class TestLogzioSenderFork(TestCase):
+    @skipIf(not hasattr(os, 'fork'), 'fork is not available')
+    def test_logs_queued_before_fork_are_sent_once(self):
+        logzio_listener = listener.MockLogzioListener()
+        logzio_listener.clear_logs_buffer()
+        logzio_listener.clear_server_error()
+        sender = LogzioSender(
+            token='token', logs_drain_timeout=60,
+            url='http://{}:{}'.format(logzio_listener.get_host(),
+                                      logzio_listener.get_port()))
+        sender.append({'message': 'Test queued before fork'})
+
+        children = []
+        # As if the sending thread was flushing while the process forked
+        with sender._flush_lock:
+            for counter in range(3):
+                pid = os.fork()
+                if pid == 0:
+                    sender.append({'message': 'Test child {}'.format(counter)})
+                    os._exit(0 if sender.shutdown(timeout=10) else 1)
+                children.append(pid)
+        for pid in children:
+            _, status = os.waitpid(pid, 0)
+            self.assertEqual(os.WEXITSTATUS(status), 0)
+        self.assertTrue(sender.shutdown())
+
+        for log in ('Test queued before fork', 'Test child 0', 'Test child 1',
+                    'Test child 2'):
+            self.assertEqual(
+                sum(log in sent_log for sent_log in logzio_listener.logs_list),
+                1, log)
+
+    @skipIf(not hasattr(os, 'fork'), 'fork is not available')
+    def test_record_summaries_are_shipped_once(self):
+        logzio_listener = listener.MockLogzioListener()
+        logzio_listener.clear_logs_buffer()
+        logzio_listener.clear_server_error()
+        handler = LogzioHandler(
+            'token', logs_drain_timeout=60, dedup_window=30,
+            sampling_rules=[{'logger': 'fork-test.sampled',
+                             'max_per_second': 1}],
+            url='http://{}:{}'.format(logzio_listener.get_host(),
+                                      logzio_listener.get_port()))
+        logger = logging.getLogger('fork-test')
+        logger.propagate = False
+        logger.setLevel(logging.INFO)
+        logger.addHandler(handler)
+        self.addCleanup(logger.removeHandler, handler)
+        for _ in range(3):
+            logger.error('Test repeated')
+            logging.getLogger('fork-test.sampled').info('Test sampled')
+
+        # As if other threads were logging while the process forked
+        with handler._deduplicator._lock, handler._sampler.rules[0]._lock:
+            pid = os.fork()
+            if pid == 0:
+                # Repeats are still collapsed in the child
+                for _ in range(2):
+                    logger.error('Test child repeated')
+                os._exit(0 if handler.flush(timeout=10) else 1)
+        _, status = os.waitpid(pid, 0)
+        self.assertEqual(os.WEXITSTATUS(status), 0)
+        self.assertTrue(handler.flush(timeout=10))
+        handler.close()
+
+        summaries = [log for log in logzio_listener.logs_list
+                     if 'repeat_count' in log]
+        self.assertEqual(len(summaries), 2)
+        self.assertEqual(sum('Test repeated' in log for log in summaries), 1)
+        self.assertEqual(
+            sum('Test child repeated' in log for log in summaries), 1)
+        self.assertEqual(sum('suppressed_records' in log
+                             for log in logzio_listener.logs_list), 1)
+
+
+def _response(status_code, headers=None):
+    response = MagicMock()
+    response.status_code = status_code
+    response.headers = headers or {}
+    return response
+
+
+class TestLogzioSenderRetries(TestCase):
+    @patch('logzio.sender.requests.Session')
+    def test_flush_does_not_wait_for_retries(self, mock_session):
+        post = mock_session.return_value.post
+        post.return_value = _response(500)
+        sender = LogzioSender(token='token', logs_drain_timeout=60,
+                              backup_logs=False, retry_timeout=0.2)
+        sender.append({'message': 'Test retries'})
+
+        start_time = time.time()
+        sender.flush()
+        self.assertLess(time.time() - start_time, 0.1)
+        self.assertEqual(post.call_count, 1)
+
+        # The sending thread tries again once the backoff is over
+        post.return_value = _response(200)
+        time.sleep(0.5)
+        self.assertEqual(post.call_count, 2)
+        self.assertTrue(sender.shutdown())
+
+    def test_exponential_backoff(self):
+        sender = LogzioSender(token='token', retry_timeout=1,
+                              max_retry_timeout=5)
+        for current_try, low, high in ((0, 0.5, 1), (2, 2, 4), (5, 2.5, 5)):
+            for _ in range(20):
+                self.assertTrue(low <= sender._backoff(current_try) <= high)
+        sender.shutdown()
+
+    @patch('logzio.sender.requests.Session')
+    def test_retry_after_is_honoured(self, mock_session):
+        post = mock_session.return_value.post
+        post.return_value = _response(429, {'Retry-After': '0.2'})
+        sender = LogzioSender(token='token', logs_drain_timeout=60,
+                              backup_logs=False, retry_timeout=60)
+        sender.append({'message': 'Test retry after'})
+        sender.flush()
+
+        post.return_value = _response(200)
+        time.sleep(0.5)
+        self.assertEqual(post.call_count, 2)
+        sender.shutdown()
+
+    def test_retry_after_http_date(self):
+        response = _response(503, {'Retry-After': 'Wed, 21 Oct 2015 07:28:00 GMT'})
+        self.assertEqual(retry_after(response), 0)
+        self.assertIsNone(retry_after(_response(500, {'Retry-After': '10'})))
+
+    @patch('logzio.sender.requests.Session')
+    def test_circuit_breaker(self, mock_session):
+        post = mock_session.return_value.post
+        post.return_value = _response(500)
+        sender = LogzioSender(token='token', logs_drain_timeout=60,
+                              backup_logs=False, number_of_retries=1,
+                              circuit_breaker_threshold=2,
+                              circuit_breaker_cooldown=0.3)
+        for counter in range(2):
+            sender.append({'message': 'Test breaker {}'.format(counter)})
+            sender.flush()
+        self.assertEqual(post.call_count, 2)
+
+        # Open, logs are held back without trying to send them
+        sender.append({'message': 'Test breaker held back'})
+        sender.flush()
+        self.assertEqual(post.call_count, 2)
+        self.assertFalse(sender.queue.empty())
+
+        # Closed again after the cool-down
+        post.return_value = _response(200)
+        time.sleep(0.5)
+        sender.flush()
+        self.assertEqual(post.call_count, 3)
+        self.assertIn(b'Test breaker held back', post.call_args.kwargs['data'])
+        sender.shutdown()
+
+
+class TestLogzioSenderInFlight(TestCase):
+    @patch('logzio.sender.requests.Session')
+    def test_bulks_are_uploaded_concurrently(self, mock_session):
+        lock = threading.Lock()
+        concurrency = {'current': 0, 'max': 0}
+
+        def slow_post(*args, **kwargs):
+            with lock:
+                concurrency['current'] += 1
+                concurrency['max'] = max(concurrency['max'], concurrency['current'])
+            time.sleep(0.2)
+            with lock:
+                concurrency['current'] -= 1
+            response = MagicMock()
+            response.status_code = 200
+            return response
+
+        mock_session.return_value.post.side_effect = slow_post
+        sender = LogzioSender(token='token', logs_drain_timeout=60,
+                              bulk_size_in_bytes=100, max_in_flight=4)
+        for counter in range(8):
+            sender.append({'message': 'Test in flight {}'.format(counter) + 'x' * 60})
+
+        start_time = time.time()
+        sender.flush()
+
+        # flush() returns once every bulk was uploaded, 4 at a time
+        self.assertEqual(mock_session.return_value.post.call_count, 8)
+        self.assertLess(time.time() - start_time, 1.2)
+        self.assertEqual(concurrency['max'], 4)
+
+    @patch('logzio.sender.requests.Session')
+    def test_connection_pool_fits_in_flight_bulks(self, mock_session):
+        sender = LogzioSender(token='token', logs_drain_timeout=60,
+                              max_in_flight=4)
+        adapter = mock_session.return_value.mount.call_args.args[1]
+        self.assertEqual(adapter._pool_maxsize, 4)
+        sender.shutdown()
+
+
+class TestLogzioSenderFlush(TestCase):
+    @patch('logzio.sender.requests.Session')
+    def test_flush_with_timeout_waits_for_retries(self, mock_session):
+        post = mock_session.return_value.post
+        post.side_effect = [_response(500), _response(200)]
+        sender = LogzioSender(token='token', logs_drain_timeout=60,
+                              backup_logs=False, retry_timeout=0.2)
+        sender.append({'message': 'Test flush retried'})
+
+        self.assertTrue(sender.flush(timeout=2))
+        self.assertEqual(post.call_count, 2)
+        sender.shutdown()
+
+    @patch('logzio.sender.requests.Session')
+    def test_flush_is_bounded_by_timeout(self, mock_session):
+        mock_session.return_value.post.return_value = _response(500)
+        sender = LogzioSender(token='token', logs_drain_timeout=60,
+                              backup_logs=False, retry_timeout=60)
+        sender.append({'message': 'Test flush timeout'})
+
+        start_time = time.time()
+        self.assertFalse(sender.flush(timeout=0.3))
+        self.assertLess(time.time() - start_time, 0.5)
+        sender.shutdown(0)
+
+    @patch('logzio.sender.requests.Session')
+    def test_flush_ignores_logs_queued_meanwhile(self, mock_session):
+        def slow_post(*args, **kwargs):
+            time.sleep(0.01)
+            return _response(200)
+
+        mock_session.return_value.post.side_effect = slow_post
+        sender = LogzioSender(token='token', logs_drain_timeout=60,
+                              backup_logs=False, bulk_size_in_bytes=1)
+        for counter in range(20):
+            sender.append({'message': 'Test before flush {}'.format(counter)})
+
+        # Producers keep logging faster than the bulks are sent
+        producing = threading.Event()
+        producing.set()
+
+        def produce():
+            while producing.is_set():
+                sender.append({'message': 'Test during flush'})
+                time.sleep(0.001)
+
+        producer = threading.Thread(target=produce)
+        producer.start()
+        try:
+            future = sender.flush_async()
+            self.assertTrue(future.result(timeout=5))
+            self.assertTrue(sender.flush(timeout=5))
+        finally:
+            producing.clear()
+            producer.join()
+        sender.shutdown(0)
+
+
+class TestLogzioSenderServerless(TestCase):
+    @patch('logzio.sender.requests.Session')
+    def test_logs_are_sent_by_flush_only(self, mock_session):
+        post = mock_session.return_value.post
+        post.return_value = _response(200)
+        sender = LogzioSender(token='token', logs_drain_timeout=0.01,
+                              serverless=True)
+        sender.append({'message': 'Test serverless'})
+        time.sleep(0.1)
+        self.assertFalse(sender.sending_thread.is_alive())
+        post.assert_not_called()
+
+        self.assertTrue(sender.flush(timeout=1))
+        self.assertEqual(post.call_count, 1)
+        self.assertTrue(sender.shutdown())
+
+    @patch('logzio.sender.requests.Session')
+    def test_failed_bulk_waits_for_next_flush(self, mock_session):
+        post = mock_session.return_value.post
+        post.return_value = _response(500)
+        sender = LogzioSender(token='token', serverless=True,
+                              backup_logs=False, retry_timeout=0.6)
+        sender.append({'message': 'Test next invocation'})
+
+        # The next try isn't due before the deadline
+        start_time = time.time()
+        self.assertFalse(sender.flush(timeout=0.2))
+        self.assertLess(time.time() - start_time, 0.2)
+
+        time.sleep(0.6)
+        post.return_value = _response(200)
+        self.assertTrue(sender.flush(timeout=0.2))
+        self.assertEqual(post.call_count, 2)
+        sender.shutdown()
+
+    @patch('logzio.sender._write_backup_file',
+           side_effect=OSError(30, 'Read-only file system'))
+    @patch('logzio.sender.requests.Session')
+    def test_exhausted_bulks_are_kept_rather_than_backed_up(
+            self, mock_session, write_backup_file):
+        post = mock_session.return_value.post
+        post.side_effect = [_response(500), _response(200)]
+        sender = LogzioSender(token='token', serverless=True,
+                              number_of_retries=1, retry_timeout=0.6,
+                              bulk_size_in_bytes=40)
+        sender.append({'message': 'Test first bulk'})
+        sender.append({'message': 'Test second bulk'})
+
+        self.assertFalse(sender.flush(timeout=0.2))
+        self.assertEqual(post.call_count, 2)
+        write_backup_file.assert_not_called()
+
+        time.sleep(0.6)
+        post.side_effect = None
+        post.return_value = _response(200)
+        self.assertTrue(sender.flush(timeout=0.2))
+        self.assertEqual(post.call_count, 3)
+        self.assertTrue(sender.shutdown())
+
+    @patch('logzio.sender._write_backup_file',
+           side_effect=OSError(30, 'Read-only file system'))
+    @patch('logzio.sender.requests.Session')
+    def test_failed_backup_does_not_stop_the_flush(
+            self, mock_session, write_backup_file):
+        post = mock_session.return_value.post
+        post.side_effect = [_response(500), _response(200)]
+        sender = LogzioSender(token='token', logs_drain_timeout=60,
+                              number_of_retries=1, bulk_size_in_bytes=40)
+        sender.append({'message': 'Test lost bulk'})
+        sender.append({'message': 'Test sent bulk'})
+
+        self.assertTrue(sender.flush())
+        self.assertEqual(post.call_count, 2)
+        write_backup_file.assert_called_once()
+        self.assertEqual(sender.stats()['counters']['bulks_backed_up'], 0)
+        sender.shutdown()
@@ -0,0 +1,74 @@
+import time
+from unittest import TestCase
+
+from logzio.sender import LogzioSender
+
+from .mockLogzioListener import listener
+
+
+class TestMockLogzioListenerFaults(TestCase):
+    def setUp(self):
+        self.logzio_listener = listener.MockLogzioListener()
+        self.logzio_listener.clear_logs_buffer()
+        self.logzio_listener.clear_server_error()
+
+    def tearDown(self):
+        self.logzio_listener.stop()
+
+    def _sender(self, **options):
+        return LogzioSender(
+            token='token', logs_drain_timeout=60, backup_logs=False,
+            url='http://{}:{}'.format(self.logzio_listener.get_host(),
+                                      self.logzio_listener.get_port()),
+            **options)
+
+    def test_throttled_bulk_is_sent_after_retry_after(self):
+        self.logzio_listener.retry_after = 0.2
+        self.logzio_listener.add_fault(listener.THROTTLE)
+        sender = self._sender(retry_timeout=60)
+        sender.append({'message': 'Test throttled'})
+        sender.flush()
+        self.assertFalse(self.logzio_listener.find_log('Test throttled'))
+
+        time.sleep(0.5)
+        self.assertTrue(self.logzio_listener.find_log('Test throttled'))
+        self.assertEqual(self.logzio_listener.responses[429], 1)
+        sender.shutdown()
+
+    def test_reset_connection_is_retried(self):
+        self.logzio_listener.add_fault(listener.RESET)
+        sender = self._sender(retry_timeout=0.1)
+        sender.append({'message': 'Test reset'})
+        sender.flush()
+
+        time.sleep(0.3)
+        self.assertTrue(self.logzio_listener.find_log('Test reset'))
+        self.assertEqual(self.logzio_listener.responses[None], 1)
+        sender.shutdown()
+
+    def test_partial_bad_request(self):
+        self.logzio_listener.reject_marker = 'malformed'
+        sender = self._sender()
+        sender.append({'message': 'Test well formed'})
+        sender.append({'message': 'Test malformed'})
+        sender.flush()
+
+        self.assertTrue(self.logzio_listener.find_log('Test well formed'))
+        self.assertFalse(self.logzio_listener.find_log('Test malformed'))
+        self.assertEqual(self.logzio_listener.responses[400], 1)
+        counters = sender.stats()['counters']
+        self.assertEqual(counters['bulks_rejected'], 1)
+        self.assertEqual(counters['logs_rejected'], 1)
+        self.assertEqual(counters['logs_sent'], 1)
+        sender.shutdown()
+
+    def test_counting_only(self):
+        self.logzio_listener.store_logs = False
+        sender = self._sender(compression='gzip')
+        for counter in range(100):
+            sender.append({'message': 'Test counted {}'.format(counter)})
+        sender.flush()
+
+        self.assertEqual(self.logzio_listener.get_number_of_logs(), 100)
+        self.assertEqual(self.logzio_listener.logs_list, [])
+        sender.shutdown()
@@ -0,0 +1,111 @@
+import logging
+import os
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from unittest import TestCase, skipIf
+from unittest.mock import patch
+
+from logzio.exceptions import LogzioException
+from logzio.sender import LogzioSender
+
+if hasattr(socket, 'AF_UNIX'):
+    from logzio.relay import LogzioRelayHandler, RelayServer
+
+
+class _RecordingSender:
+    def __init__(self):
+        self.logs = []
+
+    def append_encoded(self, log):
+        self.logs.append(log)
+
+    def shutdown(self, timeout=None):
+        return True
+
+
+@skipIf(not hasattr(socket, 'AF_UNIX'), 'Unix domain sockets are required')
+class TestRelay(TestCase):
+    def setUp(self):
+        self.temp_dir = tempfile.TemporaryDirectory()
+        self.socket_path = os.path.join(self.temp_dir.name, 'relay.sock')
+
+    def tearDown(self):
+        self.temp_dir.cleanup()
+
+    def _start(self, sender, **kwargs):
+        server = RelayServer(sender, self.socket_path, **kwargs)
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        return server
+
+    @patch('logzio.sender.requests.Session')
+    def test_logs_of_all_processes_share_bulks(self, mock_session):
+        post = mock_session.return_value.post
+        post.return_value.status_code = 200
+        server = self._start(LogzioSender(token='token',
+                                          logs_drain_timeout=60))
+        script = (
+            "import logging, sys\n"
+            "from logzio.relay import LogzioRelayHandler\n"
+            "handler = LogzioRelayHandler({!r})\n"
+            "logger = logging.getLogger('relay-test')\n"
+            "logger.addHandler(handler)\n"
+            "for counter in range(10):\n"
+            "    logger.warning('Test relay %s %s', sys.argv[1], counter)\n"
+            "handler.close()\n"
+            "sys.exit(handler.logzio_sender.dropped_logs)\n"
+        ).format(self.socket_path)
+        processes = [subprocess.Popen([sys.executable, '-c', script, str(i)])
+                     for i in range(3)]
+        for process in processes:
+            self.assertEqual(process.wait(timeout=30), 0)
+
+        self.assertTrue(server.stop())
+        self.assertEqual(post.call_count, 1)
+        data = post.call_args.kwargs['data']
+        self.assertEqual(data.count(b'Test relay'), 30)
+        self.assertIn(b'"Test relay 2 9"', data)
+        self.assertFalse(os.path.exists(self.socket_path))
+
+    def test_long_and_cut_short_lines_are_dropped(self):
+        sender = _RecordingSender()
+        server = self._start(sender, max_log_bytes=100)
+        client = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        client.connect(self.socket_path)
+        client.sendall(b'{"message": "first"}\n' + b'x' * 150 + b'\n' +
+                       b'x' * 50)
+        client.sendall(b'x' * 100 + b'\n{"message": "second"}\n' +
+                       b'{"message": "cut sh')
+        client.close()
+
+        self.assertTrue(server.stop())
+        self.assertEqual(sender.logs, [b'{"message": "first"}',
+                                       b'{"message": "second"}'])
+        self.assertEqual(server.dropped, 2)
+
+    def test_logs_are_dropped_while_relay_is_down(self):
+        handler = LogzioRelayHandler(self.socket_path)
+        handler.logzio_sender.reconnect_interval = 0
+        logger = logging.getLogger('relay-down-test')
+        logger.propagate = False
+        logger.addHandler(handler)
+        logger.warning('Test relay down')
+        self.assertEqual(handler.logzio_sender.dropped_logs, 1)
+
+        sender = _RecordingSender()
+        server = self._start(sender)
+        with self.assertRaises(LogzioException):
+            RelayServer(_RecordingSender(), self.socket_path)
+        logger.warning('Test relay up')
+        handler.close()
+        for _ in range(50):
+            if sender.logs:
+                break
+            time.sleep(0.1)
+
+        self.assertTrue(server.stop())
+        self.assertEqual(len(sender.logs), 1)
+        self.assertIn(b'Test relay up', sender.logs[0])
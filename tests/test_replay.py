@@ -0,0 +1,116 @@
+import os
+import subprocess
+import sys
+import tempfile
+import time
+from unittest import TestCase
+
+from logzio.logger import get_stdout_logger
+from logzio.replay import BackupReplayer
+from logzio.sender import LogzioSender
+
+from .mockLogzioListener import listener
+
+
+class TestBackupReplayer(TestCase):
+    def setUp(self):
+        self.temp_dir = tempfile.TemporaryDirectory()
+        self.backup_dir = self.temp_dir.name
+        self.sent = []
+
+    def tearDown(self):
+        self.temp_dir.cleanup()
+
+    def _write_backup(self, name, logs, age=60):
+        path = os.path.join(self.backup_dir, name)
+        with open(path, 'wb') as f:
+            f.writelines(log + b'\n' for log in logs)
+        os.utime(path, (time.time() - age, time.time() - age))
+        return path
+
+    def _replayer(self, send_function=None, **kwargs):
+        return BackupReplayer(send_function or self._send,
+                              get_stdout_logger(False),
+                              directory=self.backup_dir, **kwargs)
+
+    def _send(self, logs_list):
+        self.sent.append(logs_list)
+        return True
+
+    def test_backups_are_replayed_and_deleted(self):
+        self._write_backup('logzio-failures-01012024-000000.txt',
+                           [b'first', b'second', b'third'])
+
+        self.assertTrue(self._replayer(bulk_size=12).replay_backups())
+        self.assertEqual(self.sent, [[b'first', b'second'], [b'third']])
+        self.assertEqual(os.listdir(self.backup_dir), [])
+
+    def test_replay_resumes_after_failure(self):
+        self._write_backup('logzio-failures-01012024-000000.txt',
+                           [b'first', b'second', b'third'])
+        attempts = []
+
+        def flaky_send(logs_list):
+            attempts.append(logs_list)
+            return len(attempts) == 1
+
+        self.assertFalse(self._replayer(flaky_send, bulk_size=5).replay_backups())
+        self.assertEqual(len(os.listdir(self.backup_dir)), 2)
+
+        self.assertTrue(self._replayer(bulk_size=5).replay_backups())
+        self.assertEqual(self.sent, [[b'second'], [b'third']])
+        self.assertEqual(os.listdir(self.backup_dir), [])
+
+    def test_recent_backups_are_left_alone(self):
+        self._write_backup('logzio-failures-01012024-000000.txt', [b'log'],
+                           age=0)
+
+        self.assertTrue(self._replayer().replay_backups())
+        self.assertEqual(self.sent, [])
+
+    def test_backups_claimed_by_dead_process_are_adopted(self):
+        dead_process = subprocess.Popen([sys.executable, '-c', 'pass'])
+        dead_process.wait()
+        path = self._write_backup(
+            'logzio-failures-01012024-000000.txt.{}.replay'.format(dead_process.pid),
+            [b'first', b'second'])
+        with open(path + '.offset', 'w') as f:
+            f.write('6')
+
+        self.assertTrue(self._replayer().replay_backups())
+        self.assertEqual(self.sent, [[b'second']])
+
+    def test_rate_limit(self):
+        self._write_backup('logzio-failures-01012024-000000.txt',
+                           [b'x' * 99] * 4)
+
+        start_time = time.time()
+        self._replayer(bulk_size=100, bytes_per_second=1000).replay_backups()
+        self.assertGreaterEqual(time.time() - start_time, 0.35)
+        self.assertEqual(len(self.sent), 4)
+
+
+class TestLogzioSenderReplay(TestCase):
+    def test_sender_replays_backups(self):
+        logzio_listener = listener.MockLogzioListener()
+        logzio_listener.clear_logs_buffer()
+        logzio_listener.clear_server_error()
+        with tempfile.TemporaryDirectory() as backup_dir:
+            path = os.path.join(backup_dir, 'logzio-failures-01012024-000000.txt')
+            with open(path, 'wb') as f:
+                f.write(b'{"message": "Test replayed log"}\n')
+            os.utime(path, (time.time() - 60, time.time() - 60))
+
+            sender = LogzioSender(
+                token='token', logs_drain_timeout=60,
+                url='http://{}:{}'.format(logzio_listener.get_host(),
+                                          logzio_listener.get_port()),
+                replay_backups=True, replay_directory=backup_dir)
+            for _ in range(50):
+                if logzio_listener.find_log('Test replayed log'):
+                    break
+                time.sleep(0.1)
+            sender.shutdown()
+
+            self.assertTrue(logzio_listener.find_log('Test replayed log'))
+            self.assertEqual(os.listdir(backup_dir), [])
@@ -0,0 +1,110 @@
+import logging
+import threading
+from unittest import TestCase
+from unittest.mock import patch
+
+from logzio.exceptions import LogzioException
+from logzio.handler import LogzioHandler
+from logzio.sampling import RecordSampler, SamplingRule
+
+
+def _record(name='chatty', level=logging.INFO):
+    return logging.LogRecord(name, level, 'test.py', 10, 'moo', (), None)
+
+
+class TestRecordSampler(TestCase):
+    def test_first_matching_rule_applies(self):
+        sampler = RecordSampler([
+            {'logger': 'chatty.quiet', 'sample_rate': 1.0},
+            {'logger': 'chatty', 'max_level': 'INFO', 'sample_rate': 0},
+        ])
+
+        self.assertFalse(sampler.allow(_record('chatty')))
+        self.assertFalse(sampler.allow(_record('chatty.child')))
+        self.assertTrue(sampler.allow(_record('chatty.quiet')))
+        self.assertTrue(sampler.allow(_record('chatty', logging.ERROR)))
+        self.assertTrue(sampler.allow(_record('chattybox')))
+
+    def test_sample_rate(self):
+        sampler = RecordSampler([{'sample_rate': 0.25}])
+        with patch('logzio.sampling.random.random',
+                   side_effect=[0.1, 0.3, 0.2, 0.9]):
+            self.assertEqual([sampler.allow(_record()) for _ in range(4)],
+                             [True, False, True, False])
+
+    @patch('logzio.sampling.monotonic')
+    def test_token_bucket(self, monotonic):
+        monotonic.return_value = 100.0
+        sampler = RecordSampler([{'max_per_second': 2, 'burst': 3}])
+
+        self.assertEqual([sampler.allow(_record()) for _ in range(4)],
+                         [True, True, True, False])
+        monotonic.return_value = 100.5
+        self.assertEqual([sampler.allow(_record()) for _ in range(2)],
+                         [True, False])
+        self.assertEqual(sampler.take_summaries()[0][1], 2)
+
+    @patch('logzio.sampling.monotonic')
+    def test_fractional_rate(self, monotonic):
+        monotonic.return_value = 100.0
+        sampler = RecordSampler([{'max_per_second': 0.5}])
+
+        self.assertEqual([sampler.allow(_record()) for _ in range(2)],
+                         [True, False])
+        monotonic.return_value = 101.0
+        self.assertFalse(sampler.allow(_record()))
+        monotonic.return_value = 102.0
+        self.assertTrue(sampler.allow(_record()))
+
+    def test_invalid_rules(self):
+        with self.assertRaises(LogzioException):
+            SamplingRule(sample_rate=2)
+        with self.assertRaises(LogzioException):
+            SamplingRule(max_per_second=0.5, burst=0.5)
+        with self.assertRaises(LogzioException):
+            SamplingRule(max_level='LOUD')
+
+
+class TestLogzioHandlerSampling(TestCase):
+    def test_suppressed_records_are_not_formatted_and_summarized(self):
+        handler = LogzioHandler('moo', sampling_rules=[
+            {'logger': 'chatty', 'max_level': 'INFO', 'sample_rate': 0}])
+        appended = []
+        handler.logzio_sender.append = appended.append
+        logger = logging.getLogger('chatty.sampling-test')
+        logger.propagate = False
+        logger.setLevel(logging.INFO)
+        logger.addHandler(handler)
+
+        with patch.object(handler, 'format_message',
+                          wraps=handler.format_message) as format_message:
+            for _ in range(5):
+                logger.info('Test suppressed')
+            logger.error('Test kept')
+        self.assertEqual(format_message.call_count, 1)
+        self.assertEqual([log['message'] for log in appended], ['Test kept'])
+
+        handler.flush()
+        self.assertEqual(appended[-1]['suppressed_records'], 5)
+        self.assertEqual(appended[-1]['logger'], 'chatty')
+        self.assertEqual(
+            appended[-1]['message'],
+            '5 records of chatty at INFO or below were suppressed by sampling')
+        logger.removeHandler(handler)
+
+    def test_summary_is_shipped_when_no_more_records_come_in(self):
+        handler = LogzioHandler('moo', sampling_summary_interval=0.1,
+                                sampling_rules=[{'sample_rate': 0}])
+        shipped = threading.Event()
+        appended = []
+
+        def append(log):
+            appended.append(log)
+            shipped.set()
+        handler.logzio_sender.append = append
+
+        for _ in range(3):
+            handler.handle(_record())
+        self.assertTrue(shipped.wait(5))
+        self.assertEqual(appended[0]['suppressed_records'], 3)
+        handler.close()
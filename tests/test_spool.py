@@ -0,0 +1,189 @@
+import os
+import signal
+import subprocess
+import sys
+import tempfile
+import time
+from unittest import TestCase, skipIf
+from unittest.mock import patch
+
+from logzio.sender import LogzioSender
+from logzio.spool import SpoolQueue
+
+
+class TestSpoolQueue(TestCase):
+    def setUp(self):
+        self.temp_dir = tempfile.TemporaryDirectory()
+        self.spool_dir = self.temp_dir.name
+
+    def tearDown(self):
+        self.temp_dir.cleanup()
+
+    def _segments(self):
+        return sorted(name for name in os.listdir(self.spool_dir)
+                      if name.endswith('.log'))
+
+    def test_get_bulk_and_ack(self):
+        spool = SpoolQueue(self.spool_dir)
+        for log in (b'first', b'second', b'third'):
+            self.assertTrue(spool.put(log))
+        self.assertEqual(spool.qsize(), 3)
+        self.assertEqual(spool.bytes, 16)
+
+        bulk = spool.get_bulk(12)
+        self.assertEqual(bulk, [b'first', b'second'])
+        self.assertEqual(spool.get_bulk(100), [b'third'])
+        self.assertTrue(spool.empty())
+
+        spool.ack(bulk)
+        spool.close()
+        self.assertEqual(SpoolQueue(self.spool_dir).get_bulk(100), [b'third'])
+
+    def test_acknowledged_segments_are_deleted(self):
+        spool = SpoolQueue(self.spool_dir, segment_bytes=10)
+        for counter in range(5):
+            spool.put('log {}'.format(counter).encode('utf-8'))
+        self.assertEqual(len(self._segments()), 3)
+
+        bulks = [spool.get_bulk(6) for _ in range(5)]
+        # Out of order acknowledgements don't release the older bulks
+        spool.ack(bulks[2])
+        self.assertEqual(len(self._segments()), 3)
+        for bulk in bulks:
+            spool.ack(bulk)
+        self.assertEqual(len(self._segments()), 1)
+
+        spool.close()
+        self.assertEqual(self._segments(), [])
+
+    def test_logs_are_resumed_after_close(self):
+        spool = SpoolQueue(self.spool_dir, segment_bytes=10)
+        for counter in range(5):
+            spool.put('log {}'.format(counter).encode('utf-8'))
+        spool.ack(spool.get_bulk(11))
+        spool.get_bulk(6)  # In flight, never acknowledged
+        spool.close()
+
+        resumed_spool = SpoolQueue(self.spool_dir)
+        self.assertEqual(resumed_spool.qsize(), 3)
+        self.assertTrue(resumed_spool.bulk_ready(linger=60))
+        self.assertEqual(resumed_spool.get_bulk(100),
+                         [b'log 2', b'log 3', b'log 4'])
+
+    def test_segments_of_live_spools_are_not_adopted(self):
+        spool = SpoolQueue(self.spool_dir)
+        spool.put(b'log')
+
+        self.assertTrue(SpoolQueue(self.spool_dir).empty())
+        self.assertEqual(spool.get_bulk(100), [b'log'])
+
+    def test_log_cut_short_by_a_crash_is_dropped(self):
+        spool = SpoolQueue(self.spool_dir)
+        spool.put(b'complete')
+        spool.close()
+        with open(os.path.join(self.spool_dir, self._segments()[0]), 'ab') as f:
+            f.write(b'{"message": "cut sh')
+
+        self.assertEqual(SpoolQueue(self.spool_dir).get_bulk(100), [b'complete'])
+
+    def test_max_size_bounds_queued_logs(self):
+        spool = SpoolQueue(self.spool_dir, max_size=2,
+                           overflow_policy='drop_oldest')
+        for log in (b'first', b'second', b'third'):
+            spool.put(log)
+
+        self.assertEqual(spool.dropped, 1)
+        self.assertEqual(spool.get_bulk(100), [b'second', b'third'])
+
+    @skipIf(os.name == 'nt', 'SIGKILL is not available on Windows')
+    def test_oldest_log_age_follows_taken_logs(self):
+        spool = SpoolQueue(self.spool_dir, bulk_size=1000)
+        with patch('logzio.spool.monotonic', return_value=100.0):
+            for _ in range(5):
+                spool.put(b'old log')
+        with patch('logzio.spool.monotonic', return_value=101.1):
+            for _ in range(2):
+                spool.put(b'new log')
+        self.assertEqual(spool.get_bulk(24).enqueued_at, 100.0)
+        self.assertEqual(spool.get_bulk(16).enqueued_at, 100.0)
+        self.assertEqual(spool.get_bulk(100).enqueued_at, 101.1)
+        spool.put(b'newest log')
+        self.assertLess(spool.oldest_log_age(), 1)
+        self.assertFalse(spool.bulk_ready(linger=1.0))
+        spool.close()
+
+    def test_unsynced_logs_are_synced_once_due(self):
+        spool = SpoolQueue(self.spool_dir, fsync_interval=0.1)
+        with patch('logzio.spool.os.fsync') as fsync:
+            spool.put(b'synced right away')
+            spool.put(b'synced later')
+            self.assertEqual(fsync.call_count, 1)
+            self.assertLessEqual(spool.time_to_sync(), 0.1)
+
+            time.sleep(0.1)
+            spool.sync_if_due()
+            self.assertEqual(fsync.call_count, 2)
+            self.assertIsNone(spool.time_to_sync())
+        spool.close()
+
+    def test_logs_survive_sigkill(self):
+        script = (
+            "import os, signal\n"
+            "from logzio.spool import SpoolQueue\n"
+            "spool = SpoolQueue({!r})\n"
+            "for counter in range(100):\n"
+            "    spool.put('killed log {{}}'.format(counter).encode('utf-8'))\n"
+            "spool.ack(spool.get_bulk(50))\n"
+            "os.kill(os.getpid(), signal.SIGKILL)\n"
+        ).format(self.spool_dir)
+        process = subprocess.run([sys.executable, '-c', script], timeout=30)
+        self.assertEqual(process.returncode, -signal.SIGKILL)
+
+        spool = SpoolQueue(self.spool_dir)
+        logs = spool.get_bulk(10000)
+        # The first bulk, of 3 logs, was acknowledged before the kill
+        self.assertEqual(len(logs), 97)
+        self.assertEqual(logs[0], b'killed log 3')
+
+
+class TestLogzioSenderSpool(TestCase):
+    def setUp(self):
+        self.temp_dir = tempfile.TemporaryDirectory()
+        self.spool_dir = self.temp_dir.name
+
+    def tearDown(self):
+        self.temp_dir.cleanup()
+
+    @patch('logzio.sender.requests.Session')
+    def test_sent_logs_leave_the_spool(self, mock_session):
+        mock_session.return_value.post.return_value.status_code = 200
+        sender = LogzioSender(token='token', logs_drain_timeout=60,
+                              spool_directory=self.spool_dir)
+        sender.append({'message': 'Test spool'})
+        sender.flush()
+
+        self.assertIn(b'Test spool',
+                      mock_session.return_value.post.call_args.kwargs['data'])
+        self.assertTrue(sender.shutdown())
+        self.assertEqual(os.listdir(self.spool_dir), [])
+
+    @patch('logzio.sender.requests.Session')
+    def test_unsent_logs_are_resumed_by_next_sender(self, mock_session):
+        mock_session.return_value.post.side_effect = Exception('Listener is down')
+        sender = LogzioSender(token='token', logs_drain_timeout=60,
+                              number_of_retries=4, retry_timeout=2,
+                              spool_directory=self.spool_dir)
+        sender.append({'message': 'Test spool resume'})
+
+        start_time = time.time()
+        self.assertFalse(sender.shutdown(timeout=0.5))
+        self.assertLess(time.time() - start_time, 1.5)
+
+        mock_session.return_value.post.side_effect = None
+        mock_session.return_value.post.return_value.status_code = 200
+        next_sender = LogzioSender(token='token', logs_drain_timeout=60,
+                                   spool_directory=self.spool_dir)
+        next_sender.flush()
+        self.assertIn(b'Test spool resume',
+                      mock_session.return_value.post.call_args.kwargs['data'])
+        next_sender.shutdown()
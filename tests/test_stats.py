@@ -0,0 +1,96 @@
+from unittest import TestCase
+from unittest.mock import MagicMock, patch
+
+from logzio.sender import LogzioSender
+from logzio.stats import Histogram, prometheus_text
+
+
+def _response(status_code):
+    response = MagicMock()
+    response.status_code = status_code
+    response.headers = {}
+    return response
+
+
+class TestHistogram(TestCase):
+    def test_buckets_are_cumulative(self):
+        histogram = Histogram((1, 10))
+        for value in (0.5, 1, 5, 50):
+            histogram.observe(value)
+        snapshot = histogram.snapshot()
+        self.assertEqual(snapshot['buckets'],
+                         [(1, 2), (10, 3), (float('inf'), 4)])
+        self.assertEqual(snapshot['sum'], 56.5)
+        self.assertEqual(snapshot['count'], 4)
+
+
+class TestLogzioSenderStats(TestCase):
+    @patch('logzio.sender.requests.Session')
+    def test_requests_are_counted(self, mock_session):
+        post = mock_session.return_value.post
+        events = []
+        sender = LogzioSender(
+            token='token', logs_drain_timeout=60, backup_logs=False,
+            number_of_retries=2, retry_timeout=60,
+            stats_callback=lambda event, fields: events.append(event))
+
+        post.return_value = _response(200)
+        sender.append({'message': 'Test sent 1'})
+        sender.append({'message': 'Test sent 2'})
+        sender.flush()
+        post.return_value = _response(400)
+        sender.append({'message': 'Test rejected'})
+        sender.flush()
+        post.return_value = _response(500)
+        sender.append({'message': 'Test retried'})
+        sender.flush()
+
+        stats = sender.stats()
+        counters = stats['counters']
+        self.assertEqual(counters['logs_enqueued'], 4)
+        self.assertEqual(counters['bulks_sent'], 1)
+        self.assertEqual(counters['logs_sent'], 2)
+        self.assertEqual(counters['logs_rejected'], 1)
+        self.assertEqual(counters['failed_requests'], 1)
+        self.assertEqual(counters['retries'], 1)
+        self.assertEqual(stats['gauges']['retries_pending'], 1)
+        self.assertEqual(stats['gauges']['queued_logs'], 0)
+        self.assertEqual(stats['histograms']['request_seconds']['count'], 3)
+        # The retried bulk isn't acknowledged yet
+        self.assertEqual(
+            stats['histograms']['enqueue_to_ack_seconds']['count'], 2)
+        self.assertEqual(events, ['request', 'ack', 'request', 'ack',
+                                  'request'])
+        sender.shutdown(0)
+
+    @patch('logzio.sender.requests.Session')
+    def test_callback_errors_are_swallowed(self, mock_session):
+        mock_session.return_value.post.return_value = _response(200)
+
+        def callback(event, fields):
+            raise ValueError(event)
+
+        sender = LogzioSender(token='token', logs_drain_timeout=60,
+                              stats_callback=callback)
+        sender.append({'message': 'Test callback error'})
+        sender.flush()
+        self.assertEqual(sender.stats()['counters']['logs_sent'], 1)
+        sender.shutdown()
+
+    def test_prometheus_text(self):
+        sender = LogzioSender(token='token', logs_drain_timeout=60,
+                              backup_logs=False)
+        sender.append({'message': 'Test queued'})
+        text = prometheus_text(sender.stats(), labels={'sender': 'a"b'})
+        sender.shutdown(0)
+
+        self.assertIn('# TYPE logzio_sender_logs_enqueued_total counter\n'
+                      'logzio_sender_logs_enqueued_total{sender="a\\"b"} 1\n',
+                      text)
+        self.assertIn('logzio_sender_queued_logs{sender="a\\"b"} 1\n', text)
+        self.assertIn('# TYPE logzio_sender_request_seconds histogram\n',
+                      text)
+        self.assertIn('logzio_sender_request_seconds_bucket'
+                      '{sender="a\\"b",le="+Inf"} 0\n', text)
+        self.assertIn('logzio_sender_request_seconds_count'
+                      '{sender="a\\"b"} 0\n', text)
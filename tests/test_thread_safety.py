@@ -44,14 +44,14 @@ class TestThreadSafety(TestCase):
 
     def test_get_messages_returns_available_messages(self):
         """Test that _get_messages_up_to_max_allowed_size returns queued messages."""
-        self.sender.queue.put('{"message": "test1"}')
-        self.sender.queue.put('{"message": "test2"}')
-        self.sender.queue.put('{"message": "test3"}')
+        self.sender.queue.put(b'{"message": "test1"}')
+        self.sender.queue.put(b'{"message": "test2"}')
+        self.sender.queue.put(b'{"message": "test3"}')
         
         result = self.sender._get_messages_up_to_max_allowed_size()
         
         self.assertEqual(len(result), 3)
-        self.assertIn('{"message": "test1"}', result)
+        self.assertIn(b'{"message": "test1"}', result)
 
     @patch('logzio.sender.requests.Session')
     def test_concurrent_flush_calls_are_thread_safe(self, mock_session):
@@ -61,7 +61,7 @@ class TestThreadSafety(TestCase):
         mock_session.return_value.post.return_value = mock_response
         
         for i in range(100):
-            self.sender.queue.put(f'{{"message": "test{i}"}}')
+            self.sender.queue.put(f'{{"message": "test{i}"}}'.encode('utf-8'))
         
         errors = []
         
@@ -87,7 +87,7 @@ class TestThreadSafety(TestCase):
         mock_response.status_code = 200
         mock_session.return_value.post.return_value = mock_response
         
-        self.sender.queue.put('{"message": "test"}')
+        self.sender.queue.put(b'{"message": "test"}')
         
         start_time = time.time()
         self.sender.flush()
@@ -133,7 +133,7 @@ class TestThreadSafety(TestCase):
             except Exception as e:
                 results['error'] = e
         
-        self.sender.queue.put('{"message": "test"}')
+        self.sender.queue.put(b'{"message": "test"}')
         
         consumer_thread = threading.Thread(target=consumer)
         flusher_thread = threading.Thread(target=flusher)
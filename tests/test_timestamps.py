@@ -0,0 +1,46 @@
+import logging
+from unittest import TestCase
+
+from logzio.exceptions import LogzioException
+from logzio.handler import LogzioHandler
+from logzio.timestamps import TimestampFormatter
+
+# 2023-11-14T22:13:20.123456Z
+CREATED = 1700000000.123456
+
+
+class TestTimestampFormatter(TestCase):
+    def test_precisions(self):
+        self.assertEqual(TimestampFormatter()(CREATED),
+                         '2023-11-14T22:13:20.123Z')
+        self.assertEqual(TimestampFormatter('micros')(CREATED),
+                         '2023-11-14T22:13:20.123456Z')
+        self.assertAlmostEqual(TimestampFormatter('nanos')(CREATED),
+                               1700000000123456000, delta=1000)
+
+    def test_fraction_is_not_truncated_below_the_millisecond(self):
+        # 1700000000.123 * 1000 % 1000 is 122.99...
+        self.assertEqual(TimestampFormatter()(1700000000.123),
+                         '2023-11-14T22:13:20.123Z')
+
+    def test_prefix_follows_the_second(self):
+        format_timestamp = TimestampFormatter()
+        self.assertEqual(format_timestamp(CREATED),
+                         '2023-11-14T22:13:20.123Z')
+        self.assertEqual(format_timestamp(CREATED + 100),
+                         '2023-11-14T22:15:00.123Z')
+        self.assertEqual(format_timestamp(1700000000.9999999),
+                         '2023-11-14T22:13:21.000Z')
+
+    def test_unknown_precision(self):
+        with self.assertRaises(LogzioException):
+            TimestampFormatter('seconds')
+
+    def test_handler_stamps_the_time_of_the_event(self):
+        handler = LogzioHandler('moo', timestamp_precision='micros')
+        record = logging.LogRecord('my-logger', logging.INFO, 'test.py', 10,
+                                   'moo', (), None)
+        record.created = CREATED
+
+        self.assertEqual(handler.format_message(record)['@timestamp'],
+                         '2023-11-14T22:13:20.123456Z')